@@ -1,19 +1,45 @@
 #!/usr/bin/env python3
 
 import os
+import copy
 import sys
-import subprocess
 import json
 import shutil
 import argparse
 import datetime
 import re
 import stat
+import threading
+import uuid
 import tempfile
 import math
+import mmap
+import ctypes
+import select
+import signal
+import asyncio
+import shlex
+import struct
+import concurrent.futures
+import contextlib
+import contextvars
+import hashlib
+import ipaddress
+import hmac
+import time
+import fnmatch
+import gzip
+import zipfile
+import zlib
+import tarfile
+import http.server
+import queue
+import urllib.request
+import urllib.error
+import urllib.parse
 from pathlib import Path
 from textwrap import dedent
-from typing import Optional
+from typing import Callable, Optional
 
 # Root directory of this script
 ROOT_DIR = Path(__file__).resolve().parent
@@ -34,25 +60,340 @@ BUILD_LOG_FILE = ROOT_DIR / "kernel_build.log"
 # Defconfig used for kernel build
 KERNEL_DEFCONFIG = "essi_defconfig"
 
+# Fingerprint of the defconfig inputs, stored inside OUT_DIR
+DEFCONFIG_FINGERPRINT_FILE = ".defconfig_fingerprint"
+
+# Maximum number of external commands running at the same time
+MAX_PARALLEL_COMMANDS = os.cpu_count() or 1
+
+# Per-program command timeouts in seconds (None: no limit)
+COMMAND_TIMEOUTS = {
+    "make": None,
+    "git": 3600,
+    "wget": 3600,
+    "curl": 3600,
+}
+COMMAND_DEFAULT_TIMEOUT = 1800
+
+# Seconds a command gets to exit after SIGTERM before SIGKILL
+COMMAND_KILL_GRACE = 5
+
+# Config fragments applied for --lto
+LTO_CONFIG_FRAGMENTS = {
+    "none": ["CONFIG_LTO_NONE=y",
+             "# CONFIG_LTO_CLANG_THIN is not set",
+             "# CONFIG_LTO_CLANG_FULL is not set"],
+    "thin": ["CONFIG_LTO_CLANG_THIN=y",
+             "# CONFIG_LTO_NONE is not set",
+             "# CONFIG_LTO_CLANG_FULL is not set"],
+    "full": ["CONFIG_LTO_CLANG_FULL=y",
+             "# CONFIG_LTO_NONE is not set",
+             "# CONFIG_LTO_CLANG_THIN is not set"],
+}
+
+# Persistent ThinLTO cache, kept outside OUT_DIR so it survives --clean
+THINLTO_CACHE_DIR = ROOT_DIR.parent / "cache" / "thinlto"
+THINLTO_CACHE_DEFAULT_MAX_SIZE_GB = 10.0
+THINLTO_CACHE_MAX_AGE_DAYS = 14
+
+# Sample-based (AutoFDO) and instrumentation-based (PGO) profiles for --profile
+PROFILE_KINDS = {"sample": "AutoFDO", "instr": "PGO"}
+
+# Compiler flags applying a profile, passed in KCFLAGS
+PROFILE_CFLAGS = {
+    "sample": ["-fprofile-sample-use={path}"],
+    "instr": ["-fprofile-instr-use={path}", "-Wno-profile-instr-unprofiled",
+              "-Wno-profile-instr-out-of-date"],
+}
+
+# File magics of indexed and raw LLVM instrumentation profiles
+PROFILE_INDEXED_MAGIC = b"\xfflprofi\x81"
+PROFILE_RAW_MAGIC = b"\x81rforpl\xff"
+
+# Validated profiles stored under their hash, outside OUT_DIR
+PROFILE_CACHE_DIR = ROOT_DIR.parent / "cache" / "profiles"
+
+# Share of all profile samples held by the functions counted as hot
+PROFILE_HOT_FRACTION = 0.99
+
+# Kernel functions in a profile written by --write-synthetic-profile
+PROFILE_SYNTHETIC_FUNCTIONS = 200
+
+# tmpfs mounts tried for --ram-build, in order
+RAM_BUILD_TMPFS_DIRS = [Path("/dev/shm"), Path(os.environ.get("XDG_RUNTIME_DIR", "/run/shm"))]
+
+# Free memory required to start a RAM build, and the level that forces a spill
+RAM_BUILD_DEFAULT_MIN_FREE_GB = 16.0
+RAM_BUILD_SPILL_FREE_GB = 2.0
+RAM_BUILD_POLL_INTERVAL = 2.0
+
+# Files and directories an in-tree (no O=) build leaves in the kernel source,
+# only then does --clean need 'make mrproper'
+IN_TREE_BUILD_STATE = [".config", "include/config", "include/generated", "vmlinux", "Module.symvers"]
+
+# Record of the modules installed into MODULES_STAGING_DIR, stored inside OUT_DIR
+MODULES_INSTALL_MANIFEST_FILE = ".modules_install_manifest"
+
+# Checkpoint journal of completed build stages, stored inside OUT_DIR
+BUILD_JOURNAL_FILE = ".build_journal"
+
+# Options that do not change what the build stages produce
+BUILD_JOURNAL_IGNORED_OPTIONS = {
+    "resume", "clean", "jobs", "watch", "watch_debounce", "max_parallel_commands",
+    "skip_prebuilt_update", "verify_reproducible", "build_cache",
+    "build_cache_max_size", "ram_build", "ram_build_min_free",
+}
+
+# Default size limit for a local build artifact cache
+BUILD_CACHE_DEFAULT_MAX_SIZE_GB = 20.0
+
+# Default port and address of the build artifact cache server, which only
+# binds beyond loopback with a shared token
+BUILD_CACHE_DEFAULT_PORT = 8787
+BUILD_CACHE_DEFAULT_BIND = "127.0.0.1"
+
+# Shared token of the cache server: clients send it as a bearer token and
+# sign entries with it (HMAC-SHA256 in BUILD_CACHE_SIGNATURE_HEADER)
+BUILD_CACHE_TOKEN_ENV = "BUILD_CACHE_TOKEN"
+BUILD_CACHE_SIGNATURE_HEADER = "X-Cache-Signature"
+
+# Marks an OUT_DIR whose Image, dtbs and modules came from the build cache:
+# vmlinux and the object tree next to them belong to an older compile
+BUILD_CACHE_RESTORED_FILE = ".build_cache_restored"
+
+# Default localhost port and number of concurrent builds of the build service
+BUILD_SERVICE_DEFAULT_PORT = 8788
+BUILD_SERVICE_DEFAULT_WORKERS = 2
+
+# Per-worker kernel worktrees and O= trees and per-build results of the build service
+BUILD_SERVICE_DIR = ROOT_DIR.parent / "build_service"
+
+# Options set by the build service itself, meaningless for a queued build,
+# or writing files outside the build's own results
+BUILD_SERVICE_REJECTED_OPTIONS = {
+    "watch", "serve_build_cache", "serve_builds", "benchmark_ram_build",
+    "target_device", "kernel_source", "out_dir", "dist_dir", "write_synthetic_profile",
+    "trim_unpackaged_modules", "trim_fragment", "benchmark_config_trim", "artifact_store",
+    "list_artifacts", "restore_artifacts", "thinlto_cache", "save_size_baseline",
+    "compression_profile", "benchmark_compression", "build_service_dir",
+}
+
+# Path options of build requests read from the requested branch: builds run
+# in the worker's kernel worktree, so they must be relative and stay inside it
+BUILD_SERVICE_TREE_PATH_OPTIONS = {"config_fragment", "profile", "size_budgets", "verify_boot_image"}
+
+# Timeout of one queued build
+BUILD_SERVICE_BUILD_TIMEOUT = 6 * 3600
+
+# Directory of the fragments written by --trim-unpackaged-modules,
+# unpackaged_modules_<target>.config unless --trim-fragment is given
+CONFIG_TRIM_DIR = ROOT_DIR.parent / "cache" / "config_trim"
+
+# Trial .config generations before giving up on resolving Kconfig dependencies
+CONFIG_TRIM_MAX_ROUNDS = 5
+
+# Boot image header version 4 layouts, as written by mkbootimg.py
+BOOT_MAGIC = b"ANDROID!"
+BOOT_IMAGE_V4_HEADER = "<8sIIII4II1536sI"
+BOOT_IMAGE_PAGE_SIZE = 4096
+VENDOR_BOOT_MAGIC = b"VNDRBOOT"
+VENDOR_BOOT_V4_HEADER = "<8sIIIII2048sI16sIIQIIII"
+VENDOR_RAMDISK_TABLE_ENTRY = "<III32s16I"
+VENDOR_RAMDISK_TYPES = {"none": 0, "platform": 1, "recovery": 2, "dlkm": 3}
+
+# mkbootimg.py default load addresses recorded in vendor_boot.img
+VENDOR_BOOT_LOAD_BASE = 0x10000000
+VENDOR_BOOT_LOAD_OFFSETS = {"kernel": 0x00008000, "ramdisk": 0x01000000,
+                            "tags": 0x00000100, "dtb": 0x01f00000}
+
+# History of size reports per target, kept outside OUT_DIR
+SIZE_HISTORY_DIR = ROOT_DIR.parent / "cache" / "size_history"
+SIZE_HISTORY_MAX_ENTRIES = 100
+
+# Size budgets checked by --track-sizes when the file exists
+SIZE_BUDGETS_FILE = ROOT_DIR / "size_budgets.json"
+
+# Names accepted for size baselines, which become file names
+SIZE_BASELINE_NAME_RE = re.compile(r"[A-Za-z0-9][A-Za-z0-9._-]*")
+
+# Largest module and symbol changes logged by --track-sizes
+SIZE_DIFF_TOP = 20
+
+# Archive of DIST_DIR across builds, deduplicated by content-defined chunks
+ARTIFACT_STORE_DIR = ROOT_DIR.parent / "cache" / "artifacts"
+ARTIFACT_STORE_MAX_BUILDS = 200
+
+# Chunk size bounds; a chunk ends after ARTIFACT_CHUNK_RUN bytes mapped to 1
+# by ARTIFACT_CHUNK_TABLE. A 15-byte run of 1s (p = 1/2 each) takes 2^16 - 2
+# bytes to appear past ARTIFACT_CHUNK_MIN, so chunks average ~76 KiB on random
+# data after the ARTIFACT_CHUNK_MAX cut. Zero and 0xff padding maps to 0
+# and is cut at ARTIFACT_CHUNK_MAX, so padding chunks deduplicate as well
+ARTIFACT_CHUNK_MIN = 16 * 1024
+ARTIFACT_CHUNK_MAX = 256 * 1024
+ARTIFACT_CHUNK_RUN = 15
+ARTIFACT_CHUNK_TABLE = bytes(
+    0 if x in (0x00, 0xff) else hashlib.sha256(bytes([x])).digest()[0] & 1
+    for x in range(256)
+)
+
+# Unreferenced chunks younger than this are kept, a running build may use them
+ARTIFACT_CHUNK_GRACE = 3600
+
+# ELF section flag of sections loaded into memory
+ELF_SHF_ALLOC = 0x2
+
+# Build information written to DIST_DIR (profile hash and coverage, ...)
+BUILD_METADATA_FILE = "build_metadata.json"
+
+# Compression settings chosen by --benchmark-compression, read by normal builds
+COMPRESSION_PROFILE_FILE = ROOT_DIR.parent / "cache" / "compression_profile.json"
+
+# Settings used when no profile exists
+DEFAULT_COMPRESSION_SETTINGS = {
+    "vendor_ramdisk_dlkm": {"level": 9, "favor_dec_speed": False},
+    "system_dlkm": {"compressor": "lz4hc,9", "cluster_size": 0, "extended": []},
+    "vendor_dlkm": {"compressor": "lz4hc,9", "cluster_size": 0, "extended": []},
+}
+
+# Benchmark matrix for --benchmark-compression
+BENCH_LZ4_LEVELS = [1, 3, 6, 9, 12]
+BENCH_EROFS_COMPRESSORS = ["lz4", "lz4hc,9", "lz4hc,12"]
+BENCH_EROFS_CLUSTER_SIZES = [0, 16384, 65536]
+BENCH_EROFS_EXTENDED = [[], ["dedupe"], ["fragments"], ["ztailpacking"]]
+
+# A candidate must decompress at least this fraction as fast as the best one
+BENCH_MIN_THROUGHPUT_RATIO = 0.8
+
+# Source files that trigger a rebuild in --watch mode
+WATCH_SOURCE_SUFFIXES = {".c", ".h", ".S", ".dts", ".dtsi", ".lds", ".rs"}
+WATCH_SOURCE_NAMES = {"Makefile", "Kbuild", "Kconfig", KERNEL_DEFCONFIG}
+
+# Seconds of quiet after the last edit before rebuilding in --watch mode
+WATCH_DEFAULT_DEBOUNCE = 0.5
+
+# Codecs available for compressed kernel Image variants
+KERNEL_IMAGE_CODECS = ["gz", "lz4", "zst"]
+
+# Paths never packaged into the flashable ZIP
+FLASH_ZIP_EXCLUDES = {".git"}
+
+# Per-entry (pattern, method, level) for the flashable ZIP, first match wins
+# Payloads that are already compressed are stored as-is
+FLASH_ZIP_COMPRESSION = [
+    ("*.gz", zipfile.ZIP_STORED, 0),
+    ("*.lz4", zipfile.ZIP_STORED, 0),
+    ("*.zst", zipfile.ZIP_STORED, 0),
+    ("*.xz", zipfile.ZIP_STORED, 0),
+    ("*", zipfile.ZIP_DEFLATED, 9),
+]
+
+# Entries at least this large are deflated in parallel chunks
+FLASH_ZIP_PARALLEL_THRESHOLD = 8 * 1024 * 1024
+FLASH_ZIP_CHUNK_SIZE = 1024 * 1024
+
+# Zip records written by ZipWriter: local file header, central directory
+# header and end of central directory record, without zip64 extensions
+ZIP_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+ZIP_CENTRAL_HEADER = struct.Struct("<IBBHHHHHIIIHHHHHII")
+ZIP_END_RECORD = struct.Struct("<IHHHHIIH")
+ZIP_MAX_SIZE = 0xffffffff
+
+# Strip flags matching the INSTALL_MOD_STRIP used for modules_install
+MODULE_STRIP_FLAGS = "--strip-debug --keep-section=.ARM.attributes"
+
+# Module partitions: (mount prefix used in modules.dep, boot stage loading them)
+# vendor_ramdisk_dlkm loads in first stage init, the DLKM partitions later
+MODULE_PARTITIONS = {
+    "vendor_ramdisk_dlkm": ("", 0),
+    "system_dlkm": ("/system_dlkm", 1),
+    "vendor_dlkm": ("/vendor_dlkm", 1),
+}
+
 # Path to a kernel modules list file
 VENDOR_RAMDISK_DLKM_EARLY_MODULES_FILE = ROOT_DIR / "modules.early.load"
 VENDOR_RAMDISK_DLKM_MODULES_FILE = ROOT_DIR / "modules.load"
 VENDOR_DLKM_MODULES_FILE = ROOT_DIR / "modules.load.vendor_dlkm"
 
-# Global Paths
-OUT_DIR = None
-DIST_DIR = None
-MODULES_STAGING_DIR = None
-TOOLCHAIN_PATH = None
-KERNELBUILD_TOOLS_PATH = None
-GAS_PATH = None
-MKBOOT_PATH = None
-ANYKERNEL_PATH = None
-KERNEL_SOURCE_DIR = None
-
 # Config for downloading required prebuilts
 PREBUILTS_CONFIG = json.load(open(ROOT_DIR / "prebuilts.json"))
 
+class BuildContext:
+    """
+    Paths, environment and target settings of one build
+
+    Every stage function takes the context instead of reading module
+    globals, and commands run with the context's own environment, so
+    several builds (e.g. different targets or output trees) can run in
+    one process and on worker threads
+
+    The module-level settings (ARCH, TARGET_DEVICE, ...) are the defaults
+    """
+
+    def __init__(self,
+                 arch: str = ARCH,
+                 target_soc: str = TARGET_SOC,
+                 variant: str = VARIANT,
+                 target_device: str = TARGET_DEVICE,
+                 cross_compile_prefix: str = CROSS_COMPILE_PREFIX,
+                 defconfig: str = KERNEL_DEFCONFIG,
+                 prebuilts_base_dir: Path = PREBUILTS_BASE_DIR,
+                 out_dir: Optional[Path] = None,
+                 dist_dir: Optional[Path] = None):
+        self.arch = arch
+        self.target_soc = target_soc
+        self.variant = variant
+        self.target_device = target_device
+        self.cross_compile_prefix = cross_compile_prefix
+        self.defconfig = defconfig
+        self.prebuilts_base_dir = prebuilts_base_dir
+        self.prebuilts_config = json.loads(json.dumps(PREBUILTS_CONFIG))
+        self.compression_profile_file = COMPRESSION_PROFILE_FILE
+
+        # Set by setup_environment() and validate_prebuilts(), output
+        # directories default to the kernel tree
+        self.kernel_source_dir = None
+        self.toolchain_path = None
+        self.kernelbuild_tools_path = None
+        self.gas_path = None
+        self.mkboot_path = None
+        self.anykernel_path = None
+        self.out_dir = out_dir
+        self.dist_dir = dist_dir
+        self.modules_staging_dir = out_dir / "modules_install" if out_dir else None
+
+        # SOURCE_DATE_EPOCH used for all timestamps, set in reproducible mode
+        self.source_date_epoch = None
+
+        # tmpfs directory holding OUT_DIR and staging dirs in --ram-build mode
+        self.ram_build_root = None
+        self.ram_build_monitor = None
+
+        # Parent directory for staging dirs (None: system default)
+        self.temp_dir = None
+
+        # AutoFDO/PGO profile applied to every compile, set by load_profile()
+        self.profile = None
+
+        # Environment of every command run for this build
+        self.env = os.environ.copy()
+        self.env.update({
+            "ARCH": arch,
+            "CROSS_COMPILE": cross_compile_prefix,
+            "TARGET_SOC": target_soc,
+        })
+
+    def mkdtemp(self, prefix: str) -> Path:
+        """
+        Creates a staging directory under temp_dir
+        """
+        return Path(tempfile.mkdtemp(prefix=prefix, dir=self.temp_dir))
+
+    def which(self, name: str) -> Optional[str]:
+        """
+        Looks up a tool on this build's PATH
+        """
+        return shutil.which(name, path=self.env["PATH"])
+
 def log_message(message: str):
     """
     Logs a message to console and appends it to the build log file
@@ -71,52 +412,264 @@ def log_message(message: str):
     except Exception as e:
         print(f"Logging failed: {e}")
 
-def run_cmd(command: str,
+class CommandAborted(Exception):
+    """
+    Raised for commands that were cancelled because another stage failed
+    """
+
+class StageFailed(Exception):
+    """
+    Raised by run_parallel_stages when one of the stages exited with an error
+    """
+
+class CommandGroup:
+    """
+    Commands started by one stage group or one make, aborted together
+
+    Groups nest: commands run while a group is current (see
+    command_group()) belong to it, and aborting a group aborts the groups
+    started within it, but not the commands of other builds or stages
+    """
+
+    def __init__(self, parent: Optional["CommandGroup"] = None):
+        self.parent = parent
+        self.aborted = False
+
+    def is_aborted(self) -> bool:
+        group = self
+        while group is not None:
+            if group.aborted:
+                return True
+            group = group.parent
+        return False
+
+    def contains(self, group: Optional["CommandGroup"]) -> bool:
+        while group is not None:
+            if group is self:
+                return True
+            group = group.parent
+        return False
+
+# Command group of the running thread, copied into stage worker threads
+_COMMAND_GROUP = contextvars.ContextVar("command_group", default=None)
+
+def current_command_group() -> Optional[CommandGroup]:
+    return _COMMAND_GROUP.get()
+
+@contextlib.contextmanager
+def command_group(group: CommandGroup):
+    """
+    Makes group current for the commands this thread runs in the with block
+    """
+    token = _COMMAND_GROUP.set(group)
+    try:
+        yield group
+    finally:
+        _COMMAND_GROUP.reset(token)
+
+class SubprocessEngine:
+    """
+    Runs external commands on a dedicated asyncio event loop
+
+    Commands are started as argv lists in their own process group, limited
+    by a concurrency semaphore and subject to a per-command timeout.
+    abort() terminates the running commands of a CommandGroup and rejects
+    new ones in it, so a failing stage tears down its sibling stages'
+    children and nothing else. abort() without a group stops everything
+    """
+
+    def __init__(self, max_parallel: int):
+        self.max_parallel = max_parallel
+        # Running process -> CommandGroup it was started in
+        self.processes = {}
+        self.aborted = False
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="subprocess-engine", daemon=True)
+        self.thread.start()
+        self.semaphore = self.call(self.create_semaphore())
+
+    async def create_semaphore(self) -> asyncio.Semaphore:
+        return asyncio.Semaphore(self.max_parallel)
+
+    def call(self, coro):
+        """
+        Runs a coroutine on the engine loop from any other thread and waits for it
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def run_async(self,
+                        command: list[str] | str,
+                        cwd: Optional[Path],
+                        env: dict[str, str],
+                        timeout: Optional[float],
+                        stdout_path: Optional[Path],
+                        group: Optional[CommandGroup] = None) -> tuple[int, str, str]:
+        """
+        Runs one command
+
+        Returns:
+            tuple[int, str, str]: Exit code, stdout and stderr
+        """
+        def aborted() -> bool:
+            return self.aborted or (group is not None and group.is_aborted())
+
+        async with self.semaphore:
+            if aborted():
+                raise CommandAborted()
+            stdout_file = open(stdout_path, "wb") if stdout_path else None
+            try:
+                kwargs = dict(
+                    cwd=cwd,
+                    env=env,
+                    stdout=stdout_file or asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                    start_new_session=True,
+                )
+                if isinstance(command, str):
+                    process = await asyncio.create_subprocess_shell(command, **kwargs)
+                else:
+                    process = await asyncio.create_subprocess_exec(*command, **kwargs)
+                self.processes[process] = group
+                try:
+                    # Aborted while the process was starting
+                    if aborted():
+                        await self.terminate(process)
+                    stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+                except (asyncio.TimeoutError, asyncio.CancelledError):
+                    await self.terminate(process)
+                    raise
+                finally:
+                    self.processes.pop(process, None)
+            finally:
+                if stdout_file:
+                    stdout_file.close()
+
+        if aborted() and process.returncode != 0:
+            raise CommandAborted()
+        return (
+            process.returncode,
+            (stdout or b"").decode("utf-8", errors="replace"),
+            (stderr or b"").decode("utf-8", errors="replace"),
+        )
+
+    async def terminate(self, process: asyncio.subprocess.Process):
+        """
+        Sends SIGTERM to the command's process group, then SIGKILL if it
+        does not exit within COMMAND_KILL_GRACE seconds
+        """
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(process.pid, sig)
+            except ProcessLookupError:
+                return
+            try:
+                await asyncio.wait_for(process.wait(), COMMAND_KILL_GRACE)
+                return
+            except asyncio.TimeoutError:
+                continue
+
+    def run(self,
+            command: list[str] | str,
+            cwd: Optional[Path] = None,
+            env: Optional[dict[str, str]] = None,
+            timeout: Optional[float] = None,
+            stdout_path: Optional[Path] = None) -> tuple[int, str, str]:
+        return self.call(self.run_async(command, cwd, env or os.environ.copy(),
+                                        timeout, stdout_path, current_command_group()))
+
+    def abort(self, group: Optional[CommandGroup] = None) -> concurrent.futures.Future:
+        """
+        Terminates the running commands of a group (and of the groups within
+        it) and rejects new ones in it; without a group, terminates every
+        command and rejects all new ones, for shutdown
+
+        Returns:
+            concurrent.futures.Future: Done once the commands have exited
+        """
+        if group is None:
+            self.aborted = True
+        else:
+            group.aborted = True
+
+        async def terminate_all():
+            await asyncio.gather(*(
+                self.terminate(process) for process, owner in list(self.processes.items())
+                if group is None or group.contains(owner)
+            ))
+
+        return asyncio.run_coroutine_threadsafe(terminate_all(), self.loop)
+
+_ENGINE = None
+_ENGINE_LOCK = threading.Lock()
+
+def get_engine() -> SubprocessEngine:
+    """
+    Returns the process-wide subprocess engine, starting it on first use
+    """
+    global _ENGINE
+    with _ENGINE_LOCK:
+        if _ENGINE is None:
+            _ENGINE = SubprocessEngine(MAX_PARALLEL_COMMANDS)
+        return _ENGINE
+
+def get_command_timeout(command: list[str] | str) -> Optional[float]:
+    """
+    Returns the default timeout for a command, based on its program name
+    """
+    program = shlex.split(command)[0] if isinstance(command, str) else str(command[0])
+    return COMMAND_TIMEOUTS.get(Path(program).name, COMMAND_DEFAULT_TIMEOUT)
+
+def run_cmd(ctx: BuildContext,
+            command: list[str] | str,
             cwd: Optional[Path] = None,
             extra_env: Optional[dict[str, str]] = None,
-            fatal_on_error: bool = True
+            fatal_on_error: bool = True,
+            timeout: Optional[float] = None,
+            stdout_path: Optional[Path] = None,
+            stderr_path: Optional[Path] = None
             ) -> Optional[str]:
     """
-    Runs a shell command. The global PATH environment variable is expected
-    to be set correctly by setup_environment()
+    Runs a command through the subprocess engine with the build's
+    environment, whose PATH is set by setup_environment()
 
     Args:
-        command: Shell command to run
+        command: argv list, or a shell string for legacy callers
         cwd: Working directory (optional)
         extra_env: Additional environment variables (optional)
         fatal_on_error: Exit on failure if True
+        timeout: Seconds before the command is killed
+            (default: per-program COMMAND_TIMEOUTS)
+        stdout_path: Write stdout to this file instead of capturing it
+        stderr_path: Also append stderr to this file
 
     Returns:
         Command stdout, or None if failed and not fatal
     """
+    if not isinstance(command, str):
+        command = [str(x) for x in command]
+    display = command if isinstance(command, str) else shlex.join(command)
     log_message(
-        f"Running: '{command}' in '{cwd.resolve()}'" 
-        if cwd else f"Running: '{command}'"
+        f"Running: '{display}' in '{cwd.resolve()}'"
+        if cwd else f"Running: '{display}'"
     )
 
-    env = os.environ.copy()
+    env = dict(ctx.env)
     if extra_env:
         env.update(extra_env)
+    if timeout is None:
+        timeout = get_command_timeout(command)
 
     try:
-        result = subprocess.run(
-            command,
-            shell=True,
-            check=True,
-            cwd=cwd,
-            capture_output=True,
-            text=True,
-            encoding="utf-8",
-            env=env
-        )
-        log_message("Command succeeded")
-        return result.stdout
-    except subprocess.CalledProcessError as e:
-        log_message(f"[ERROR] Command failed (exit {e.returncode}): '{command}'")
-        if e.stdout:
-            log_message(f"stdout:\n{e.stdout.strip()}")
-        if e.stderr:
-            log_message(f"stderr:\n{e.stderr.strip()}")
+        returncode, stdout, stderr = get_engine().run(
+            command, cwd=cwd, env=env, timeout=timeout, stdout_path=stdout_path)
+    except CommandAborted:
+        log_message(f"[ERROR] Command cancelled: '{display}'")
+        if fatal_on_error:
+            sys.exit(1)
+        return None
+    except asyncio.TimeoutError:
+        log_message(f"[ERROR] Command timed out after {timeout}s: '{display}'")
         if fatal_on_error:
             sys.exit(1)
         return None
@@ -124,14 +677,78 @@ def run_cmd(command: str,
         log_message(f"[CRITICAL] Unexpected exception: {e}")
         sys.exit(1)
 
-def get_version_env() -> dict[str, str]:
+    if stderr_path and stderr:
+        with open(stderr_path, "a") as f:
+            f.write(stderr)
+
+    if returncode != 0:
+        log_message(f"[ERROR] Command failed (exit {returncode}): '{display}'")
+        if stdout and stdout.strip():
+            log_message(f"stdout:\n{stdout.strip()}")
+        if stderr and stderr.strip():
+            log_message(f"stderr:\n{stderr.strip()}")
+        if fatal_on_error:
+            sys.exit(1)
+        return None
+
+    log_message("Command succeeded")
+    return stdout
+
+def run_parallel_stages(stages: list[tuple[str, Callable[[], None]]]):
+    """
+    Runs independent build stages concurrently in worker threads
+
+    If any stage fails, the stages' CommandGroup is aborted so the other
+    stages' running commands are terminated, then the build exits once
+    every stage has stopped. Commands of other builds are not affected
+
+    Args:
+        stages (list[tuple[str, Callable]]): (name, function) pairs
+    """
+    if len(stages) <= 1:
+        for _, stage in stages:
+            stage()
+        return
+    engine = get_engine()
+    group = CommandGroup(current_command_group())
+
+    def guarded(name: str, stage: Callable[[], None]):
+        try:
+            with command_group(group):
+                stage()
+        except SystemExit:
+            # SystemExit must not escape into the event loop
+            raise StageFailed(name) from None
+
+    async def runner():
+        tasks = [asyncio.ensure_future(asyncio.to_thread(guarded, name, stage))
+                 for name, stage in stages]
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        failed = [x for x in done if x.exception()]
+        if failed:
+            engine.abort(group)
+            if pending:
+                await asyncio.wait(pending)
+            # Cancelled stages fail too; only the first failure is reported
+            for task in tasks:
+                task.exception()
+            raise failed[0].exception()
+
+    log_message(f"Running stages in parallel: {', '.join(x[0] for x in stages)}")
+    try:
+        engine.call(runner())
+    except StageFailed as e:
+        log_message(f"ERROR: Stage '{e}' failed, cancelled remaining stages")
+        sys.exit(1)
+
+def get_version_env(ctx: BuildContext) -> dict[str, str]:
     """
     Returns BRANCH and KMI_GENERATION from build config files as env variables
     Exits if required files are missing
     """
     config_files = {
-        "BRANCH": KERNEL_SOURCE_DIR / "build.config.constants",
-        "KMI_GENERATION": KERNEL_SOURCE_DIR / "build.config.common"
+        "BRANCH": ctx.kernel_source_dir / "build.config.constants",
+        "KMI_GENERATION": ctx.kernel_source_dir / "build.config.common"
     }
 
     result = {}
@@ -147,22 +764,127 @@ def get_version_env() -> dict[str, str]:
             sys.exit(1)
     return result
 
-def validate_prebuilts():
+def hash_file(path: Path) -> str:
+    """
+    Returns the SHA-256 hex digest of a file, read in chunks
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def get_toolchain_identity(ctx: BuildContext) -> str:
+    """
+    Returns a stable string identifying the toolchain from prebuilts.json
+    Runtime-only keys (e.g. skip_update) are ignored
+    """
+    toolchain = {
+        key: value
+        for key, value in ctx.prebuilts_config["Toolchain"].items()
+        if key != "skip_update"
+    }
+    return json.dumps(toolchain, sort_keys=True)
+
+def enable_reproducible_mode(ctx: BuildContext):
+    """
+    Enables reproducible outputs. SOURCE_DATE_EPOCH is taken from the
+    environment, or from the kernel commit time if unset, and exported
+    so every tool sees the same value
+    """
+    epoch = ctx.env.get("SOURCE_DATE_EPOCH")
+    if not epoch:
+        epoch = run_cmd(ctx, ["git", "log", "-1", "--format=%ct"], cwd=ctx.kernel_source_dir,
+                        fatal_on_error=True)
+    try:
+        ctx.source_date_epoch = int(epoch.strip())
+    except ValueError:
+        log_message(f"ERROR: Invalid SOURCE_DATE_EPOCH: '{epoch}'")
+        sys.exit(1)
+
+    ctx.env["SOURCE_DATE_EPOCH"] = str(ctx.source_date_epoch)
+    log_message(f"Reproducible mode enabled, SOURCE_DATE_EPOCH={ctx.source_date_epoch}")
+
+def get_reproducible_env(ctx: BuildContext) -> dict[str, str]:
+    """
+    Returns the kbuild variables pinning build timestamp, user and host
+    Empty unless reproducible mode is enabled
+    """
+    if ctx.source_date_epoch is None:
+        return {}
+    timestamp = datetime.datetime.fromtimestamp(ctx.source_date_epoch, tz=datetime.timezone.utc)
+    return {
+        "KBUILD_BUILD_TIMESTAMP": timestamp.strftime("%a %b %d %H:%M:%S UTC %Y"),
+        "KBUILD_BUILD_USER": "build-user",
+        "KBUILD_BUILD_HOST": "build-host",
+    }
+
+def normalize_tree(ctx: BuildContext, root: Path):
+    """
+    Normalizes a staging tree before packaging in reproducible mode:
+    every mtime is set to SOURCE_DATE_EPOCH and permissions to
+    0755 (directories and executables) or 0644
+    """
+    if ctx.source_date_epoch is None:
+        return
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames:
+            path = Path(dirpath) / name
+            if path.is_symlink():
+                continue
+            executable = path.stat().st_mode & stat.S_IXUSR
+            path.chmod(0o755 if executable else 0o644)
+            os.utime(path, (ctx.source_date_epoch, ctx.source_date_epoch))
+    # Directories last, after their contents were touched
+    for dirpath, dirnames, filenames in os.walk(root, topdown=False):
+        Path(dirpath).chmod(0o755)
+        os.utime(dirpath, (ctx.source_date_epoch, ctx.source_date_epoch))
+
+def hash_dist_dir(ctx: BuildContext) -> dict[str, str]:
+    """
+    Returns the SHA-256 of every file in DIST_DIR, keyed by relative path
+    """
+    return {
+        str(path.relative_to(ctx.dist_dir)): hash_file(path)
+        for path in sorted(ctx.dist_dir.rglob("*"))
+        if path.is_file()
+    }
+
+def compare_dist_hashes(first: dict[str, str], second: dict[str, str]) -> bool:
+    """
+    Compares two DIST_DIR hash sets and logs every differing artifact
+
+    Returns:
+        bool: True if both builds produced identical artifacts
+    """
+    mismatches = [
+        name for name in sorted(set(first) | set(second))
+        if first.get(name) != second.get(name)
+    ]
+    for name in mismatches:
+        log_message(f"NOT REPRODUCIBLE: {name} "
+                    f"({first.get(name, 'missing')} != {second.get(name, 'missing')})")
+    if mismatches:
+        log_message(f"ERROR: {len(mismatches)} of {len(first)} artifacts differ between builds")
+        return False
+    log_message(f"All {len(first)} artifacts are reproducible")
+    return True
+
+def validate_prebuilts(ctx: BuildContext):
     """
     Verifies that all required prebuilt paths and kernel source exist
     Exits if any are missing or invalid
     """
     log_message("Checking required prebuilts...")
 
-    global OUT_DIR, DIST_DIR, MODULES_STAGING_DIR, KERNEL_SOURCE_DIR
-
     required = {
-        "Toolchain": TOOLCHAIN_PATH,
-        "Kernel Build Tools": KERNELBUILD_TOOLS_PATH,
-        "GAS": GAS_PATH,
-        "Mkbootimg Tool": MKBOOT_PATH,
-        "Anykernel3": ANYKERNEL_PATH,
-        "Kernel Source": KERNEL_SOURCE_DIR,
+        "Toolchain": ctx.toolchain_path,
+        "Kernel Build Tools": ctx.kernelbuild_tools_path,
+        "GAS": ctx.gas_path,
+        "Mkbootimg Tool": ctx.mkboot_path,
+        "Anykernel3": ctx.anykernel_path,
+        "Kernel Source": ctx.kernel_source_dir,
     }
 
     for name, path in required.items():
@@ -171,231 +893,2476 @@ def validate_prebuilts():
             sys.exit(1)
 
     # Output directory for the kernel build artifacts
-    OUT_DIR = KERNEL_SOURCE_DIR / "out"
-    DIST_DIR = KERNEL_SOURCE_DIR.parent / "out" / "dist"
-    MODULES_STAGING_DIR = OUT_DIR / "modules_install"
+    if ctx.out_dir is None:
+        set_out_dir(ctx, ctx.kernel_source_dir / "out")
+    if ctx.dist_dir is None:
+        ctx.dist_dir = ctx.kernel_source_dir.parent / "out" / "dist"
 
     log_message("All prebuilts verified")
 
-def clean_build_artifacts():
+def set_out_dir(ctx: BuildContext, out_dir: Path):
     """
-    Cleans the kernel build environment:
-    - Runs 'make clean' and 'make mrproper'
-    - Removes the output directory (OUT_DIR)
+    Points OUT_DIR and the module staging directory at out_dir
     """
-    log_message("Cleaning kernel build artifacts...")
-    
-    run_cmd("make clean", cwd=KERNEL_SOURCE_DIR, fatal_on_error=False)
-    run_cmd("make mrproper", cwd=KERNEL_SOURCE_DIR, fatal_on_error=False)
-    
-    if OUT_DIR.exists():
-        log_message(f"Removing main output directory: '{OUT_DIR}'")
-        shutil.rmtree(OUT_DIR, ignore_errors=True)
-    
-    log_message("Clean operation completed...")
-
-def build_kernel(jobs: int,
-                 extra_env: Optional[dict[str, str]] = None,
-                 install_modules: bool = False
-                 ) -> Optional[str]:
+    ctx.out_dir = out_dir
+    ctx.modules_staging_dir = ctx.out_dir / "modules_install"
+
+def get_mem_available() -> int:
     """
-    Builds the Android kernel using the given defconfig
+    Returns MemAvailable from /proc/meminfo in bytes
+    """
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) * 1024
+    return 0
 
-    Args:
-        jobs (int): Number of parallel make jobs (-j)
-        extra_env (dict[str, str], optional): Additional environment variables
-            (e.g. BRANCH, KMI_GENERATION) for versioning or build scripts
-        install_modules (bool): Whether to install kernel modules to the staging directory
+def find_tmpfs(min_free: int) -> Optional[Path]:
+    """
+    Returns the first writable tmpfs mount from RAM_BUILD_TMPFS_DIRS with at
+    least min_free bytes available, or None
+    """
+    try:
+        with open("/proc/mounts") as f:
+            mounts = {Path(x.split()[1]): x.split()[2] for x in f}
+    except OSError:
+        return None
+    for path in RAM_BUILD_TMPFS_DIRS:
+        if mounts.get(path) != "tmpfs" or not os.access(path, os.W_OK):
+            continue
+        st = os.statvfs(path)
+        if st.f_bavail * st.f_frsize >= min_free:
+            return path
+    return None
+
+def get_ram_build_free(ctx: BuildContext) -> int:
+    """
+    Returns the memory still usable by a RAM build: the smaller of
+    MemAvailable and the free space of its tmpfs
+    """
+    st = os.statvfs(ctx.ram_build_root)
+    return min(get_mem_available(), st.f_bavail * st.f_frsize)
 
-    Returns:
-        Optional[str]: Not used, present for compatibility
+class RamPressureMonitor:
+    """
+    Polls free memory while the kernel compiles on tmpfs and aborts the
+    commands of the make's CommandGroup once it drops below
+    RAM_BUILD_SPILL_FREE_GB
     """
-    log_message(f"Starting kernel build with {jobs} parallel jobs...")
 
-    OUT_DIR.mkdir(parents=True, exist_ok=True)
-    DIST_DIR.mkdir(parents=True, exist_ok=True)
-    MODULES_STAGING_DIR.mkdir(parents=True, exist_ok=True)
+    def __init__(self, ctx: BuildContext, group: CommandGroup):
+        self.ctx = ctx
+        self.group = group
+        self.pressure = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.poll, name="ram-monitor", daemon=True)
+        self.thread.start()
+
+    def poll(self):
+        limit = RAM_BUILD_SPILL_FREE_GB * 1024 ** 3
+        while not self.stopped.wait(RAM_BUILD_POLL_INTERVAL):
+            free = get_ram_build_free(self.ctx)
+            if free < limit:
+                log_message(f"WARNING: Only {free / 1024 ** 3:.1f} GB free, "
+                            f"stopping the tmpfs build")
+                self.pressure.set()
+                get_engine().abort(self.group)
+                return
 
-    make_args = (
-        f"LLVM=1 LLVM_IAS=1 ARCH={ARCH} O={OUT_DIR} "
-        f"CROSS_COMPILE={CROSS_COMPILE_PREFIX}"
-    )
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
 
-    log_message(f"Using defconfig: '{KERNEL_DEFCONFIG}'")
-    run_cmd(
-        f"make {make_args} {KERNEL_DEFCONFIG}",
-        cwd=KERNEL_SOURCE_DIR,
-        fatal_on_error=True
-    )
+def enable_ram_build(ctx: BuildContext, min_free: int) -> bool:
+    """
+    Moves OUT_DIR and the staging dirs onto tmpfs when enough memory is free
+    DIST_DIR stays on disk, so only final artifacts are written there
 
-    # Compile the kernel Image
-    log_message("Compiling kernel Image...")
-    extra_version = extra_env
-    run_cmd(
-        f"make -j{jobs} {make_args}",
-        cwd=KERNEL_SOURCE_DIR,
-        extra_env=extra_version,
-        fatal_on_error=True
-    )
+    The tmpfs OUT_DIR is kept between runs for incremental builds. It is not
+    seeded from the disk tree: Kbuild records srctree relative to O= when
+    OUT_DIR is inside the source, so a moved tree rebuilds everything anyway
 
-    # Install modules to the staging directory
-    if install_modules:
-        log_message(f"Installing all modules to: {MODULES_STAGING_DIR}...")
-        run_cmd(
-            f"make -j{jobs} {make_args} "
-            f"INSTALL_MOD_STRIP='--strip-debug --keep-section=.ARM.attributes' "
-            f"INSTALL_MOD_PATH={MODULES_STAGING_DIR} modules_install",
-            cwd=KERNEL_SOURCE_DIR
-        )
+    Args:
+        min_free (int): Bytes of free memory and tmpfs space required
 
-    # Source and destination paths for the final kernel Image
-    image_path = OUT_DIR / "arch" / ARCH / "boot" / "Image"
-    dist_path = DIST_DIR / "Image"
+    Returns:
+        bool: True if the RAM build is active, False if it stays on disk
+    """
+    available = get_mem_available()
+    tmpfs = find_tmpfs(min_free)
+    if available < min_free or tmpfs is None:
+        log_message(f"WARNING: --ram-build needs {min_free / 1024 ** 3:.1f} GB free memory "
+                    f"and tmpfs space ({available / 1024 ** 3:.1f} GB available), "
+                    f"building on disk")
+        return False
+
+    tag = hashlib.sha256(str(ctx.kernel_source_dir.resolve()).encode()).hexdigest()[:12]
+    ctx.ram_build_root = tmpfs / f"kernel_build_{tag}"
+    (ctx.ram_build_root / "staging").mkdir(parents=True, exist_ok=True)
+    set_out_dir(ctx, ctx.ram_build_root / "out")
+    ctx.temp_dir = ctx.ram_build_root / "staging"
+    log_message(f"RAM build: OUT_DIR and staging on {ctx.ram_build_root}")
+    return True
+
+def disable_ram_build(ctx: BuildContext, discard: bool = False):
+    """
+    Returns OUT_DIR and the staging dirs to disk
+
+    Args:
+        discard (bool): Delete the tmpfs tree to release its memory
+    """
+    if ctx.ram_build_root is None:
+        return
+    if discard:
+        shutil.rmtree(ctx.ram_build_root, ignore_errors=True)
+    set_out_dir(ctx, ctx.kernel_source_dir / "out")
+    ctx.temp_dir = None
+    ctx.ram_build_root = None
+
+def spill_staging_if_low(ctx: BuildContext):
+    """
+    Moves new staging dirs back to disk if tmpfs memory ran low after compiling
+    """
+    if ctx.ram_build_root is None or ctx.temp_dir is None:
+        return
+    if get_ram_build_free(ctx) < RAM_BUILD_SPILL_FREE_GB * 1024 ** 3:
+        log_message("WARNING: Low memory, staging images on disk")
+        ctx.temp_dir = None
+
+def run_kernel_make(ctx: BuildContext,
+                    jobs: int, extra_env: Optional[dict[str, str]],
+                    config_fragments: list[Path],
+                    goals: Optional[list[str]] = None):
+    """
+    Runs the main kernel make for the given goals (default: all)
 
+    In --ram-build mode, memory pressure stops the make, discards the tmpfs
+    tree and continues the build in the on-disk OUT_DIR
+    """
+    group = CommandGroup(current_command_group())
+    if ctx.ram_build_root is not None:
+        ctx.ram_build_monitor = RamPressureMonitor(ctx, group)
     try:
-        shutil.copyfile(image_path, dist_path)
-    except Exception as e:
-        log_message(f"ERROR: Failed to copy kernel Image to DIST_DIR: {e}")
+        with command_group(group):
+            result = run_cmd(
+                ctx,
+                ["make", f"-j{jobs}", *get_make_args(ctx), *(goals or [])],
+                cwd=ctx.kernel_source_dir,
+                extra_env=extra_env,
+                fatal_on_error=ctx.ram_build_monitor is None
+            )
+    finally:
+        if ctx.ram_build_monitor is not None:
+            ctx.ram_build_monitor.stop()
+    if result is not None:
+        ctx.ram_build_monitor = None
+        return
+
+    if ctx.ram_build_monitor is None or not ctx.ram_build_monitor.pressure.is_set():
         sys.exit(1)
+    ctx.ram_build_monitor = None
+
+    log_message("Spilling to disk, continuing the build in the on-disk OUT_DIR")
+    thinlto_link = ctx.out_dir / ".thinlto-cache"
+    thinlto_cache = thinlto_link.resolve() if thinlto_link.is_symlink() else None
+    disable_ram_build(ctx, discard=True)
+    ctx.out_dir.mkdir(parents=True, exist_ok=True)
+    ctx.modules_staging_dir.mkdir(parents=True, exist_ok=True)
+    generate_kernel_config(ctx, get_make_args(ctx), config_fragments)
+    if thinlto_cache:
+        link_thinlto_cache(ctx, thinlto_cache)
+    run_cmd(
+        ctx,
+        ["make", f"-j{jobs}", *get_make_args(ctx), *(goals or [])],
+        cwd=ctx.kernel_source_dir,
+        extra_env=extra_env,
+        fatal_on_error=True
+    )
 
-    log_message("Kernel build completed")
+def run_kernel_goals(ctx: BuildContext,
+                     jobs: int, extra_env: Optional[dict[str, str]],
+                     config_fragments: list[Path],
+                     on_dtbs: Callable[[], None]):
+    """
+    Builds the dtbs goal first, then Image and modules while on_dtbs
+    packages the device trees, and logs how much packaging overlapped the
+    compile, net of the separate dtbs make at worst
 
-def build_dtbo_images():
+    Image and modules stay in one make so module compilation still
+    overlaps the vmlinux link; separate makes on one O= tree would race
     """
-    Generate dtbo.img and dtb.img from compiled *.dtbo and *.dtb files
+    start = time.perf_counter()
+    run_kernel_make(ctx, jobs, extra_env, config_fragments, goals=["dtbs"])
+    dtbs_make = time.perf_counter() - start
+
+    timings = {}
+
+    def timed(name: str, stage: Callable[[], None]) -> Callable[[], None]:
+        def run():
+            start = time.perf_counter()
+            stage()
+            timings[name] = time.perf_counter() - start
+        return run
+
+    start = time.perf_counter()
+    run_parallel_stages([
+        ("Image modules", timed("make", lambda: run_kernel_make(
+            ctx,
+            jobs, extra_env, config_fragments, goals=["Image", "modules"]))),
+        ("dtbs packaging", timed("dtbs", on_dtbs)),
+    ])
+    wall = time.perf_counter() - start
+    overlap = timings["make"] + timings["dtbs"] - wall
+    # A single make would have built the dtbs too, so only part of the
+    # separate dtbs make is extra work; counting all of it bounds the saving
+    log_message(f"DTB packaging ran alongside Image/modules: {timings['dtbs']:.1f}s of "
+                f"packaging, {overlap:.1f}s overlapped; the separate dtbs make took "
+                f"{dtbs_make:.1f}s, so at least {overlap - dtbs_make:.1f}s wall time saved")
+
+def benchmark_ram_build(ctx: BuildContext, args: argparse.Namespace, min_free: int):
+    """
+    Times a from-scratch build on disk and on tmpfs and logs the comparison
+    Both runs use throwaway output trees, so existing OUT_DIRs are untouched
+    """
+    results = {}
+    for mode in ("disk", "tmpfs"):
+        if mode == "tmpfs":
+            if not enable_ram_build(ctx, min_free):
+                break
+            set_out_dir(ctx, ctx.ram_build_root / "out.bench")
+        else:
+            set_out_dir(ctx, ctx.kernel_source_dir / "out.bench")
+        shutil.rmtree(ctx.out_dir, ignore_errors=True)
 
-    - Uses mkdtimg for dtbo.img with custom flags
-    - Concatenates *.dtb files into dtb.img
+        log_message(f"Benchmarking {mode} build...")
+        start = time.perf_counter()
+        try:
+            run_build_stages(ctx, args)
+        finally:
+            shutil.rmtree(ctx.out_dir, ignore_errors=True)
+            disable_ram_build(ctx)
+        results[mode] = time.perf_counter() - start
+
+    for mode, elapsed in results.items():
+        log_message(f"{mode:>5} build: {elapsed:.1f}s")
+    if len(results) == 2:
+        log_message(f"tmpfs speedup: {results['disk'] / results['tmpfs']:.2f}x")
+
+def discard_tree(path: Path):
     """
-    arch_dts = OUT_DIR / "arch" / ARCH / "boot" / "dts"
-    dtbo_dir = arch_dts / "samsung" / TARGET_DEVICE
-    dtb_dir = arch_dts / "exynos"
+    Moves a directory aside with an atomic rename and deletes it in a
+    background thread, so a new build can start in its place at once
 
-    dtbo_files = sorted(dtbo_dir.glob("*.dtbo"))
-    dtb_files = sorted(dtb_dir.glob("*.dtb"))
+    Leftovers of deletions cut short by an earlier exit are deleted too.
+    The thread is not a daemon, so the script only exits once it is done
 
-    if not dtbo_files:
-        log_message(f"ERROR: No *.dtbo files found in {dtbo_dir}")
-        sys.exit(1)
-    if not dtb_files:
-        log_message(f"ERROR: No *.dtb files found in {dtb_dir}")
-        sys.exit(1)
+    Args:
+        path (Path): Directory to remove
+    """
+    start = time.perf_counter()
+    trash = sorted(path.parent.glob(f".{path.name}.deleting-*"))
+    if path.exists():
+        target = path.with_name(f".{path.name}.deleting-{uuid.uuid4().hex[:8]}")
+        try:
+            path.rename(target)
+            trash.append(target)
+        except OSError as e:
+            log_message(f"WARNING: Cannot move '{path}' aside ({e}), deleting it in place")
+            shutil.rmtree(path, ignore_errors=True)
+    blocked = time.perf_counter() - start
+    if not trash:
+        return
 
-    DIST_DIR.mkdir(parents=True, exist_ok=True)
+    def delete():
+        delete_start = time.perf_counter()
+        for x in trash:
+            shutil.rmtree(x, ignore_errors=True)
+        elapsed = time.perf_counter() - delete_start
+        log_message(f"Removed '{path}' in the background in {elapsed:.1f}s, "
+                    f"the build waited {blocked:.2f}s ({elapsed - blocked:.1f}s saved)")
 
-    dtbo_img_path = DIST_DIR / "dtbo.img"
-    dtb_img_path = DIST_DIR / "dtb.img"
+    log_message(f"Removing '{path}' in the background")
+    threading.Thread(target=delete, name=f"discard-{path.name}").start()
 
-    # Build dtbo.img
-    custom_flags = (
-        "--custom0=/:dtbo-hw_rev "
-        "--custom1=/:dtbo-hw_rev_end "
-        "--custom2=/:edtbo-rev"
-    )
+def clean_build_artifacts(ctx: BuildContext):
+    """
+    Cleans the kernel build environment:
+    - Runs 'make mrproper' only if the source tree holds in-tree build
+      state; O= builds keep all of theirs in OUT_DIR
+    - Moves the output directory (OUT_DIR) aside and deletes it in the background
+    """
+    log_message("Cleaning kernel build artifacts...")
+    start = time.perf_counter()
+
+    # mrproper includes clean, both walk the whole source tree
+    in_tree = [x for x in IN_TREE_BUILD_STATE if (ctx.kernel_source_dir / x).exists()]
+    if in_tree:
+        log_message(f"Source tree has in-tree build state ({', '.join(in_tree)}), "
+                    f"running make mrproper")
+        run_cmd(ctx, ["make", "mrproper"], cwd=ctx.kernel_source_dir, fatal_on_error=False)
+    else:
+        log_message("All build state is in OUT_DIR, skipping make clean and mrproper")
 
-    run_cmd(
-        f"{KERNELBUILD_TOOLS_PATH / 'mkdtimg'} create {dtbo_img_path} {custom_flags} "
-        + " ".join(str(f) for f in dtbo_files),
-        fatal_on_error=True
-    )
+    discard_tree(ctx.out_dir)
 
-    # Build dtb.img
-    with open(dtb_img_path, "wb") as out_f:
-        for dtb in dtb_files:
-            out_f.write(dtb.read_bytes())
+    log_message(f"Clean operation completed in {time.perf_counter() - start:.2f}s...")
 
-    log_message("Successfully built dtbo.img and dtb.img")
+def get_config_fingerprint(ctx: BuildContext, make_args: list[str], config_fragments: list[Path]) -> str:
+    """
+    Fingerprints everything that feeds the generated .config:
+    the defconfig, config fragments, make arguments and toolchain
 
-def build_boot_image():
+    Args:
+        make_args (list[str]): Common make arguments used for config generation
+        config_fragments (list[Path]): Config fragments merged over the defconfig
+
+    Returns:
+        str: SHA-256 hex digest of all inputs
     """
-    Builds boot.img from kernel image
+    defconfig_path = ctx.kernel_source_dir / "arch" / ctx.arch / "configs" / ctx.defconfig
+
+    digest = hashlib.sha256()
+    digest.update(" ".join(make_args).encode())
+    digest.update(get_toolchain_identity(ctx).encode())
+    for path in [defconfig_path, *config_fragments]:
+        if not path.is_file():
+            log_message(f"ERROR: Config input not found: {path}")
+            sys.exit(1)
+        digest.update(str(path.resolve()).encode())
+        digest.update(hash_file(path).encode())
+    return digest.hexdigest()
+
+def generate_kernel_config(ctx: BuildContext,
+                           make_args: list[str],
+                           config_fragments: Optional[list[Path]] = None
+                           ) -> bool:
     """
-    # Paths to input and output files
-    kernel_image_path = OUT_DIR / "arch" / ARCH / "boot" / "Image"
-    bootimg_output_path = DIST_DIR / "boot.img"
+    Generates OUT_DIR/.config from the defconfig and optional fragments
+    Skipped entirely when the inputs match the fingerprint stored in OUT_DIR
+    and .config has not been modified since it was generated
 
-    if not kernel_image_path.is_file():
-        log_message(f"ERROR: Kernel image not found: {kernel_image_path}")
-        sys.exit(1)
+    Args:
+        make_args (list[str]): Common make arguments (LLVM, ARCH, O=, ...)
+        config_fragments (list[Path], optional): Fragments merged over the defconfig
+
+    Returns:
+        bool: True if .config was regenerated, False if it was up to date
+    """
+    config_fragments = config_fragments or []
+    config_path = ctx.out_dir / ".config"
+    fingerprint_path = ctx.out_dir / DEFCONFIG_FINGERPRINT_FILE
+    fingerprint = get_config_fingerprint(ctx, make_args, config_fragments)
 
+    if config_path.is_file() and fingerprint_path.is_file():
+        try:
+            stored = json.loads(fingerprint_path.read_text())
+        except (OSError, ValueError):
+            stored = {}
+        if (stored.get("fingerprint") == fingerprint and
+                stored.get("config_hash") == hash_file(config_path)):
+            log_message("Defconfig inputs unchanged, skipping config generation")
+            return False
+
+    log_message(f"Using defconfig: '{ctx.defconfig}'")
+    fingerprint_path.unlink(missing_ok=True)
     run_cmd(
-        f"{MKBOOT_PATH / 'mkbootimg.py'} --kernel {kernel_image_path} "
-        f"--output {bootimg_output_path} "
-        f"--pagesize 4096 "
-        f"--header_version 4 ",
+        ctx,
+        ["make", *make_args, ctx.defconfig],
+        cwd=ctx.kernel_source_dir,
         fatal_on_error=True
     )
 
-    if bootimg_output_path.exists():
-        log_message(f"boot.img created at {bootimg_output_path}")
-    else:
-        sys.exit(1)
-
-def create_flash_zip():
-    """Create a flashable ZIP from the built kernel Image"""
-    image_path = DIST_DIR / "Image"
-    if not image_path.exists():
-        log_message(f"ERROR: Kernel Image not found: {image_path}")
-        sys.exit(1)
-
-    tmp_dir = Path(tempfile.mkdtemp(prefix="anykernel3_"))
-    staging_dir = tmp_dir / "AnyKernel3"
-
-    # Replace anykernel.sh with local version
-    src_path = ROOT_DIR / "src" / "anykernel.sh"
-    target_anykernel_sh = staging_dir / "anykernel.sh"
-    try:
-        shutil.copytree(ANYKERNEL_PATH, staging_dir, dirs_exist_ok=True)
-        shutil.copy(src_path, target_anykernel_sh)
-        shutil.copy(image_path, staging_dir / "Image")
-        log_message(f"Copied Image to temp AnyKernel3 folder: {staging_dir/'Image'}")
-
-        timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M")
-        output_zip = DIST_DIR / f"{TARGET_DEVICE}-{VARIANT}-{timestamp}.zip"
+    # Merge fragments over the defconfig and resolve new dependencies
+    if config_fragments:
+        log_message(f"Merging config fragments: {', '.join(str(x) for x in config_fragments)}")
+        merge_script = ctx.kernel_source_dir / "scripts" / "kconfig" / "merge_config.sh"
         run_cmd(
-            f"cd {staging_dir} && zip -r9 {output_zip} * -x .git/*",
+            ctx,
+            [merge_script, "-m", "-O", ctx.out_dir, config_path, *config_fragments],
+            cwd=ctx.kernel_source_dir,
+            fatal_on_error=True
+        )
+        run_cmd(
+            ctx,
+            ["make", *make_args, "olddefconfig"],
+            cwd=ctx.kernel_source_dir,
             fatal_on_error=True
         )
-        log_message(f"Created flashable ZIP: {output_zip}")
-    except Exception as e:
-        log_message(f"ERROR during flash ZIP creation: {e}")
-        sys.exit(1)
-    finally:
-        shutil.rmtree(tmp_dir, ignore_errors=True)
 
-def read_modules_file(file_path: Path) -> list[str]:
+    fingerprint_path.write_text(json.dumps({
+        "fingerprint": fingerprint,
+        "config_hash": hash_file(config_path),
+    }, indent=2))
+    return True
+
+def get_make_args(ctx: BuildContext) -> list[str]:
     """
-    Reads a list of modules from a text file, one module per line
-    Ignores empty lines and lines starting with '#'
+    Returns the make arguments shared by every kernel make invocation
     """
-    if not file_path.is_file():
-        log_message(f"WARNING: Module list file not found: {file_path}")
-        sys.exit(1)
-
-    modules = []
-    with open(file_path, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith('#'):
-                modules.append(line)
-    return modules
+    make_args = [
+        "LLVM=1", "LLVM_IAS=1", f"ARCH={ctx.arch}", f"O={ctx.out_dir}",
+        f"CROSS_COMPILE={ctx.cross_compile_prefix}",
+    ]
+    if ctx.profile:
+        # KCFLAGS on the command line hides the environment's, so keep it
+        kcflags = [ctx.env.get("KCFLAGS", ""), *get_profile_flags(ctx)]
+        make_args.append(f"KCFLAGS={' '.join(x for x in kcflags if x)}")
+    return make_args
 
-def mk_vendor_rd_dlkm(mount_prefix: str,
-                    module_early_list_file: Path,
-                    module_list_file: Path):
+def get_config_lto_mode(ctx: BuildContext, config_fragments: list[Path]) -> str:
     """
-    Creates vendor_ramdisk_dlkm.cpio.lz4 from a module list and mount prefix
+    Returns the LTO mode the defconfig and fragments select, without
+    generating a .config; later files override earlier ones, as in
+    merge_config.sh, and Kconfig defaults to no LTO
 
     Args:
-        mount_prefix (str): Ramdisk mount point (e.g., "vendor_ramdisk_dlkm")
-        module_early_list_file (Path): Early-loaded kernel module list file
-        module_list_file (Path): Kernel module list file
+        config_fragments (list[Path]): Fragments merged over the defconfig
+
+    Returns:
+        str: "none", "thin" or "full"
     """
-    # Ensure module list files exist
-    missing_files = [
-        module_early_list_file,
-        module_list_file
-    ]
+    defconfig_path = ctx.kernel_source_dir / "arch" / ctx.arch / "configs" / ctx.defconfig
+    selected = {lines[0]: mode for mode, lines in LTO_CONFIG_FRAGMENTS.items()}
+    mode = "none"
+    for path in [defconfig_path, *config_fragments]:
+        if path.is_file():
+            for line in path.read_text().splitlines():
+                mode = selected.get(line.strip(), mode)
+    return mode
+
+def set_profile_link_flags(ctx: BuildContext, lto: str):
+    """
+    Passes a sample profile to the LTO backend of the vmlinux and module links
+
+    Under LTO, code generation runs in ld.lld, which only applies a sample
+    profile given as --lto-sample-profile (PGO profiles are already in the
+    bitcode). The option goes into LDFLAGS_vmlinux and LDFLAGS_MODULE in
+    the environment: Kbuild appends its own flags to those, while the same
+    variables on the make command line would replace them
+
+    Args:
+        lto (str): LTO mode of the build, from get_config_lto_mode()
+    """
+    if not ctx.profile or ctx.profile["kind"] != "sample" or lto == "none":
+        return
+    flag = f"--lto-sample-profile={ctx.profile['path']}"
+    for name in ("LDFLAGS_vmlinux", "LDFLAGS_MODULE"):
+        ctx.env[name] = " ".join(x for x in (ctx.env.get(name, ""), flag) if x)
+
+def write_lto_fragment(ctx: BuildContext, mode: str) -> Path:
+    """
+    Writes the config fragment selecting an LTO mode into OUT_DIR
+
+    Args:
+        mode (str): "none", "thin" or "full"
+
+    Returns:
+        Path: The fragment file
+    """
+    fragment = ctx.out_dir / f"lto_{mode}.config"
+    fragment.parent.mkdir(parents=True, exist_ok=True)
+    content = "\n".join(LTO_CONFIG_FRAGMENTS[mode]) + "\n"
+    # Keep the mtime stable so the config fingerprint only sees real changes
+    if not fragment.is_file() or fragment.read_text() != content:
+        fragment.write_text(content)
+    return fragment
+
+def check_lto_mode(ctx: BuildContext, mode: str):
+    """
+    Verifies that the generated .config ended up in the requested LTO mode
+    Kconfig silently falls back to LTO_NONE when the toolchain lacks support
+    """
+    config = read_kernel_config(ctx)
+    symbol = LTO_CONFIG_FRAGMENTS[mode][0].split("=", 1)[0]
+    if config.get(symbol) != "y":
+        log_message(f"ERROR: --lto {mode} requested but {symbol} is not set in .config "
+                    f"(unsupported by the toolchain or defconfig dependencies)")
+        sys.exit(1)
+
+def link_thinlto_cache(ctx: BuildContext, cache_dir: Path):
+    """
+    Points OUT_DIR/.thinlto-cache, which Kbuild passes to ld.lld as
+    --thinlto-cache-dir, at a persistent directory outside OUT_DIR
+    """
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    link = ctx.out_dir / ".thinlto-cache"
+    if link.is_symlink():
+        if link.resolve() == cache_dir.resolve():
+            return
+        link.unlink()
+    elif link.is_dir():
+        # Keep entries from a cache Kbuild created inside OUT_DIR
+        for entry in link.iterdir():
+            if not (cache_dir / entry.name).exists():
+                shutil.move(str(entry), cache_dir / entry.name)
+        shutil.rmtree(link, ignore_errors=True)
+    link.symlink_to(cache_dir.resolve(), target_is_directory=True)
+    log_message(f"ThinLTO cache: {cache_dir}")
+
+def snapshot_thinlto_cache(cache_dir: Path) -> dict[str, os.stat_result]:
+    """
+    Returns the stat of every ThinLTO cache entry, keyed by file name
+    """
+    if not cache_dir.is_dir():
+        return {}
+    return {x.name: x.stat() for x in cache_dir.iterdir() if x.is_file()}
+
+def prepare_thinlto_cache(cache_dir: Path) -> dict[str, os.stat_result]:
+    """
+    Moves the atime of every ThinLTO cache entry just below its mtime, so
+    that a read by the coming link updates it even under relatime, and
+    returns the snapshot mark_thinlto_cache_hits() compares against
+    """
+    before = snapshot_thinlto_cache(cache_dir)
+    for name, st in before.items():
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(cache_dir / name, ns=(st.st_mtime_ns - 10 ** 9, st.st_mtime_ns))
+    return before
+
+def thinlto_cache_reads_update_atime(cache_dir: Path) -> bool:
+    """
+    Returns whether reading a file in cache_dir updates its atime,
+    which noatime mounts never do
+    """
+    probe = cache_dir / ".atime_probe"
+    try:
+        probe.write_bytes(b"\0")
+        os.utime(probe, (1, 2))
+        probe.read_bytes()
+        return probe.stat().st_atime > 1
+    finally:
+        probe.unlink(missing_ok=True)
+
+def mark_thinlto_cache_hits(cache_dir: Path, before: dict[str, os.stat_result]) -> set[str]:
+    """
+    Finds the entries of a prepare_thinlto_cache() snapshot the link read
+    without rewriting them and sets their mtime to now, the last-use time
+    prune_thinlto_cache() ranks by
+
+    Where reads leave atime alone, every entry that survived the link
+    unchanged counts as a hit
+
+    Returns:
+        set[str]: Names of the entries reused by the link
+    """
+    atime_works = thinlto_cache_reads_update_atime(cache_dir)
+    hits = set()
+    for name, st in before.items():
+        path = cache_dir / name
+        try:
+            current = path.stat()
+            if (current.st_ino, current.st_mtime_ns) != (st.st_ino, st.st_mtime_ns):
+                continue
+            if atime_works and current.st_atime_ns < current.st_mtime_ns:
+                continue
+            os.utime(path)
+        except FileNotFoundError:
+            continue
+        hits.add(name)
+    return hits
+
+def prune_thinlto_cache(cache_dir: Path, max_size: int, max_age_days: int):
+    """
+    Removes ThinLTO cache entries not used for max_age_days, then the least
+    recently used entries until the cache fits in max_size bytes
+    The last use is the mtime, which the link sets when it writes an entry
+    and mark_thinlto_cache_hits() when it reads one
+
+    Args:
+        cache_dir (Path): ThinLTO cache directory
+        max_size (int): Size limit in bytes
+        max_age_days (int): Entries unused for longer are always removed
+    """
+    entries = sorted(
+        ((st.st_mtime, st.st_size, cache_dir / name)
+         for name, st in snapshot_thinlto_cache(cache_dir).items()),
+        key=lambda x: x[0]
+    )
+    cutoff = time.time() - max_age_days * 86400
+    total = sum(x[1] for x in entries)
+    removed = 0
+    for used, size, path in entries:
+        if used >= cutoff and total <= max_size:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
+        removed += 1
+    if removed:
+        log_message(f"Pruned {removed} ThinLTO cache entries "
+                    f"({total / 1024 ** 3:.2f} GB remaining)")
+
+def report_lto_link(ctx: BuildContext,
+                    mode: str,
+                    build_start: float,
+                    cache_dir: Optional[Path] = None,
+                    cache_before: Optional[dict[str, os.stat_result]] = None,
+                    cache_hits: Optional[set[str]] = None):
+    """
+    Logs the vmlinux link time and, in thin mode, how much of the
+    ThinLTO cache was reused
+
+    The link time is taken from Kbuild's artifacts: from the archive of
+    built-in objects to the final vmlinux. Cache reuse comes from
+    mark_thinlto_cache_hits(); entries the link wrote or replaced (a new
+    inode) count as new
+    """
+    vmlinux = ctx.out_dir / "vmlinux"
+    archive = ctx.out_dir / "vmlinux.a"
+    if not archive.is_file():
+        archive = ctx.out_dir / "built-in.a"
+    if vmlinux.is_file() and vmlinux.stat().st_mtime >= build_start:
+        if archive.is_file():
+            link_time = vmlinux.stat().st_mtime - archive.stat().st_mtime
+            log_message(f"LTO ({mode}): vmlinux link took {link_time:.1f}s")
+    else:
+        log_message(f"LTO ({mode}): vmlinux up to date, no link")
+
+    if cache_dir is None or cache_before is None or cache_hits is None:
+        return
+    after = snapshot_thinlto_cache(cache_dir)
+    reused = len(cache_hits)
+    created = sum(1 for name, st in after.items()
+                  if name not in cache_before or st.st_ino != cache_before[name].st_ino)
+    total = created + reused
+    ratio = reused / total * 100 if total else 0.0
+    size = sum(x.st_size for x in after.values())
+    log_message(f"ThinLTO cache: {reused} entries reused, {created} new "
+                f"({ratio:.1f}% reuse), {size / 1024 ** 2:.1f} MB total")
+
+def get_function_key(name: str) -> str:
+    """
+    Reduces a symbol or profile function name to the kernel function name:
+    drops the source file prefix of static functions in instrumented
+    profiles and compiler suffixes such as .llvm.<hash> or .cfi
+    """
+    return name.rsplit(";", 1)[-1].split(".", 1)[0]
+
+def read_profile_functions(ctx: BuildContext, path: Path, kind: str) -> Optional[dict[str, int]]:
+    """
+    Reads the per-function sample or counter totals of a profile
+
+    Args:
+        path (Path): AutoFDO sample profile or indexed PGO profile
+        kind (str): "sample" or "instr"
+
+    Returns:
+        Optional[dict[str, int]]: Total count per function, or None if
+            llvm-profdata cannot read the profile
+    """
+    command = ["llvm-profdata", "merge", "--text", "--output=-", path]
+    if kind == "sample":
+        command.insert(2, "--sample")
+    text = run_cmd(ctx, command, fatal_on_error=False)
+    if text is None:
+        return None
+
+    functions = {}
+    if kind == "sample":
+        # Top-level records are "name:total_samples:head_samples"
+        for line in text.splitlines():
+            match = re.match(r"^(\S.*):(\d+):\d+$", line)
+            if match:
+                key = get_function_key(match.group(1))
+                functions[key] = functions.get(key, 0) + int(match.group(2))
+        return functions
+
+    # Records are a name, its hash, the counter count and the counter values
+    for record in text.split("\n\n"):
+        lines = [x for x in record.splitlines() if x and not x.startswith(("#", ":"))]
+        if len(lines) >= 3 and all(x.isdigit() for x in lines[1:]):
+            key = get_function_key(lines[0])
+            functions[key] = functions.get(key, 0) + sum(int(x) for x in lines[3:])
+    return functions
+
+def load_profile(ctx: BuildContext, path: Path):
+    """
+    Validates an AutoFDO or PGO profile and applies it to the build
+
+    The profile is copied to PROFILE_CACHE_DIR under its hash, so a new
+    profile changes the compiler flags and Kbuild recompiles every object,
+    while the same profile keeps the build incremental
+
+    Args:
+        path (Path): Sample profile (text or binary AutoFDO) or indexed
+            instrumentation profile (.profdata)
+    """
+    if not path.is_file():
+        log_message(f"ERROR: Profile not found: {path}")
+        sys.exit(1)
+    with open(path, "rb") as f:
+        magic = f.read(8)
+    if magic == PROFILE_RAW_MAGIC:
+        log_message(f"ERROR: {path} is a raw profile, convert it with "
+                    f"'llvm-profdata merge -o <file>.profdata' first")
+        sys.exit(1)
+    kind = "instr" if magic == PROFILE_INDEXED_MAGIC else "sample"
+
+    functions = read_profile_functions(ctx, path, kind)
+    if functions is None:
+        log_message(f"ERROR: Invalid {PROFILE_KINDS[kind]} profile: {path}")
+        sys.exit(1)
+    if not any(functions.values()):
+        log_message(f"ERROR: Profile contains no samples: {path}")
+        sys.exit(1)
+
+    sha256 = hash_file(path)
+    cached = PROFILE_CACHE_DIR / f"{sha256}{path.suffix}"
+    if not cached.is_file():
+        PROFILE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path = cached.with_name(f".{cached.name}.{os.getpid()}.tmp")
+        shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, cached)
+
+    ctx.profile = {
+        "source": str(path),
+        "path": cached,
+        "kind": kind,
+        "sha256": sha256,
+        "functions": functions,
+    }
+    log_message(f"Using {PROFILE_KINDS[kind]} profile {path.name} "
+                f"({len(functions)} functions, sha256 {sha256[:16]})")
+
+def get_profile_flags(ctx: BuildContext) -> list[str]:
+    """
+    Returns the compiler flags applying the loaded profile
+    """
+    if not ctx.profile:
+        return []
+    return [x.format(path=ctx.profile["path"]) for x in PROFILE_CFLAGS[ctx.profile["kind"]]]
+
+def read_function_symbols(ctx: BuildContext, paths: list[Path]) -> set[str]:
+    """
+    Returns the names of the functions defined in ELF files
+    """
+    output = run_cmd(ctx, ["llvm-nm", "--defined-only", *paths], fatal_on_error=False) or ""
+    symbols = set()
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 3 and fields[1] in "tTwW":
+            symbols.add(get_function_key(fields[2]))
+    return symbols
+
+def report_profile_coverage(ctx: BuildContext) -> Optional[dict]:
+    """
+    Logs how much of the profile's hot code exists in the built kernel
+
+    Hot functions are the hottest profile functions that together hold
+    PROFILE_HOT_FRACTION of all samples. Hot functions missing from
+    vmlinux and the modules were renamed, removed or inlined since the
+    profile was collected and are not optimized
+
+    Returns:
+        Optional[dict]: Coverage summary, None if vmlinux was not built
+    """
+    vmlinux = ctx.out_dir / "vmlinux"
+    if not vmlinux.is_file():
+        return None
+    symbols = read_function_symbols(
+        ctx, [vmlinux, *sorted(ctx.modules_staging_dir.rglob("*.ko"))])
+
+    functions = sorted(ctx.profile["functions"].items(), key=lambda x: -x[1])
+    total = sum(x[1] for x in functions)
+    hot = []
+    weight = 0
+    for name, count in functions:
+        if weight >= total * PROFILE_HOT_FRACTION:
+            break
+        hot.append((name, count))
+        weight += count
+
+    matched = [(name, count) for name, count in hot if name in symbols]
+    matched_weight = sum(x[1] for x in matched)
+    missing = [name for name, _ in hot if name not in symbols]
+    coverage = {
+        "hot_functions": len(hot),
+        "matched_functions": len(matched),
+        "hot_sample_coverage": round(matched_weight / weight, 4) if weight else 0.0,
+        "missing_hot_functions": missing[:20],
+    }
+    log_message(f"Profile coverage: {len(matched)} of {len(hot)} hot functions found in the "
+                f"kernel, {coverage['hot_sample_coverage']:.1%} of hot samples")
+    if missing:
+        log_message(f"Hot functions not in the kernel (stale profile?): "
+                    f"{', '.join(missing[:10])}{' ...' if len(missing) > 10 else ''}")
+    return coverage
+
+def write_synthetic_profile(ctx: BuildContext, output: Path, count: int):
+    """
+    Writes a text AutoFDO profile for functions of the built vmlinux
+
+    The profile has decreasing sample counts and one function that does
+    not exist in the kernel, so CI can exercise --profile, the profile
+    hash and the coverage report without device-collected samples
+
+    Args:
+        output (Path): Profile file to write
+        count (int): Number of kernel functions in the profile
+    """
+    vmlinux = ctx.out_dir / "vmlinux"
+    if not vmlinux.is_file():
+        log_message(f"ERROR: {vmlinux} not found, build the kernel first")
+        sys.exit(1)
+    check_out_dir_compiled(ctx, "--write-synthetic-profile")
+    symbols = sorted(read_function_symbols(ctx, [vmlinux]),
+                     key=lambda x: hashlib.sha256(x.encode()).digest())
+    if not symbols:
+        log_message(f"ERROR: No function symbols found in {vmlinux}")
+        sys.exit(1)
+
+    lines = []
+    for index, name in enumerate([*symbols[:count], "synthetic_missing_function"]):
+        samples = max(1, 100000 >> min(index, 16))
+        lines += [f"{name}:{samples}:{samples // 10}", f" 1: {samples // 10}"]
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text("\n".join(lines) + "\n")
+    log_message(f"Wrote synthetic profile with {min(count, len(symbols)) + 1} functions to {output}")
+
+def write_build_metadata(ctx: BuildContext, section: str, data: dict):
+    """
+    Records data about the build in DIST_DIR/BUILD_METADATA_FILE
+
+    Args:
+        section (str): Top-level key replaced with data
+        data (dict): JSON-serializable values
+    """
+    metadata_path = ctx.dist_dir / BUILD_METADATA_FILE
+    try:
+        metadata = json.loads(metadata_path.read_text())
+    except (OSError, ValueError):
+        metadata = {}
+    metadata[section] = data
+    metadata_path.write_text(json.dumps(metadata, indent=2, sort_keys=True))
+
+def build_kernel(ctx: BuildContext,
+                 jobs: int,
+                 extra_env: Optional[dict[str, str]] = None,
+                 install_modules: bool = False,
+                 config_fragments: Optional[list[Path]] = None,
+                 build_cache=None,
+                 preflight_lists: Optional[list[Path]] = None,
+                 lto: Optional[str] = None,
+                 thinlto_cache: Optional[tuple[Path, int]] = None,
+                 on_dtbs: Optional[Callable[[], None]] = None
+                 ) -> Optional[str]:
+    """
+    Builds the Android kernel using the given defconfig
+
+    Args:
+        jobs (int): Number of parallel make jobs (-j)
+        extra_env (dict[str, str], optional): Additional environment variables
+            (e.g. BRANCH, KMI_GENERATION) for versioning or build scripts
+        install_modules (bool): Whether to install kernel modules to the staging directory
+        config_fragments (list[Path], optional): Config fragments merged over the defconfig
+        build_cache (LocalCacheBackend | HttpCacheBackend, optional): Artifact
+            cache used to restore Image, dtbs and modules instead of compiling
+        preflight_lists (list[Path], optional): Module list files checked
+            against .config before compiling
+        lto (str, optional): LTO mode applied over the defconfig
+            ("none", "thin", "full"), None keeps the defconfig's choice
+        thinlto_cache (tuple[Path, int], optional): Persistent ThinLTO cache
+            directory and its size limit in bytes, used in thin mode
+        on_dtbs (Callable, optional): Called once the dtbs are built, while
+            Image and modules are still compiling
+
+    Returns:
+        Optional[str]: Not used, present for compatibility
+    """
+    log_message(f"Starting kernel build with {jobs} parallel jobs...")
+
+    ctx.out_dir.mkdir(parents=True, exist_ok=True)
+    ctx.dist_dir.mkdir(parents=True, exist_ok=True)
+    ctx.modules_staging_dir.mkdir(parents=True, exist_ok=True)
+
+    make_args = get_make_args(ctx)
+
+    config_fragments = list(config_fragments or [])
+    if lto:
+        config_fragments.append(write_lto_fragment(ctx, lto))
+
+    generate_kernel_config(ctx, make_args, config_fragments)
+    if lto:
+        check_lto_mode(ctx, lto)
+
+    # Kbuild puts the ThinLTO cache in OUT_DIR, redirect it to survive cleans
+    cache_before = None
+    if lto == "thin" and thinlto_cache:
+        link_thinlto_cache(ctx, thinlto_cache[0])
+        cache_before = prepare_thinlto_cache(thinlto_cache[0])
+
+    # Fail in seconds on listed modules that the .config will not build
+    if preflight_lists:
+        preflight_module_lists(ctx, preflight_lists)
+
+    # Entries always contain installed modules, so only use the cache when
+    # modules are requested
+    profile_coverage = None
+    cache_key = None
+    restored = False
+    if build_cache and install_modules:
+        cache_key = get_build_cache_key(ctx, extra_env)
+        if cache_key:
+            restored = restore_build_cache(ctx, build_cache, cache_key)
+
+    if not restored:
+        # Compile the kernel Image
+        log_message("Compiling kernel Image...")
+        extra_version = extra_env
+        build_start = time.time()
+        # The RAM pressure spill discards the tmpfs OUT_DIR, so only overlap on disk
+        if on_dtbs and ctx.ram_build_root is None:
+            run_kernel_goals(ctx, jobs, extra_version, config_fragments, on_dtbs)
+            on_dtbs = None
+        else:
+            run_kernel_make(ctx, jobs, extra_version, config_fragments)
+        (ctx.out_dir / BUILD_CACHE_RESTORED_FILE).unlink(missing_ok=True)
+        cache_hits = None
+        if cache_before is not None:
+            cache_hits = mark_thinlto_cache_hits(thinlto_cache[0], cache_before)
+        if lto and lto != "none":
+            report_lto_link(ctx, lto, build_start,
+                            thinlto_cache[0] if cache_before is not None else None,
+                            cache_before, cache_hits)
+        if cache_before is not None:
+            prune_thinlto_cache(thinlto_cache[0], thinlto_cache[1],
+                                THINLTO_CACHE_MAX_AGE_DAYS)
+
+        # Install modules to the staging directory
+        if install_modules:
+            install_modules_incremental(ctx, jobs)
+
+        if ctx.profile:
+            profile_coverage = report_profile_coverage(ctx)
+
+        if cache_key:
+            store_build_cache(ctx, build_cache, cache_key)
+
+    if on_dtbs:
+        on_dtbs()
+
+    # Source and destination paths for the final kernel Image
+    image_path = ctx.out_dir / "arch" / ctx.arch / "boot" / "Image"
+    dist_path = ctx.dist_dir / "Image"
+
+    try:
+        shutil.copyfile(image_path, dist_path)
+    except Exception as e:
+        log_message(f"ERROR: Failed to copy kernel Image to DIST_DIR: {e}")
+        sys.exit(1)
+
+    if ctx.profile:
+        write_build_metadata(ctx, "profile", {
+            "source": ctx.profile["source"],
+            "kind": PROFILE_KINDS[ctx.profile["kind"]],
+            "sha256": ctx.profile["sha256"],
+            "coverage": profile_coverage,
+        })
+
+    log_message("Kernel build completed")
+
+class LocalCacheBackend:
+    """
+    Build artifact cache stored as files in a local directory
+    Entries are evicted least recently used first once max_size is exceeded
+    Every entry has its SHA-256 next to it, entries that do not match are misses
+    """
+
+    def __init__(self, root: Path, max_size: int):
+        self.root = root
+        self.max_size = max_size
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def entry_path(self, key: str) -> Path:
+        return self.root / f"{key}.tar.gz"
+
+    def signature_path(self, key: str) -> Path:
+        return self.root / f"{key}.tar.gz.sig"
+
+    def digest_path(self, key: str) -> Path:
+        return self.root / f"{key}.tar.gz.sha256"
+
+    def get(self, key: str, dest: Path) -> bool:
+        entry = self.entry_path(key)
+        if not entry.is_file():
+            return False
+        shutil.copyfile(entry, dest)
+        digest_path = self.digest_path(key)
+        digest = digest_path.read_text().strip() if digest_path.is_file() else None
+        if digest != hash_file(dest):
+            log_message(f"WARNING: Build cache entry {key} does not match its digest, ignoring it")
+            return False
+        # Mark as recently used for LRU eviction
+        os.utime(entry)
+        return True
+
+    def get_signature(self, key: str) -> Optional[str]:
+        path = self.signature_path(key)
+        return path.read_text().strip() if path.is_file() else None
+
+    def put(self, key: str, src: Path):
+        tmp_path = self.root / f".{key}.{os.getpid()}.tmp"
+        shutil.copyfile(src, tmp_path)
+        self.commit(key, tmp_path)
+
+    def commit(self, key: str, tmp_path: Path, signature: Optional[str] = None):
+        """
+        Atomically publishes a fully written temp file as a cache entry,
+        with the signature it was uploaded with
+        """
+        if signature:
+            self.signature_path(key).write_text(signature)
+        else:
+            self.signature_path(key).unlink(missing_ok=True)
+        digest_tmp = tmp_path.with_name(f"{tmp_path.name}.sha256")
+        digest_tmp.write_text(hash_file(tmp_path) + "\n")
+        os.replace(digest_tmp, self.digest_path(key))
+        os.replace(tmp_path, self.entry_path(key))
+        self.evict()
+
+    def evict(self):
+        entries = sorted(self.root.glob("*.tar.gz"), key=lambda x: x.stat().st_mtime)
+        total = sum(x.stat().st_size for x in entries)
+        while entries and total > self.max_size:
+            oldest = entries.pop(0)
+            total -= oldest.stat().st_size
+            log_message(f"Evicting build cache entry: {oldest.name}")
+            oldest.unlink(missing_ok=True)
+            oldest.with_name(f"{oldest.name}.sig").unlink(missing_ok=True)
+            oldest.with_name(f"{oldest.name}.sha256").unlink(missing_ok=True)
+
+def sign_cache_entry(token: str, path: Path) -> str:
+    """
+    Returns the HMAC-SHA256 of a cache entry under the shared token
+    """
+    digest = hmac.new(token.encode(), digestmod=hashlib.sha256)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class HttpCacheBackend:
+    """
+    Build artifact cache on a plain HTTP server supporting GET and PUT,
+    such as the one started with --serve-build-cache
+    Size limits and eviction are enforced by the server
+
+    With a token, requests carry it as a bearer token and entries are
+    signed with it on upload; entries without a valid signature are misses
+    """
+
+    def __init__(self, url: str, token: Optional[str] = None):
+        self.url = url.rstrip("/")
+        self.token = token
+
+    def headers(self) -> dict[str, str]:
+        return {"Authorization": f"Bearer {self.token}"} if self.token else {}
+
+    def get(self, key: str, dest: Path) -> bool:
+        try:
+            request = urllib.request.Request(f"{self.url}/{key}.tar.gz", headers=self.headers())
+            with urllib.request.urlopen(request, timeout=60) as resp:
+                with open(dest, "wb") as f:
+                    shutil.copyfileobj(resp, f)
+                signature = resp.headers.get(BUILD_CACHE_SIGNATURE_HEADER, "")
+            if self.token and not hmac.compare_digest(signature, sign_cache_entry(self.token, dest)):
+                log_message(f"WARNING: Build cache entry {key} has no valid signature, ignoring it")
+                return False
+            return True
+        except urllib.error.HTTPError as e:
+            if e.code != 404:
+                log_message(f"WARNING: Build cache GET failed: {e}")
+        except (urllib.error.URLError, OSError) as e:
+            log_message(f"WARNING: Build cache unreachable: {e}")
+        return False
+
+    def put(self, key: str, src: Path):
+        try:
+            with open(src, "rb") as f:
+                headers = {"Content-Length": str(src.stat().st_size), **self.headers()}
+                if self.token:
+                    headers[BUILD_CACHE_SIGNATURE_HEADER] = sign_cache_entry(self.token, src)
+                request = urllib.request.Request(
+                    f"{self.url}/{key}.tar.gz",
+                    data=f,
+                    method="PUT",
+                    headers=headers
+                )
+                urllib.request.urlopen(request, timeout=300).close()
+        except (urllib.error.URLError, OSError) as e:
+            log_message(f"WARNING: Build cache PUT failed: {e}")
+
+def open_build_cache(location: str, max_size_gb: float):
+    """
+    Returns the cache backend for a location: an http(s):// URL, using the
+    token in BUILD_CACHE_TOKEN_ENV if set, or a local directory
+    """
+    if location.startswith(("http://", "https://")):
+        return HttpCacheBackend(location, os.environ.get(BUILD_CACHE_TOKEN_ENV) or None)
+    return LocalCacheBackend(Path(location).expanduser().resolve(),
+                             int(max_size_gb * 1024 ** 3))
+
+def create_build_cache_server(root: Path, port: int, max_size_gb: float,
+                              bind: str = BUILD_CACHE_DEFAULT_BIND,
+                              token: Optional[str] = None) -> http.server.ThreadingHTTPServer:
+    """
+    Creates the HTTP server (GET/PUT) of a local build cache directory
+    Eviction and size limits of LocalCacheBackend apply to uploaded entries
+
+    Args:
+        port (int): Port to listen on, 0 for any free port
+        bind (str): Address to listen on, loopback unless a token is given
+        token (str, optional): Shared token required from clients; uploads
+            must then be signed with it (see sign_cache_entry())
+    """
+    if not token and not ipaddress.ip_address(bind).is_loopback:
+        log_message(f"ERROR: Serving the build cache on {bind} needs a shared token "
+                    f"in {BUILD_CACHE_TOKEN_ENV}")
+        sys.exit(1)
+    backend = LocalCacheBackend(root.expanduser().resolve(), int(max_size_gb * 1024 ** 3))
+    entry_re = re.compile(r"^/([0-9a-f]{64})\.tar\.gz$")
+
+    class CacheRequestHandler(http.server.BaseHTTPRequestHandler):
+        def authorized(self) -> bool:
+            if token and not hmac.compare_digest(
+                    self.headers.get("Authorization", ""), f"Bearer {token}"):
+                self.send_error(401)
+                return False
+            return True
+
+        def do_GET(self):
+            if not self.authorized():
+                return
+            match = entry_re.match(self.path)
+            entry = backend.entry_path(match.group(1)) if match else None
+            if not entry or not entry.is_file():
+                self.send_error(404)
+                return
+            os.utime(entry)
+            self.send_response(200)
+            self.send_header("Content-Length", str(entry.stat().st_size))
+            signature = backend.get_signature(match.group(1))
+            if signature:
+                self.send_header(BUILD_CACHE_SIGNATURE_HEADER, signature)
+            self.end_headers()
+            with open(entry, "rb") as f:
+                shutil.copyfileobj(f, self.wfile)
+
+        def do_PUT(self):
+            if not self.authorized():
+                return
+            match = entry_re.match(self.path)
+            length = int(self.headers.get("Content-Length", 0))
+            if not match or length <= 0:
+                self.send_error(400)
+                return
+            tmp_path = backend.root / f".{match.group(1)}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                remaining = length
+                while remaining > 0:
+                    chunk = self.rfile.read(min(remaining, 1 << 20))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    remaining -= len(chunk)
+            signature = self.headers.get(BUILD_CACHE_SIGNATURE_HEADER, "")
+            if remaining or (token and not hmac.compare_digest(
+                    signature, sign_cache_entry(token, tmp_path))):
+                tmp_path.unlink(missing_ok=True)
+                self.send_error(400)
+                return
+            backend.commit(match.group(1), tmp_path, signature or None)
+            self.send_response(201)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            log_message(f"build cache: {format % args}")
+
+    return http.server.ThreadingHTTPServer((bind, port), CacheRequestHandler)
+
+def serve_build_cache(root: Path, port: int, max_size_gb: float,
+                      bind: str = BUILD_CACHE_DEFAULT_BIND, token: Optional[str] = None):
+    """
+    Serves a local build cache directory over HTTP until Ctrl-C,
+    see create_build_cache_server()
+    """
+    server = create_build_cache_server(root, port, max_size_gb, bind, token)
+    log_message(f"Serving build cache '{root}' on {bind}:{port}"
+                + (" (token required)" if token else ""))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def get_build_cache_key(ctx: BuildContext, extra_env: Optional[dict[str, str]] = None) -> Optional[str]:
+    """
+    Computes the build cache key from the kernel commit, the .config hash,
+    the toolchain identity and the make arguments
+
+    Returns:
+        Optional[str]: Cache key, or None if the kernel tree has uncommitted
+            changes and cannot be identified by its commit
+    """
+    commit = run_cmd(ctx, ["git", "rev-parse", "HEAD"], cwd=ctx.kernel_source_dir,
+                     fatal_on_error=False)
+    status = run_cmd(ctx, ["git", "status", "--porcelain", "--untracked-files=no"],
+                     cwd=ctx.kernel_source_dir, fatal_on_error=False)
+    if not commit or status is None:
+        log_message("WARNING: Cannot read kernel commit, build cache disabled")
+        return None
+    if status.strip():
+        log_message("Kernel source has uncommitted changes, build cache disabled")
+        return None
+
+    # O= and the profile cache differ between runners, so key on the make
+    # arguments without them and on the profile hash
+    make_args = " ".join(get_make_args(ctx)).replace(str(ctx.out_dir), "$OUT_DIR")
+    if ctx.profile:
+        make_args = make_args.replace(str(ctx.profile["path"]), "$PROFILE")
+
+    digest = hashlib.sha256()
+    for part in [
+        commit.strip(),
+        hash_file(ctx.out_dir / ".config"),
+        get_toolchain_identity(ctx),
+        make_args,
+        json.dumps(extra_env or {}, sort_keys=True),
+        ctx.profile["sha256"] if ctx.profile else "",
+    ]:
+        digest.update(part.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def get_build_cache_files(ctx: BuildContext) -> list[Path]:
+    """
+    Returns the OUT_DIR files stored in a build cache entry: Image, dtbs,
+    module lists, the module signing tool and the signing certificate
+    The installed modules tree is added separately. The private signing
+    key never leaves the machine, see check_restored_signing_key()
+    """
+    boot_dir = ctx.out_dir / "arch" / ctx.arch / "boot"
+    files = [boot_dir / "Image"]
+    files += sorted(
+        x for x in (boot_dir / "dts").rglob("*")
+        if x.suffix in {".dtb", ".dtbo"} and x.is_file()
+    )
+    for rel in ["modules.order", "modules.builtin", "modules.builtin.modinfo",
+                "include/config/kernel.release", "scripts/sign-file",
+                "certs/signing_key.x509"]:
+        if (ctx.out_dir / rel).is_file():
+            files.append(ctx.out_dir / rel)
+    return files
+
+def store_build_cache(ctx: BuildContext, build_cache, key: str):
+    """
+    Packs Image, dtbs and installed modules into a cache entry and uploads it
+    """
+    log_message(f"Storing build artifacts in cache: {key}")
+    tmp_dir = ctx.mkdtemp("build_cache_")
+    archive = tmp_dir / f"{key}.tar.gz"
+    try:
+        with tarfile.open(archive, "w:gz", compresslevel=1) as tar:
+            for path in get_build_cache_files(ctx):
+                tar.add(path, arcname=str(path.relative_to(ctx.out_dir)), recursive=False)
+            tar.add(ctx.modules_staging_dir, arcname=str(ctx.modules_staging_dir.relative_to(ctx.out_dir)))
+        build_cache.put(key, archive)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def check_restored_signing_key(ctx: BuildContext, tar: tarfile.TarFile) -> bool:
+    """
+    Checks that the module signing certificate of a cache entry belongs to
+    the local signing key, so modules signed here load on the cached Image
+
+    Cache entries never contain the private key: runners sharing a cache
+    must have the same key in OUT_DIR/certs/signing_key.pem
+    (e.g. through CONFIG_MODULE_SIG_KEY)
+
+    Returns:
+        bool: True if the entry has no certificate or it matches the local key
+    """
+    try:
+        member = tar.getmember("certs/signing_key.x509")
+    except KeyError:
+        return True
+    key_pem = ctx.out_dir / "certs" / "signing_key.pem"
+    if not key_pem.is_file():
+        log_message("Build cache entry is signed for modules, but there is no local signing key")
+        return False
+
+    cert = ctx.mkdtemp("build_cache_cert_") / "signing_key.x509"
+    try:
+        cert.write_bytes(tar.extractfile(member).read())
+        cert_key = run_cmd(ctx, ["openssl", "x509", "-inform", "DER", "-in", cert,
+                                 "-noout", "-pubkey"], fatal_on_error=False)
+        local_key = run_cmd(ctx, ["openssl", "pkey", "-in", key_pem, "-pubout"],
+                            fatal_on_error=False)
+    finally:
+        shutil.rmtree(cert.parent, ignore_errors=True)
+    if not cert_key or cert_key.strip() != (local_key or "").strip():
+        log_message("Build cache entry was built for another module signing key")
+        return False
+    return True
+
+def is_out_dir_restored(ctx: BuildContext) -> bool:
+    """
+    Returns whether OUT_DIR was restored from the build cache since its
+    last compile
+    """
+    return (ctx.out_dir / BUILD_CACHE_RESTORED_FILE).is_file()
+
+def check_out_dir_compiled(ctx: BuildContext, stage: str):
+    """
+    Exits if OUT_DIR was restored from the build cache, as stages that read
+    vmlinux or the object tree would see an older compile
+
+    Args:
+        stage (str): What needs the compiled tree, for the error message
+    """
+    if is_out_dir_restored(ctx):
+        log_message(f"ERROR: {ctx.out_dir} was restored from the build cache, {stage} "
+                    f"needs a compiled tree; rebuild once without --build-cache")
+        sys.exit(1)
+
+def restore_build_cache(ctx: BuildContext, build_cache, key: str) -> bool:
+    """
+    Restores Image, dtbs, module lists and installed modules from a cache
+    entry, and marks OUT_DIR with BUILD_CACHE_RESTORED_FILE until the next
+    compile (see check_out_dir_compiled())
+
+    Returns:
+        bool: True on a cache hit
+    """
+    tmp_dir = ctx.mkdtemp("build_cache_")
+    archive = tmp_dir / f"{key}.tar.gz"
+    try:
+        if not build_cache.get(key, archive):
+            log_message(f"Build cache miss: {key}")
+            return False
+        with tarfile.open(archive, "r:gz") as tar:
+            if not check_restored_signing_key(ctx, tar):
+                log_message(f"Build cache miss: {key}")
+                return False
+
+        log_message(f"Build cache hit: {key}, restoring artifacts...")
+        shutil.rmtree(ctx.modules_staging_dir, ignore_errors=True)
+        # Restored modules have no built .ko behind them
+        (ctx.out_dir / MODULES_INSTALL_MANIFEST_FILE).unlink(missing_ok=True)
+        with tarfile.open(archive, "r:gz") as tar:
+            if hasattr(tarfile, "data_filter"):
+                tar.extractall(ctx.out_dir, filter="data")
+            else:
+                for member in tar.getmembers():
+                    if member.name.startswith("/") or ".." in Path(member.name).parts:
+                        log_message(f"ERROR: Unsafe path in cache entry: {member.name}")
+                        sys.exit(1)
+                tar.extractall(ctx.out_dir)
+        (ctx.out_dir / BUILD_CACHE_RESTORED_FILE).write_text(key + "\n")
+        return True
+    except (tarfile.TarError, OSError) as e:
+        log_message(f"WARNING: Failed to restore build cache entry: {e}")
+        return False
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def build_dtbo_images(ctx: BuildContext):
+    """
+    Generate dtbo.img and dtb.img from compiled *.dtbo and *.dtb files
+
+    - Uses mkdtimg for dtbo.img with custom flags
+    - Concatenates *.dtb files into dtb.img
+    """
+    arch_dts = ctx.out_dir / "arch" / ctx.arch / "boot" / "dts"
+    dtbo_dir = arch_dts / "samsung" / ctx.target_device
+    dtb_dir = arch_dts / "exynos"
+
+    dtbo_files = sorted(dtbo_dir.glob("*.dtbo"))
+    dtb_files = sorted(dtb_dir.glob("*.dtb"))
+
+    if not dtbo_files:
+        log_message(f"ERROR: No *.dtbo files found in {dtbo_dir}")
+        sys.exit(1)
+    if not dtb_files:
+        log_message(f"ERROR: No *.dtb files found in {dtb_dir}")
+        sys.exit(1)
+
+    ctx.dist_dir.mkdir(parents=True, exist_ok=True)
+
+    dtbo_img_path = ctx.dist_dir / "dtbo.img"
+    dtb_img_path = ctx.dist_dir / "dtb.img"
+
+    # Build dtbo.img
+    custom_flags = [
+        "--custom0=/:dtbo-hw_rev",
+        "--custom1=/:dtbo-hw_rev_end",
+        "--custom2=/:edtbo-rev",
+    ]
+
+    run_cmd(
+        ctx,
+        [ctx.kernelbuild_tools_path / "mkdtimg", "create", dtbo_img_path, *custom_flags,
+         *dtbo_files],
+        fatal_on_error=True
+    )
+
+    # Build dtb.img
+    with open(dtb_img_path, "wb") as out_f:
+        for dtb in dtb_files:
+            out_f.write(dtb.read_bytes())
+
+    log_message("Successfully built dtbo.img and dtb.img")
+
+def compress_kernel_image(ctx: BuildContext, codec: str) -> Path:
+    """
+    Compresses DIST_DIR/Image with the given codec using a multithreaded
+    compressor where one exists
+
+    Args:
+        codec (str): One of KERNEL_IMAGE_CODECS ("gz", "lz4", "zst")
+
+    Returns:
+        Path: Path to the compressed Image variant
+    """
+    src = ctx.dist_dir / "Image"
+    dst = ctx.dist_dir / f"Image.{codec}"
+    threads = os.cpu_count() or 1
+
+    stdout_path = None
+    if codec == "gz":
+        # -n keeps name and timestamp out of the header
+        gzip_tool = ["pigz", "-p", str(threads)] if ctx.which("pigz") else ["gzip"]
+        command = [*gzip_tool, "-n", "-9", "-c", src]
+        stdout_path = dst
+    elif codec == "lz4":
+        # Legacy frame format, as produced by the kernel's own Image.lz4 target
+        command = ["lz4", "-l", "-12", "--favor-decSpeed", "-f", src, dst]
+    elif codec == "zst":
+        command = ["zstd", "-19", f"-T{threads}", "-q", "-f", src, "-o", dst]
+    else:
+        log_message(f"ERROR: Unknown kernel Image codec: {codec}")
+        sys.exit(1)
+
+    run_cmd(ctx, command, fatal_on_error=True, stdout_path=stdout_path)
+    return dst
+
+def build_compressed_images(ctx: BuildContext, codecs: list[str]) -> dict[str, Path]:
+    """
+    Builds compressed variants of DIST_DIR/Image concurrently, then reports
+    size and single-run decompression speed for each
+
+    Args:
+        codecs (list[str]): Codecs to build, e.g. ["gz", "lz4"]
+
+    Returns:
+        dict[str, Path]: Variant file name -> path
+    """
+    image_path = ctx.dist_dir / "Image"
+    if not image_path.is_file():
+        log_message(f"ERROR: Kernel Image not found: {image_path}")
+        sys.exit(1)
+
+    codecs = sorted(set(codecs))
+    log_message(f"Compressing kernel Image: {', '.join(codecs)}...")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(codecs)) as pool:
+        variants = dict(zip(codecs, pool.map(
+            lambda codec: compress_kernel_image(ctx, codec), codecs)))
+
+    # Decompress one at a time so the timings do not compete for CPU
+    raw_size = image_path.stat().st_size
+    decompressors = {"gz": ["gzip", "-dc"], "lz4": ["lz4", "-dc"], "zst": ["zstd", "-dc"]}
+    log_message(f"Image: {raw_size / 1024 ** 2:.2f} MiB")
+    for codec, path in variants.items():
+        start = time.perf_counter()
+        run_cmd(ctx, [*decompressors[codec], path], fatal_on_error=True,
+                stdout_path=Path(os.devnull))
+        elapsed = time.perf_counter() - start
+        size = path.stat().st_size
+        log_message(
+            f"{path.name}: {size / 1024 ** 2:.2f} MiB "
+            f"({size * 100 / raw_size:.1f}% of Image), "
+            f"decompression {raw_size / 1024 ** 2 / elapsed:.0f} MiB/s"
+        )
+
+    return {path.name: path for path in variants.values()}
+
+class ImageWriter:
+    """
+    Writes an image sequentially, appending payload files in the kernel
+    with copy_file_range() or sendfile() instead of through Python buffers
+    """
+
+    def __init__(self, path: Path):
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.offset = 0
+
+    def write(self, data: bytes):
+        view = memoryview(data)
+        while view:
+            written = os.write(self.fd, view)
+            view = view[written:]
+        self.offset += len(data)
+
+    def pad(self, alignment: int):
+        self.write(bytes(-self.offset % alignment))
+
+    def copy(self, src: Path) -> int:
+        """
+        Appends a file
+
+        Returns:
+            int: Number of bytes copied
+        """
+        with open(src, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            copied = 0
+            while copied < size:
+                try:
+                    count = os.copy_file_range(f.fileno(), self.fd, size - copied)
+                except OSError:
+                    # Older kernels refuse some filesystem pairs
+                    count = os.sendfile(self.fd, f.fileno(), None, size - copied)
+                if count == 0:
+                    break
+                copied += count
+        if copied != size:
+            raise OSError(f"{src} changed while being copied")
+        self.offset += copied
+        return copied
+
+    def close(self):
+        os.close(self.fd)
+
+def write_boot_image(output: Path, kernel: Path, cmdline: str = ""):
+    """
+    Writes a boot image with header version 4 and no ramdisk, the layout
+    'mkbootimg.py --header_version 4' produces
+
+    Args:
+        output (Path): boot.img to write
+        kernel (Path): Kernel image
+        cmdline (str): Kernel command line
+    """
+    tmp_path = output.with_name(f".{output.name}.tmp")
+    writer = ImageWriter(tmp_path)
+    try:
+        writer.write(struct.pack(
+            BOOT_IMAGE_V4_HEADER, BOOT_MAGIC, kernel.stat().st_size, 0, 0,
+            struct.calcsize(BOOT_IMAGE_V4_HEADER), 0, 0, 0, 0, 4, cmdline.encode(), 0))
+        writer.pad(BOOT_IMAGE_PAGE_SIZE)
+        writer.copy(kernel)
+        writer.pad(BOOT_IMAGE_PAGE_SIZE)
+    finally:
+        writer.close()
+    os.replace(tmp_path, output)
+
+def write_vendor_boot_image(output: Path,
+                            ramdisks: list[tuple[str, str, Path]],
+                            dtb: Path,
+                            bootconfig: Path,
+                            vendor_cmdline: str = "",
+                            pagesize: int = 2048,
+                            board: str = ""):
+    """
+    Writes a vendor_boot image with header version 4, the layout
+    'mkbootimg.py --header_version 4 --vendor_boot' produces: header,
+    concatenated ramdisk fragments, dtb, ramdisk table and bootconfig,
+    each section padded to the page size
+
+    Args:
+        output (Path): vendor_boot.img to write
+        ramdisks (list[tuple[str, str, Path]]): (name, type, file) per
+            ramdisk fragment, type as in VENDOR_RAMDISK_TYPES
+        dtb (Path): DTB image
+        bootconfig (Path): Vendor bootconfig file
+        vendor_cmdline (str): Vendor kernel command line
+        pagesize (int): Flash page size
+        board (str): Product name
+    """
+    entries = []
+    offset = 0
+    for name, kind, path in ramdisks:
+        size = path.stat().st_size
+        entries.append(struct.pack(VENDOR_RAMDISK_TABLE_ENTRY, size, offset,
+                                   VENDOR_RAMDISK_TYPES[kind], name.encode(), *[0] * 16))
+        offset += size
+
+    base = VENDOR_BOOT_LOAD_BASE
+    tmp_path = output.with_name(f".{output.name}.tmp")
+    writer = ImageWriter(tmp_path)
+    try:
+        writer.write(struct.pack(
+            VENDOR_BOOT_V4_HEADER, VENDOR_BOOT_MAGIC, 4, pagesize,
+            base + VENDOR_BOOT_LOAD_OFFSETS["kernel"], base + VENDOR_BOOT_LOAD_OFFSETS["ramdisk"],
+            offset, vendor_cmdline.encode(), base + VENDOR_BOOT_LOAD_OFFSETS["tags"],
+            board.encode(), struct.calcsize(VENDOR_BOOT_V4_HEADER), dtb.stat().st_size,
+            base + VENDOR_BOOT_LOAD_OFFSETS["dtb"],
+            len(entries) * struct.calcsize(VENDOR_RAMDISK_TABLE_ENTRY), len(entries),
+            struct.calcsize(VENDOR_RAMDISK_TABLE_ENTRY), bootconfig.stat().st_size))
+        writer.pad(pagesize)
+        for _, _, path in ramdisks:
+            writer.copy(path)
+        writer.pad(pagesize)
+        writer.copy(dtb)
+        writer.pad(pagesize)
+        writer.write(b"".join(entries))
+        writer.pad(pagesize)
+        writer.copy(bootconfig)
+        writer.pad(pagesize)
+    finally:
+        writer.close()
+    os.replace(tmp_path, output)
+
+def parse_boot_image(path: Path) -> dict:
+    """
+    Parses the header of a version 4 boot or vendor_boot image
+
+    Returns:
+        dict: "kind" ("boot" or "vendor_boot"), "header" fields, "sections"
+            mapping names ("kernel", "ramdisk:<name>", "dtb", ...) to
+            (offset, size) and "size", the expected file size
+
+    Raises:
+        ValueError: If the image is truncated or not a version 4 image
+    """
+    with open(path, "rb") as f:
+        head = f.read(BOOT_IMAGE_PAGE_SIZE)
+        file_size = os.fstat(f.fileno()).st_size
+
+    def align(x: int, alignment: int) -> int:
+        return x + (-x % alignment)
+
+    sections = {}
+    if head.startswith(BOOT_MAGIC):
+        fields = struct.unpack_from(BOOT_IMAGE_V4_HEADER, head)
+        header = {"kernel_size": fields[1], "ramdisk_size": fields[2],
+                  "os_version": fields[3], "header_size": fields[4],
+                  "header_version": fields[9], "cmdline": fields[10].rstrip(b"\0").decode(),
+                  "signature_size": fields[11]}
+        if header["header_version"] != 4 or header["header_size"] != struct.calcsize(BOOT_IMAGE_V4_HEADER):
+            raise ValueError(f"unsupported boot header version {header['header_version']}")
+        offset = BOOT_IMAGE_PAGE_SIZE
+        for name in ("kernel", "ramdisk", "signature"):
+            size = header[f"{name}_size"]
+            sections[name] = (offset, size)
+            offset = align(offset + size, BOOT_IMAGE_PAGE_SIZE)
+        kind = "boot"
+    elif head.startswith(VENDOR_BOOT_MAGIC):
+        fields = struct.unpack_from(VENDOR_BOOT_V4_HEADER, head)
+        header = dict(zip(
+            ["header_version", "pagesize", "kernel_addr", "ramdisk_addr", "vendor_ramdisk_size",
+             "vendor_cmdline", "tags_addr", "board", "header_size", "dtb_size", "dtb_addr",
+             "ramdisk_table_size", "ramdisk_table_entry_num", "ramdisk_table_entry_size",
+             "bootconfig_size"], fields[1:]))
+        header["vendor_cmdline"] = header["vendor_cmdline"].rstrip(b"\0").decode()
+        header["board"] = header["board"].rstrip(b"\0").decode()
+        if header["header_version"] != 4 or header["header_size"] != struct.calcsize(VENDOR_BOOT_V4_HEADER):
+            raise ValueError(f"unsupported vendor_boot header version {header['header_version']}")
+        if header["ramdisk_table_entry_size"] != struct.calcsize(VENDOR_RAMDISK_TABLE_ENTRY):
+            raise ValueError(f"unexpected ramdisk table entry size "
+                             f"{header['ramdisk_table_entry_size']}")
+        pagesize = header["pagesize"]
+        ramdisk_offset = align(header["header_size"], pagesize)
+        dtb_offset = align(ramdisk_offset + header["vendor_ramdisk_size"], pagesize)
+        table_offset = align(dtb_offset + header["dtb_size"], pagesize)
+        bootconfig_offset = align(table_offset + header["ramdisk_table_size"], pagesize)
+
+        with open(path, "rb") as f:
+            f.seek(table_offset)
+            table = f.read(header["ramdisk_table_size"])
+        if len(table) != header["ramdisk_table_size"]:
+            raise ValueError("truncated ramdisk table")
+        types = {v: k for k, v in VENDOR_RAMDISK_TYPES.items()}
+        expected_offset = 0
+        for index in range(header["ramdisk_table_entry_num"]):
+            size, offset, kind_id, name = struct.unpack_from(
+                VENDOR_RAMDISK_TABLE_ENTRY, table,
+                index * header["ramdisk_table_entry_size"])[:4]
+            name = name.rstrip(b"\0").decode()
+            if kind_id not in types:
+                raise ValueError(f"ramdisk '{name}' has unknown type {kind_id}")
+            if offset != expected_offset or f"ramdisk:{name}" in sections:
+                raise ValueError(f"ramdisk '{name}' overlaps another fragment")
+            sections[f"ramdisk:{name}"] = (ramdisk_offset + offset, size)
+            expected_offset += size
+        if expected_offset != header["vendor_ramdisk_size"]:
+            raise ValueError(f"ramdisk fragments hold {expected_offset} bytes, "
+                             f"header says {header['vendor_ramdisk_size']}")
+        sections["dtb"] = (dtb_offset, header["dtb_size"])
+        sections["ramdisk_table"] = (table_offset, header["ramdisk_table_size"])
+        sections["bootconfig"] = (bootconfig_offset, header["bootconfig_size"])
+        offset = align(bootconfig_offset + header["bootconfig_size"], pagesize)
+        kind = "vendor_boot"
+    else:
+        raise ValueError("not a boot or vendor_boot image")
+
+    if file_size < offset:
+        raise ValueError(f"truncated: {file_size} bytes, header needs {offset}")
+    return {"kind": kind, "header": header, "sections": sections, "size": offset}
+
+def verify_boot_image(path: Path, sources: Optional[dict[str, Path]] = None) -> bool:
+    """
+    Checks a version 4 boot or vendor_boot image without unpacking it:
+    the header, the section layout, zeroed padding and, for each given
+    source, that the section at its offset has the source's hash
+
+    An image signed by avbtool is longer than its sections; the footer
+    area is not checked
+
+    Args:
+        path (Path): Image to check
+        sources (dict[str, Path], optional): Section name (as returned by
+            parse_boot_image(), e.g. "kernel", "ramdisk:dlkm") to the file
+            it was built from
+
+    Returns:
+        bool: True if the image is valid
+    """
+    start = time.perf_counter()
+    try:
+        layout = parse_boot_image(path)
+    except (OSError, ValueError, struct.error) as e:
+        log_message(f"ERROR: {path.name}: {e}")
+        return False
+
+    errors = []
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        view = memoryview(data)
+        try:
+            # Everything between the header and the end of the last section
+            # that is not a section must be zero
+            header_size = layout["header"]["header_size"]
+            covered = sorted((o, o + s) for o, s in layout["sections"].values() if s)
+            position = header_size
+            for begin, end in [*covered, (layout["size"], layout["size"])]:
+                if begin > position and any(view[position:begin]):
+                    errors.append(f"non-zero padding at {position:#x}")
+                position = max(position, end)
+
+            for name, source in (sources or {}).items():
+                if name not in layout["sections"]:
+                    errors.append(f"section {name} missing")
+                    continue
+                offset, size = layout["sections"][name]
+                if size != source.stat().st_size:
+                    errors.append(f"{name} is {size} bytes, {source.name} is {source.stat().st_size}")
+                elif hashlib.sha256(view[offset:offset + size]).hexdigest() != hash_file(source):
+                    errors.append(f"{name} at {offset:#x} differs from {source}")
+        finally:
+            view.release()
+
+    for error in errors:
+        log_message(f"ERROR: {path.name}: {error}")
+    if errors:
+        return False
+    log_message(f"Verified {path.name}: {len(layout['sections'])} sections, "
+                f"{len(sources or {})} checked against sources in "
+                f"{time.perf_counter() - start:.3f}s")
+    return True
+
+def compare_with_mkbootimg(ctx: BuildContext, image: Path, mkbootimg_args: list, output_option: str):
+    """
+    Builds the same image with mkbootimg.py and compares both byte for byte
+
+    Args:
+        image (Path): Image written by the native writer
+        mkbootimg_args (list): mkbootimg.py arguments without the output
+        output_option (str): Output option of this image type
+            ("--output" or "--vendor_boot")
+    """
+    reference_dir = ctx.mkdtemp("mkbootimg_reference_")
+    reference = reference_dir / image.name
+    try:
+        start = time.perf_counter()
+        run_cmd(ctx, [ctx.mkboot_path / "mkbootimg.py", *mkbootimg_args, output_option, reference],
+                fatal_on_error=True)
+        elapsed = time.perf_counter() - start
+        native, expected = image.read_bytes(), reference.read_bytes()
+        if native != expected:
+            mismatch = next((i for i, (a, b) in enumerate(zip(native, expected)) if a != b),
+                            min(len(native), len(expected)))
+            log_message(f"ERROR: {image.name} differs from mkbootimg.py output at offset "
+                        f"{mismatch:#x} ({len(native)} vs {len(expected)} bytes)")
+            sys.exit(1)
+        log_message(f"{image.name} matches mkbootimg.py byte for byte "
+                    f"(mkbootimg.py took {elapsed:.2f}s)")
+    finally:
+        shutil.rmtree(reference_dir, ignore_errors=True)
+
+def build_boot_image(ctx: BuildContext, kernel_image: str = "Image",
+                     compare_mkbootimg: bool = False):
+    """
+    Builds boot.img from kernel image and verifies it
+
+    Args:
+        kernel_image (str): Image variant in DIST_DIR to embed
+            (e.g. "Image", "Image.lz4")
+        compare_mkbootimg (bool): Also build it with mkbootimg.py and
+            require identical output
+    """
+    # Paths to input and output files
+    kernel_image_path = ctx.dist_dir / kernel_image
+    bootimg_output_path = ctx.dist_dir / "boot.img"
+
+    if not kernel_image_path.is_file():
+        log_message(f"ERROR: Kernel image not found: {kernel_image_path}")
+        sys.exit(1)
+
+    write_boot_image(bootimg_output_path, kernel_image_path)
+    if not verify_boot_image(bootimg_output_path, {"kernel": kernel_image_path}):
+        sys.exit(1)
+
+    if compare_mkbootimg:
+        compare_with_mkbootimg(
+            ctx, bootimg_output_path,
+            ["--kernel", kernel_image_path, "--pagesize", "4096", "--header_version", "4"],
+            "--output")
+
+    log_message(f"boot.img created at {bootimg_output_path}")
+
+def get_zip_compression(arcname: str,
+                        overrides: Optional[list[tuple[str, int, int]]] = None
+                        ) -> tuple[int, int]:
+    """
+    Returns the (method, level) used for a flash zip entry
+    The first matching override wins, then FLASH_ZIP_COMPRESSION
+
+    Args:
+        arcname (str): Entry name inside the zip
+        overrides (list[tuple[str, int, int]], optional): (pattern, method, level)
+    """
+    rules = list(overrides or []) + FLASH_ZIP_COMPRESSION
+    for pattern, method, level in rules:
+        if fnmatch.fnmatch(arcname, pattern):
+            return method, level
+    return zipfile.ZIP_DEFLATED, 9
+
+def deflate_chunk(data: bytes, level: int, final: bool) -> bytes:
+    """
+    Raw-deflates one chunk of a large entry. Non-final chunks end with a
+    sync flush so the concatenated chunks form a single deflate stream
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(
+        zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+class ZipWriter:
+    """
+    Minimal zip archive writer for the flash zip, built on the zip format
+    alone instead of zipfile internals, so large deflated entries can be
+    compressed in parallel chunks
+
+    Entries are stored or deflated; archives and entries must stay below
+    4 GiB (no zip64)
+    """
+
+    def __init__(self, path: Path):
+        self.file = open(path, "wb")
+        self.central = []
+
+    def __enter__(self) -> "ZipWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.finish()
+        finally:
+            self.file.close()
+
+    @staticmethod
+    def dos_time(date_time: tuple) -> tuple[int, int]:
+        year, month, day, hour, minute, second = date_time[:6]
+        return (hour << 11 | minute << 5 | second // 2,
+                max(year - 1980, 0) << 9 | month << 5 | day)
+
+    def write(self,
+              info: zipfile.ZipInfo,
+              src: Path,
+              level: int = 9,
+              pool: Optional[concurrent.futures.Executor] = None):
+        """
+        Writes one entry from a file
+
+        Args:
+            info (zipfile.ZipInfo): Name, date_time, external_attr,
+                create_system and compress_type (ZIP_STORED or ZIP_DEFLATED)
+            level (int): Deflate level
+            pool (Executor, optional): Deflates FLASH_ZIP_CHUNK_SIZE chunks
+                in parallel; without it the entry is compressed serially
+        """
+        method = info.compress_type
+        if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise ValueError(f"Unsupported zip compression for {info.filename}: {method}")
+        name = info.filename.encode("utf-8")
+        flags = 0 if name.isascii() else 0x800
+        mod_time, mod_date = self.dos_time(info.date_time)
+        offset = self.file.tell()
+        self.file.write(b"\0" * (ZIP_LOCAL_HEADER.size + len(name)))
+
+        crc = 0
+        file_size = 0
+        compress_size = 0
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        futures = []
+        with open(src, "rb") as f:
+            for data in iter(lambda: f.read(FLASH_ZIP_CHUNK_SIZE), b""):
+                crc = zlib.crc32(data, crc)
+                file_size += len(data)
+                if method == zipfile.ZIP_STORED:
+                    out = data
+                elif pool:
+                    futures.append(pool.submit(deflate_chunk, data, level, False))
+                    continue
+                else:
+                    out = compressor.compress(data)
+                self.file.write(out)
+                compress_size += len(out)
+        if method == zipfile.ZIP_DEFLATED:
+            # Sync-flushed chunks plus an empty final block form one stream
+            tail = [x.result() for x in futures]
+            tail.append(deflate_chunk(b"", level, True) if pool else compressor.flush())
+            for out in tail:
+                self.file.write(out)
+                compress_size += len(out)
+
+        end = self.file.tell()
+        if end > ZIP_MAX_SIZE or file_size > ZIP_MAX_SIZE:
+            raise ValueError(f"{info.filename}: flash zips over 4 GiB are not supported")
+        fields = (20, flags, method, mod_time, mod_date, crc, compress_size, file_size)
+        self.file.seek(offset)
+        self.file.write(ZIP_LOCAL_HEADER.pack(0x04034b50, *fields, len(name), 0) + name)
+        self.file.seek(end)
+        self.central.append(ZIP_CENTRAL_HEADER.pack(
+            0x02014b50, 20, info.create_system, *fields, len(name), 0, 0, 0, 0,
+            info.external_attr, offset) + name)
+
+    def finish(self):
+        """
+        Writes the central directory and its end record
+        """
+        start = self.file.tell()
+        for header in self.central:
+            self.file.write(header)
+        size = self.file.tell() - start
+        if len(self.central) > 0xffff or start + size > ZIP_MAX_SIZE:
+            raise ValueError("flash zips over 4 GiB or 65535 entries are not supported")
+        self.file.write(ZIP_END_RECORD.pack(0x06054b50, 0, 0, len(self.central),
+                                            len(self.central), size, start, 0))
+
+def iter_flash_zip_entries(ctx: BuildContext, image_path: Path) -> list[tuple[str, Path]]:
+    """
+    Lists (arcname, source) pairs for the flash zip: the AnyKernel3 tree
+    with excluded paths pruned while walking, overlaid by the local
+    anykernel.sh and the kernel Image variant
+    """
+    overlays = {
+        "anykernel.sh": ROOT_DIR / "src" / "anykernel.sh",
+        image_path.name: image_path,
+    }
+
+    entries = dict(overlays)
+    for dirpath, dirnames, filenames in os.walk(ctx.anykernel_path):
+        rel_dir = Path(dirpath).relative_to(ctx.anykernel_path)
+        top_level = rel_dir == Path(".")
+        # Hidden top-level entries (.git, .github, ...) are never packaged
+        dirnames[:] = sorted(
+            x for x in dirnames
+            if x not in FLASH_ZIP_EXCLUDES and not (top_level and x.startswith("."))
+        )
+        for name in filenames:
+            if name in FLASH_ZIP_EXCLUDES or (top_level and name.startswith(".")):
+                continue
+            arcname = (rel_dir / name).as_posix()
+            if arcname not in overlays:
+                entries[arcname] = Path(dirpath) / name
+    return sorted(entries.items())
+
+def create_flash_zip(ctx: BuildContext,
+                     compression: Optional[list[tuple[str, int, int]]] = None,
+                     kernel_image: str = "Image"):
+    """
+    Create a flashable ZIP from the built kernel Image
+
+    Entries are streamed from the AnyKernel3 tree, the local anykernel.sh
+    and the Image variant in DIST_DIR without a staging copy. Large
+    deflated entries are compressed in parallel
+
+    Args:
+        compression (list[tuple[str, int, int]], optional): Per-entry
+            (pattern, method, level) overrides, see FLASH_ZIP_COMPRESSION
+        kernel_image (str): Image variant in DIST_DIR to embed
+    """
+    image_path = ctx.dist_dir / kernel_image
+    if not image_path.exists():
+        log_message(f"ERROR: Kernel Image not found: {image_path}")
+        sys.exit(1)
+
+    if ctx.source_date_epoch is None:
+        timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M")
+    else:
+        timestamp = datetime.datetime.fromtimestamp(
+            ctx.source_date_epoch, tz=datetime.timezone.utc).strftime("%Y%m%d-%H%M")
+    output_zip = ctx.dist_dir / f"{ctx.target_device}-{ctx.variant}-{timestamp}.zip"
+    tmp_zip = output_zip.with_suffix(".zip.tmp")
+
+    try:
+        entries = iter_flash_zip_entries(ctx, image_path)
+        with ZipWriter(tmp_zip) as zf, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            for arcname, src in entries:
+                info = zipfile.ZipInfo.from_file(src, arcname)
+                if ctx.source_date_epoch is not None:
+                    # Fixed timestamp and modes, no host-specific metadata
+                    info.date_time = datetime.datetime.fromtimestamp(
+                        max(ctx.source_date_epoch, 315532800),
+                        tz=datetime.timezone.utc).timetuple()[:6]
+                    executable = src.stat().st_mode & stat.S_IXUSR
+                    info.external_attr = ((0o100755 if executable else 0o100644) << 16)
+                    info.create_system = 3
+
+                method, level = get_zip_compression(arcname, compression)
+                info.compress_type = method
+                parallel = src.stat().st_size >= FLASH_ZIP_PARALLEL_THRESHOLD
+                zf.write(info, src, level, pool if parallel else None)
+
+        os.replace(tmp_zip, output_zip)
+        log_message(f"Created flashable ZIP: {output_zip} ({len(entries)} entries)")
+    except Exception as e:
+        log_message(f"ERROR during flash ZIP creation: {e}")
+        sys.exit(1)
+    finally:
+        tmp_zip.unlink(missing_ok=True)
+
+def read_modules_file(file_path: Path) -> list[str]:
+    """
+    Reads a list of modules from a text file, one module per line
+    Ignores empty lines and lines starting with '#'
+    """
+    if not file_path.is_file():
+        log_message(f"WARNING: Module list file not found: {file_path}")
+        sys.exit(1)
+
+    modules = []
+    with open(file_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                modules.append(line)
+    return modules
+
+def get_elf_sections(data) -> list[tuple[str, int, int, int]]:
+    """
+    Lists the sections of a 64-bit ELF file
+
+    Args:
+        data (bytes | mmap.mmap): File contents
+
+    Returns:
+        list[tuple[str, int, int, int]]: (name, offset, size, flags) per section,
+            or an empty list if data is not a 64-bit ELF file
+    """
+    if data[:4] != b"\x7fELF" or data[4] != 2:
+        return []
+    endian = "<" if data[5] == 1 else ">"
+
+    e_shoff = struct.unpack_from(f"{endian}Q", data, 0x28)[0]
+    e_shentsize, e_shnum, e_shstrndx = struct.unpack_from(f"{endian}HHH", data, 0x3A)
+
+    def section(index: int) -> tuple[int, int, int, int]:
+        # (sh_name, sh_flags, sh_offset, sh_size)
+        name, _, flags, _, offset, size = struct.unpack_from(
+            f"{endian}IIQQQQ", data, e_shoff + index * e_shentsize)
+        return name, flags, offset, size
+
+    _, _, strtab_offset, _ = section(e_shstrndx)
+    sections = []
+    for index in range(1, e_shnum):
+        name_offset, flags, offset, size = section(index)
+        name_end = data.find(b"\0", strtab_offset + name_offset)
+        name = data[strtab_offset + name_offset:name_end].decode(errors="replace")
+        sections.append((name, offset, size, flags))
+    return sections
+
+def read_modinfo(module_path: Path) -> dict[str, list[str]]:
+    """
+    Reads the .modinfo section of a 64-bit ELF kernel module
+
+    Returns:
+        dict[str, list[str]]: Values per key (e.g. "depends", "alias")
+    """
+    data = module_path.read_bytes()
+    sections = get_elf_sections(data)
+    if not sections:
+        log_message(f"ERROR: Not a 64-bit ELF module: {module_path}")
+        sys.exit(1)
+
+    modinfo = {}
+    for name, offset, size, _ in sections:
+        if name != ".modinfo":
+            continue
+        for entry in data[offset:offset + size].split(b"\0"):
+            key, sep, value = entry.decode(errors="replace").partition("=")
+            if sep:
+                modinfo.setdefault(key, []).append(value)
+        break
+    return modinfo
+
+def get_module_depends(module_path: Path) -> list[str]:
+    """
+    Returns the module names (KBUILD_MODNAME form) a module depends on
+    """
+    depends = ",".join(read_modinfo(module_path).get("depends", []))
+    return [x for x in depends.split(",") if x]
+
+def module_name_key(name: str) -> str:
+    """
+    Converts a module filename to the name used in 'depends=',
+    e.g. "blk-sec-wb.ko" -> "blk_sec_wb"
+    """
+    return Path(name).name.removesuffix(".ko").replace("-", "_")
+
+def order_modules(modules: list[str],
+                  module_dir: Path,
+                  early_count: int = 0
+                  ) -> tuple[list[str], list[list[str]], list[str]]:
+    """
+    Computes a dependency-respecting load order for packaged modules
+
+    The list order is kept wherever dependencies allow. The first
+    early_count modules (modules.early.load) stay first, together with any
+    dependency they need
+
+    Args:
+        modules (list[str]): Module filenames in list order
+        module_dir (Path): Directory containing the packaged .ko files
+        early_count (int): Number of leading early-load modules
+
+    Returns:
+        tuple: (ordered modules, dependency levels that can load in
+            parallel, ordering violations found in the input order)
+    """
+    by_key = {module_name_key(x): x for x in modules}
+    position = {name: index for index, name in enumerate(modules)}
+    deps = {}
+    violations = []
+    for name in modules:
+        path = module_dir / name
+        deps[name] = []
+        if not path.is_file():
+            continue
+        for dep in get_module_depends(path):
+            if dep not in by_key:
+                violations.append(f"{name} depends on {dep}, which is not packaged")
+                continue
+            dep_name = by_key[dep]
+            deps[name].append(dep_name)
+            if position[dep_name] > position[name]:
+                violations.append(f"{name} is listed before its dependency {dep_name}")
+
+    # Early modules and everything they need go first
+    early = set()
+    pending = list(modules[:early_count])
+    while pending:
+        name = pending.pop()
+        if name in early:
+            continue
+        early.add(name)
+        pending.extend(deps[name])
+    for name in sorted(early - set(modules[:early_count]), key=position.get):
+        violations.append(f"{name} is needed by an early module but not in modules.early.load")
+
+    def topo(group: list[str], placed: set[str]) -> list[str]:
+        # Kahn's algorithm, always taking the earliest listed ready module
+        remaining = {x: [d for d in deps[x] if d not in placed] for x in group}
+        result = []
+        while remaining:
+            ready = [x for x, d in remaining.items() if not d]
+            if not ready:
+                cycle = sorted(remaining, key=position.get)
+                log_message(f"ERROR: Module dependency cycle among: {', '.join(cycle)}")
+                sys.exit(1)
+            chosen = min(ready, key=position.get)
+            result.append(chosen)
+            del remaining[chosen]
+            for pending_deps in remaining.values():
+                if chosen in pending_deps:
+                    pending_deps.remove(chosen)
+        return result
+
+    early_order = topo([x for x in modules if x in early], set())
+    ordered = early_order + topo([x for x in modules if x not in early], set(early_order))
+
+    level = {}
+    for name in ordered:
+        level[name] = 1 + max((level[d] for d in deps[name]), default=-1)
+    levels = [[] for _ in range(max(level.values(), default=-1) + 1)]
+    for name in ordered:
+        levels[level[name]].append(name)
+
+    return ordered, levels, violations
+
+def optimize_load_order(ctx: BuildContext,
+                        image_name: str,
+                        modules: list[str],
+                        module_dir: Path,
+                        early_count: int = 0,
+                        optimize: bool = False) -> list[str]:
+    """
+    Reports load-order violations for an image's module list and, when
+    optimize is set, returns the dependency-ordered list and writes the
+    parallel load levels to DIST_DIR/<image>.modules.load.levels
+
+    Returns:
+        list[str]: Module order to write to modules.load/modules.order
+    """
+    ordered, levels, violations = order_modules(modules, module_dir, early_count)
+    for violation in violations:
+        log_message(f"WARNING: {image_name}: {violation}")
+    log_message(f"{image_name}: {len(violations)} load order violation(s), "
+                f"{len(levels)} dependency level(s)")
+
+    if not optimize:
+        return modules
+
+    levels_file = ctx.dist_dir / f"{image_name}.modules.load.levels"
+    levels_file.write_text("".join(" ".join(x) + "\n" for x in levels))
+    log_message(f"Using dependency-ordered module list, levels in {levels_file}")
+    return ordered
+
+def get_compression_settings(ctx: BuildContext, image_name: str) -> dict:
+    """
+    Returns the compression settings for a module image from
+    COMPRESSION_PROFILE_FILE, falling back to DEFAULT_COMPRESSION_SETTINGS
+    """
+    settings = dict(DEFAULT_COMPRESSION_SETTINGS[image_name])
+    if ctx.compression_profile_file.is_file():
+        try:
+            profile = json.loads(ctx.compression_profile_file.read_text())
+        except (OSError, ValueError) as e:
+            log_message(f"ERROR: Invalid compression profile {ctx.compression_profile_file}: {e}")
+            sys.exit(1)
+        settings.update(profile.get(image_name, {}).get("settings", {}))
+    return settings
+
+def get_lz4_args(settings: dict) -> list[str]:
+    """
+    Returns lz4 compression arguments for vendor_ramdisk_dlkm settings
+    """
+    args = [f"-{settings['level']}"]
+    if settings.get("favor_dec_speed"):
+        args.append("--favor-decSpeed")
+    return args
+
+def get_erofs_args(settings: dict) -> list[str]:
+    """
+    Returns mkfs.erofs compression arguments for DLKM image settings
+    """
+    args = ["-z", settings["compressor"]]
+    if settings.get("cluster_size"):
+        args += ["-C", str(settings["cluster_size"])]
+    for option in settings.get("extended", []):
+        args += ["-E", option]
+    return args
+
+def time_command(ctx: BuildContext,
+                 command: list[str],
+                 repeat: int = 3,
+                 before: Optional[Callable[[], None]] = None) -> Optional[float]:
+    """
+    Returns the best wall time of a command over several runs,
+    or None if it fails. Output is discarded; before() runs untimed
+    ahead of every run
+    """
+    best = None
+    for _ in range(repeat):
+        if before:
+            before()
+        start = time.perf_counter()
+        if run_cmd(ctx, command, fatal_on_error=False, stdout_path=Path(os.devnull)) is None:
+            return None
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def select_compression(results: list[dict]) -> dict:
+    """
+    Picks the smallest result whose decompression throughput is within
+    BENCH_MIN_THROUGHPUT_RATIO of the fastest; by size alone when no
+    throughput could be measured
+    """
+    measured = [x for x in results if x["throughput_mib_s"]]
+    if not measured:
+        return min(results, key=lambda x: x["size"])
+    fastest = max(x["throughput_mib_s"] for x in measured)
+    eligible = [
+        x for x in measured
+        if x["throughput_mib_s"] >= fastest * BENCH_MIN_THROUGHPUT_RATIO
+    ]
+    return min(eligible, key=lambda x: x["size"])
+
+def benchmark_ramdisk_compression(ctx: BuildContext) -> dict:
+    """
+    Recompresses the built vendor_ramdisk_dlkm cpio across lz4 levels and
+    measures size and userspace decompression throughput
+    """
+    source = ctx.dist_dir / "vendor_ramdisk_dlkm.cpio.lz4"
+    if not source.is_file():
+        log_message(f"ERROR: {source} not found, build vendor_ramdisk_dlkm first")
+        sys.exit(1)
+
+    tmp_dir = ctx.mkdtemp("ramdisk_bench_")
+    try:
+        cpio = tmp_dir / "vendor_ramdisk_dlkm.cpio"
+        run_cmd(ctx, ["lz4", "-dc", source], fatal_on_error=True, stdout_path=cpio)
+        raw_size = cpio.stat().st_size
+
+        results = []
+        for level in BENCH_LZ4_LEVELS:
+            for favor_dec_speed in ([False, True] if level >= 10 else [False]):
+                settings = {"level": level, "favor_dec_speed": favor_dec_speed}
+                output = tmp_dir / "candidate.cpio.lz4"
+                run_cmd(ctx, ["lz4", *get_lz4_args(settings), "-f", "-l", cpio, output],
+                        fatal_on_error=True)
+                elapsed = time_command(ctx, ["lz4", "-dc", output])
+                results.append({
+                    "settings": settings,
+                    "size": output.stat().st_size,
+                    "throughput_mib_s": round(raw_size / 1024 ** 2 / elapsed, 1) if elapsed else None,
+                })
+                log_message(f"vendor_ramdisk_dlkm {shlex.join(get_lz4_args(settings))}: "
+                            f"{results[-1]['size']} bytes, {results[-1]['throughput_mib_s']} MiB/s")
+        return {"raw_size": raw_size, "results": results}
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def benchmark_erofs_compression(ctx: BuildContext,
+                                image_name: str,
+                                staging_dir: Path,
+                                mkfs_command: Callable[[list[str], Path], list[str]]
+                                ) -> dict:
+    """
+    Builds an EROFS image from a staging tree for every combination of
+    compressor, cluster size and extended option, and measures size and
+    userspace extraction throughput with fsck.erofs when available
+    """
+    fsck = ctx.kernelbuild_tools_path / "fsck.erofs"
+    raw_size = sum(x.stat().st_size for x in staging_dir.rglob("*") if x.is_file())
+
+    tmp_dir = ctx.mkdtemp(f"{image_name}_bench_")
+    try:
+        results = []
+        for compressor in BENCH_EROFS_COMPRESSORS:
+            for cluster_size in BENCH_EROFS_CLUSTER_SIZES:
+                for extended in BENCH_EROFS_EXTENDED:
+                    settings = {
+                        "compressor": compressor,
+                        "cluster_size": cluster_size,
+                        "extended": extended,
+                    }
+                    output = tmp_dir / "candidate.img"
+                    output.unlink(missing_ok=True)
+                    command = mkfs_command(get_erofs_args(settings), output)
+                    if run_cmd(ctx, command, fatal_on_error=False) is None:
+                        log_message(f"{image_name} {shlex.join(get_erofs_args(settings))}: "
+                                    f"unsupported, skipped")
+                        continue
+
+                    elapsed = None
+                    if fsck.is_file():
+                        extract_dir = tmp_dir / "extract"
+                        elapsed = time_command(
+                            ctx,
+                            [fsck, f"--extract={extract_dir}", output],
+                            before=lambda: shutil.rmtree(extract_dir, ignore_errors=True))
+                    results.append({
+                        "settings": settings,
+                        "size": output.stat().st_size,
+                        "throughput_mib_s": round(raw_size / 1024 ** 2 / elapsed, 1) if elapsed else None,
+                    })
+                    log_message(f"{image_name} {shlex.join(get_erofs_args(settings))}: "
+                                f"{results[-1]['size']} bytes, {results[-1]['throughput_mib_s']} MiB/s")
+        if not results:
+            log_message(f"ERROR: No mkfs.erofs configuration succeeded for {image_name}")
+            sys.exit(1)
+        return {"raw_size": raw_size, "results": results}
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def benchmark_compression(ctx: BuildContext):
+    """
+    Benchmarks compression for vendor_ramdisk_dlkm, system_dlkm and
+    vendor_dlkm and writes the selected settings to COMPRESSION_PROFILE_FILE
+    Requires installed modules and a built vendor_ramdisk_dlkm
+    """
+    log_message("Benchmarking module image compression...")
+    benchmarks = {"vendor_ramdisk_dlkm": benchmark_ramdisk_compression(ctx)}
+
+    def collect(image_name: str) -> Callable[[Path, Callable], None]:
+        def callback(staging_dir: Path,
+                     mkfs_command: Callable[[list[str], Path], list[str]]):
+            benchmarks[image_name] = benchmark_erofs_compression(
+                ctx,
+                image_name, staging_dir, mkfs_command)
+        return callback
+
+    # The trial images go to a scratch dir, DIST_DIR keeps the real ones
+    dist_dir = ctx.dist_dir
+    ctx.dist_dir = ctx.mkdtemp("compression_bench_")
+    try:
+        build_dlkm_image(
+            ctx,
+            image_name="system_dlkm",
+            modules_list_file=None,
+            mount_prefix="/system_dlkm",
+            sign_modules=True,
+            staging_callback=collect("system_dlkm"),
+        )
+        build_dlkm_image(
+            ctx,
+            image_name="vendor_dlkm",
+            modules_list_file=VENDOR_DLKM_MODULES_FILE,
+            mount_prefix="/vendor_dlkm",
+            sign_modules=False,
+            staging_callback=collect("vendor_dlkm"),
+        )
+    finally:
+        shutil.rmtree(ctx.dist_dir, ignore_errors=True)
+        ctx.dist_dir = dist_dir
+
+    profile = {}
+    for image_name, benchmark in benchmarks.items():
+        chosen = select_compression(benchmark["results"])
+        profile[image_name] = {"settings": chosen["settings"], "benchmark": benchmark}
+        log_message(f"Selected for {image_name}: {chosen['settings']} "
+                    f"({chosen['size']} bytes, {chosen['throughput_mib_s']} MiB/s)")
+
+    ctx.compression_profile_file.parent.mkdir(parents=True, exist_ok=True)
+    ctx.compression_profile_file.write_text(json.dumps(profile, indent=2) + "\n")
+    log_message(f"Compression profile written to {ctx.compression_profile_file}")
+
+def mk_vendor_rd_dlkm(ctx: BuildContext,
+                      mount_prefix: str,
+                      module_early_list_file: Path,
+                      module_list_file: Path,
+                      optimize_order: bool = False,
+                      module_graph: Optional["ModuleGraph"] = None):
+    """
+    Creates vendor_ramdisk_dlkm.cpio.lz4 from a module list and mount prefix
+
+    Args:
+        mount_prefix (str): Ramdisk mount point (e.g., "vendor_ramdisk_dlkm")
+        module_early_list_file (Path): Early-loaded kernel module list file
+        module_list_file (Path): Kernel module list file
+        optimize_order (bool): Write modules.load in dependency order
+        module_graph (ModuleGraph, optional): Graph providing modules.dep,
+            computed from MODULES_STAGING_DIR if not given
+    """
+    # Ensure module list files exist
+    missing_files = [
+        module_early_list_file,
+        module_list_file
+    ]
 
     if not all(file.is_file() for file in missing_files):
         log_message(f"ERROR: One or more module list files are missing: {missing_files}")
@@ -405,9 +3372,9 @@ def mk_vendor_rd_dlkm(mount_prefix: str,
     early_modules = read_modules_file(module_early_list_file)
     normal_modules = read_modules_file(module_list_file)
 
-    dist_dir = Path(DIST_DIR)
-    base_modules_dir = Path(MODULES_STAGING_DIR) / "lib" / "modules"
-    tools_path = Path(KERNELBUILD_TOOLS_PATH)
+    dist_dir = Path(ctx.dist_dir)
+    base_modules_dir = Path(ctx.modules_staging_dir) / "lib" / "modules"
+    tools_path = Path(ctx.kernelbuild_tools_path)
 
     final_output_path = dist_dir / "vendor_ramdisk_dlkm.cpio.lz4"
     final_output_path.parent.mkdir(parents=True, exist_ok=True)
@@ -419,7 +3386,7 @@ def mk_vendor_rd_dlkm(mount_prefix: str,
     kernel_version = kernel_dirs[0].name
     log_message(f"Kernel version: {kernel_version}")
 
-    staging_dir = Path(tempfile.mkdtemp(prefix="vendor_ramdisk_dlkm_staging_"))
+    staging_dir = ctx.mkdtemp("vendor_ramdisk_dlkm_staging_")
     flat_dir = staging_dir / "lib" / "modules" / kernel_version
     flat_dir.mkdir(parents=True, exist_ok=True)
 
@@ -465,7 +3432,7 @@ def mk_vendor_rd_dlkm(mount_prefix: str,
         log_message("ERROR: One or more required tools are missing after path assignment")
         sys.exit(1)
 
-    run_cmd(f"{depmod} -b {staging_dir} {kernel_version}", fatal_on_error=True)
+    run_cmd(ctx, [depmod, "-b", staging_dir, kernel_version], fatal_on_error=True)
 
     # Flatten: move contents from lib/modules/<version>/ to lib/modules/
     flat_mod_root = staging_dir / "lib" / "modules"
@@ -473,23 +3440,10 @@ def mk_vendor_rd_dlkm(mount_prefix: str,
         shutil.move(str(item), flat_mod_root / item.name)
     shutil.rmtree(flat_dir)
 
-    dep_file = flat_mod_root / "modules.dep"
-    if dep_file.exists():
-        new_lines = []
-        with open(dep_file, "r") as f:
-            for line in f:
-                parts = line.strip().split(":", 1)
-                main = f"{mount_prefix}/lib/modules/{parts[0].strip()}"
-                deps = ""
-                if len(parts) == 2:
-                    deps = " ".join(f"{mount_prefix}/lib/modules/{d.strip()}"
-                            for d in parts[1].split())
-                new_lines.append(f"{main}: {deps}".rstrip())
-        with open(dep_file, "w") as f:
-            f.write("\n".join(new_lines))
-    else:
-        log_message("ERROR: modules.dep not found")
-        sys.exit(1)
+    # modules.dep comes from the system-wide graph, so dependencies on
+    # modules in other partitions resolve to their mount paths
+    module_graph = module_graph or ModuleGraph.from_staging(ctx)
+    (flat_mod_root / "modules.dep").write_text(module_graph.modules_dep("vendor_ramdisk_dlkm"))
 
     # Copy modules.builtin files
     for name in ["modules.builtin",  "modules.builtin.modinfo",
@@ -501,6 +3455,12 @@ def mk_vendor_rd_dlkm(mount_prefix: str,
         else:
             log_message(f"WARNING: {name} not found in {src.parent}")
 
+    vendor_modules = optimize_load_order(
+        ctx,
+        "vendor_ramdisk_dlkm", vendor_modules, flat_mod_root,
+        early_count=len(early_modules), optimize=optimize_order
+    )
+
     # Create modules.load and modules.order files
     for filename in ["modules.load", "modules.order"]:
         output_file_path = flat_mod_root / filename
@@ -509,12 +3469,15 @@ def mk_vendor_rd_dlkm(mount_prefix: str,
                 if name.endswith(".ko"):
                     f.write(name + "\n")
 
+    normalize_tree(ctx, staging_dir)
+
     try:
-        with open(output_cpio_path, 'wb') as out:
-            subprocess.run([str(mkbootfs), str(staging_dir)], stdout=out, check=True)
+        run_cmd(ctx, [mkbootfs, staging_dir], fatal_on_error=True, stdout_path=output_cpio_path)
 
         run_cmd(
-            f"{lz4} -9 -f -l {output_cpio_path} {final_output_path}",
+            ctx,
+            [lz4, *get_lz4_args(get_compression_settings(ctx, "vendor_ramdisk_dlkm")),
+             "-f", "-l", output_cpio_path, final_output_path],
             fatal_on_error=True
         )
 
@@ -526,7 +3489,7 @@ def mk_vendor_rd_dlkm(mount_prefix: str,
         shutil.rmtree(staging_dir, ignore_errors=True)
         output_cpio_path.unlink(missing_ok=True)
 
-def get_system_dlkm_list() -> list[str]:
+def get_system_dlkm_list(ctx: BuildContext) -> list[str]:
     """
     Extracts .ko filenames from modules.bzl under
     _COMMON_GKI_MODULES_LIST and _ARM64_GKI_MODULES_LIST
@@ -534,7 +3497,7 @@ def get_system_dlkm_list() -> list[str]:
     Returns:
         list[str]: Sorted unique list of .ko filenames
     """
-    bzl_path = KERNEL_SOURCE_DIR / "modules.bzl"
+    bzl_path = ctx.kernel_source_dir / "modules.bzl"
     markers = ["_COMMON_GKI_MODULES_LIST", "_ARM64_GKI_MODULES_LIST"]
     system_dlkm_mod_list = set()
 
@@ -559,10 +3522,14 @@ def get_system_dlkm_list() -> list[str]:
 
     return sorted(system_dlkm_mod_list)
 
-def build_dlkm_image(image_name: str,
-                    modules_list_file: Optional[Path],
-                    mount_prefix: str,
-                    sign_modules: bool = False):
+def build_dlkm_image(ctx: BuildContext,
+                     image_name: str,
+                     modules_list_file: Optional[Path],
+                     mount_prefix: str,
+                     sign_modules: bool = False,
+                     optimize_order: bool = False,
+                     staging_callback: Optional[Callable[[Path, Callable], None]] = None,
+                     module_graph: Optional["ModuleGraph"] = None):
     """
     Build a DLKM image in EROFS format using mkfs.erofs
 
@@ -570,10 +3537,16 @@ def build_dlkm_image(image_name: str,
         image_name (str): Output image name (e.g., "system_dlkm")
         modules_list_file (Path): List of kernel module filenames to include
         mount_prefix (str): Mount point inside the image (e.g., "/system_dlkm")
+        optimize_order (bool): Write modules.load in dependency order
+        staging_callback (Callable, optional): Called with the staging dir and
+            a function building the mkfs.erofs argv from compression
+            arguments and an output path, after the image is built
+        module_graph (ModuleGraph, optional): Graph providing modules.dep,
+            computed from MODULES_STAGING_DIR if not given
     """
     if image_name == "system_dlkm":
         log_message("Reading system_dlkm modules from modules.bzl...")
-        modules = get_system_dlkm_list()
+        modules = get_system_dlkm_list(ctx)
     else:
         modules = read_modules_file(modules_list_file)
 
@@ -581,14 +3554,14 @@ def build_dlkm_image(image_name: str,
         log_message(f"ERROR: No modules found for {image_name}")
         sys.exit(1)
 
-    dist_dir = Path(DIST_DIR)
-    base_modules_dir = Path(MODULES_STAGING_DIR) / "lib" / "modules"
-    tools_path = Path(KERNELBUILD_TOOLS_PATH)
+    dist_dir = Path(ctx.dist_dir)
+    base_modules_dir = Path(ctx.modules_staging_dir) / "lib" / "modules"
+    tools_path = Path(ctx.kernelbuild_tools_path)
 
     # keys
-    sign_tool = OUT_DIR / "scripts" / "sign-file"
-    key_pem = OUT_DIR / "certs" / "signing_key.pem"
-    key_x509 = OUT_DIR / "certs" / "signing_key.x509"
+    sign_tool = ctx.out_dir / "scripts" / "sign-file"
+    key_pem = ctx.out_dir / "certs" / "signing_key.pem"
+    key_x509 = ctx.out_dir / "certs" / "signing_key.x509"
 
     final_img = dist_dir / f"{image_name}.img"
     final_img.parent.mkdir(parents=True, exist_ok=True)
@@ -600,7 +3573,7 @@ def build_dlkm_image(image_name: str,
     kernel_version = kernel_dirs[0].name
     log_message(f"Kernel version: {kernel_version}")
 
-    staging_dir = Path(tempfile.mkdtemp(prefix=f"{image_name}_staging_"))
+    staging_dir = ctx.mkdtemp(f"{image_name}_staging_")
     try:
         flat_dir = staging_dir / "lib" / "modules" / kernel_version
         flat_dir.mkdir(parents=True, exist_ok=True)
@@ -627,13 +3600,12 @@ def build_dlkm_image(image_name: str,
                         log_message("ERROR: Missing signing tool or keys")
                         sys.exit(1)
 
-                    result = subprocess.run([
-                        str(sign_tool), "sha1",
-                        str(key_pem),
-                        str(key_x509),
-                        str(dst)
-                    ])
-                    if result.returncode != 0:
+                    result = run_cmd(
+                        ctx,
+                        [sign_tool, "sha1", key_pem, key_x509, dst],
+                        fatal_on_error=False
+                    )
+                    if result is None:
                         log_message(f"ERROR: Failed to sign {name}")
                         sys.exit(1)
 
@@ -662,7 +3634,7 @@ def build_dlkm_image(image_name: str,
             log_message("ERROR: One or more required tools are missing after path assignment")
             sys.exit(1)
 
-        run_cmd(f"{depmod} -b {staging_dir} {kernel_version}", fatal_on_error=True)
+        run_cmd(ctx, [depmod, "-b", staging_dir, kernel_version], fatal_on_error=True)
 
         # Flatten: move contents from lib/modules/<version>/ to lib/modules/
         flat_mod_root = staging_dir / "lib" / "modules"
@@ -670,23 +3642,10 @@ def build_dlkm_image(image_name: str,
             shutil.move(str(item), flat_mod_root / item.name)
         shutil.rmtree(flat_dir)
 
-        dep_file = flat_mod_root / "modules.dep"
-        if dep_file.exists():
-            new_lines = []
-            with open(dep_file, "r") as f:
-                for line in f:
-                    parts = line.strip().split(":", 1)
-                    main = f"{mount_prefix}/lib/modules/{parts[0].strip()}"
-                    deps = ""
-                    if len(parts) == 2:
-                        deps = " ".join(f"{mount_prefix}/lib/modules/{d.strip()}"
-                                    for d in parts[1].split())
-                    new_lines.append(f"{main}: {deps}".rstrip())
-            with open(dep_file, "w") as f:
-                f.write("\n".join(new_lines))
-        else:
-            log_message("ERROR: modules.dep not found")
-            sys.exit(1)
+        # modules.dep comes from the system-wide graph, so dependencies on
+        # modules in other partitions resolve to their mount paths
+        module_graph = module_graph or ModuleGraph.from_staging(ctx)
+        (flat_mod_root / "modules.dep").write_text(module_graph.modules_dep(image_name))
 
         # Copy modules.builtin files
         for name in ["modules.builtin", "modules.builtin.modinfo",
@@ -698,6 +3657,11 @@ def build_dlkm_image(image_name: str,
             else:
                 log_message(f"WARNING: {name} not found in {src.parent}")
 
+        modules = optimize_load_order(
+            ctx,
+            image_name, modules, flat_mod_root, optimize=optimize_order
+        )
+
         # Create modules.load and modules.order
         for filename in ["modules.load", "modules.order"]:
             output_file_path = flat_mod_root / filename
@@ -713,101 +3677,950 @@ def build_dlkm_image(image_name: str,
         elif image_name == "vendor_dlkm":
             fc_file = fc_dir / "vendor_dlkm_file_contexts"
 
-        # Create the EROFS image
-        run_cmd(
-            f"{mkfs} "
-            f"-z lz4hc,9 "
-            f"-T 0 "
-            f"--mount-point {mount_prefix.strip('/')} "
-            f"--file-contexts {str(fc_file)} "
-            f"{str(final_img)} "
-            f"{str(staging_dir)}",
-            fatal_on_error=True
-        )
+        # Pin timestamps, ownership and filesystem UUID in reproducible mode
+        reproducible_args = []
+        if ctx.source_date_epoch is not None:
+            normalize_tree(ctx, staging_dir)
+            fs_uuid = uuid.uuid5(uuid.NAMESPACE_URL, f"{image_name}:{ctx.source_date_epoch}")
+            reproducible_args = ["-U", str(fs_uuid), "--all-root"]
+
+        def mkfs_command(erofs_args: list[str], output: Path) -> list[str]:
+            return [
+                mkfs, *erofs_args,
+                "-T", "0",
+                *reproducible_args,
+                "--mount-point", mount_prefix.strip("/"),
+                "--file-contexts", fc_file,
+                output,
+                staging_dir,
+            ]
+
+        # Create the EROFS image
+        run_cmd(
+            ctx,
+            mkfs_command(get_erofs_args(get_compression_settings(ctx, image_name)), final_img),
+            fatal_on_error=True
+        )
+
+        # Let callers (e.g. the compression benchmark) reuse the staging tree
+        if staging_callback:
+            staging_callback(staging_dir, mkfs_command)
+
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+def build_vendorboot_image(ctx: BuildContext, compare_mkbootimg: bool = False):
+    """
+    Assemble vendor_boot.img (header version 4) and verify it.
+
+    Combines multiple vendor ramdisk fragments (platform, dlkm, recovery),
+    a DTB image, and embeds a basic vendor bootconfig file
+
+    Args:
+        compare_mkbootimg (bool): Also build it with mkbootimg.py and
+            require identical output
+
+    Requires:
+        - DTB image generated with --create-dtbo-images
+        - Vendor ramdisk fragments generated with --build-vendor-ramdisk-dlkm
+    """
+    image_name = "vendor_boot"
+    final_img = ctx.dist_dir / f"{image_name}.img"
+    parts_dir = ROOT_DIR / "vb_fragments"
+
+    vendor_ramdisk_dlkm = ctx.dist_dir / "vendor_ramdisk_dlkm.cpio.lz4"
+    dtb_path = ctx.dist_dir / "dtb.img"
+    vendor_ramdisk_platform = parts_dir / "vendor_ramdisk_platform.lz4"
+    vendor_ramdisk_recovery = parts_dir / "vendor_ramdisk_recovery.lz4"
+
+    # Create staging directory
+    staging_dir = ctx.mkdtemp(f"{image_name}_staging_")
+    staging_dir.mkdir(parents=True, exist_ok=True)
+
+    try:
+        # Create bootconfig
+        bootconfig_file = staging_dir / "vendor_bootconfig.txt"
+        bootconfig_file.write_text(
+            "buildtime_bootconfig=enable\n"
+            "androidboot.serialconsole=0\n"
+        )
+
+        # Check required files
+        for x in [
+            vendor_ramdisk_platform,
+            vendor_ramdisk_recovery,
+            vendor_ramdisk_dlkm,
+            dtb_path
+        ]:
+            if not x.exists():
+                log_message(f"Missing required file: {x}")
+                sys.exit(1)
+
+        ramdisks = [
+            ("platform", "platform", vendor_ramdisk_platform),
+            ("dlkm", "dlkm", vendor_ramdisk_dlkm),
+            ("recovery", "recovery", vendor_ramdisk_recovery),
+        ]
+        vendor_cmdline = "bootconfig loop.max_part=7"
+        write_vendor_boot_image(final_img, ramdisks, dtb_path, bootconfig_file,
+                                vendor_cmdline=vendor_cmdline, pagesize=2048)
+
+        sources = {f"ramdisk:{name}": path for name, _, path in ramdisks}
+        sources.update({"dtb": dtb_path, "bootconfig": bootconfig_file})
+        if not verify_boot_image(final_img, sources):
+            sys.exit(1)
+
+        if compare_mkbootimg:
+            mkbootimg_args = [
+                "--vendor_bootconfig", bootconfig_file,
+                "--vendor_cmdline", vendor_cmdline,
+                "--header_version", "4",
+                "--dtb", dtb_path,
+                "--pagesize", "2048",
+            ]
+            for name, kind, path in ramdisks:
+                mkbootimg_args += ["--ramdisk_name", name, "--ramdisk_type", kind,
+                                   "--vendor_ramdisk_fragment", path]
+            compare_with_mkbootimg(ctx, final_img, mkbootimg_args, "--vendor_boot")
+
+    finally:
+        if staging_dir.exists():
+            log_message(f"Cleaning up temporary directory: {staging_dir}")
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+def get_module_order(ctx: BuildContext) -> list[str]:
+    """
+    Returns the .ko path relative to OUT_DIR of every module in link order,
+    from OUT_DIR/modules.order of a previous build
+
+    Returns:
+        list[str]: e.g. ["kernel/sched/ems/ems.ko", ...]
+    """
+    order_file = ctx.out_dir / "modules.order"
+    if not order_file.is_file():
+        log_message(f"ERROR: {order_file} not found, run a full build first")
+        sys.exit(1)
+
+    # Newer kernels list objects (foo.o) instead of modules (foo.ko)
+    return [
+        entry[:-2] + ".ko" if entry.endswith(".o") else entry
+        for entry in order_file.read_text().split()
+    ]
+
+def get_module_build_paths(ctx: BuildContext) -> dict[str, str]:
+    """
+    Maps module filenames to their .ko path relative to OUT_DIR,
+    using OUT_DIR/modules.order from a previous build
+    Of modules sharing a filename, the last one in link order is kept
+
+    Returns:
+        dict[str, str]: e.g. {"ems.ko": "kernel/sched/ems/ems.ko"}
+    """
+    return {Path(entry).name: entry for entry in get_module_order(ctx)}
+
+def read_kernel_config(ctx: BuildContext, config_path: Optional[Path] = None) -> dict[str, str]:
+    """
+    Parses a kernel .config into {"CONFIG_FOO": "y"|"m"|value}
+    Symbols that are not set are absent from the result
+    """
+    config_path = config_path or ctx.out_dir / ".config"
+    config = {}
+    for line in config_path.read_text().splitlines():
+        if line.startswith("CONFIG_") and "=" in line:
+            key, value = line.split("=", 1)
+            config[key] = value.strip('"')
+    return config
+
+def scan_kbuild_makefiles(ctx: BuildContext) -> tuple[dict[str, list[tuple[str, str]]],
+                                     dict[str, Optional[str]]]:
+    """
+    Scans the kernel source Makefiles/Kbuild files for obj-* assignments
+
+    Returns:
+        tuple: (modules, dirs) where modules maps "foo.ko" to a list of
+            (source dir, CONFIG symbol, or "y"/"m" for obj-y/obj-m) and dirs
+            maps a source dir to the CONFIG symbol gating it from its parent
+            Makefile (None if always descended into)
+    """
+    obj_re = re.compile(r"^\s*obj-(?:\$\((CONFIG_\w+)\)|(y|m))\s*[:+]?=\s*(.*)$")
+    modules = {}
+    dirs = {}
+
+    for dirpath, dirnames, filenames in os.walk(ctx.kernel_source_dir):
+        current = Path(dirpath)
+        dirnames[:] = [
+            x for x in dirnames
+            if not x.startswith(".") and current / x != ctx.out_dir
+            and x not in {"Documentation", "tools", "samples"}
+        ]
+        rel_dir = current.relative_to(ctx.kernel_source_dir).as_posix()
+        for makefile in ("Makefile", "Kbuild"):
+            if makefile not in filenames:
+                continue
+            try:
+                text = (current / makefile).read_text(errors="replace")
+            except OSError:
+                continue
+            for line in text.replace("\\\n", " ").splitlines():
+                match = obj_re.match(line)
+                if not match:
+                    continue
+                symbol = match.group(1)
+                for token in match.group(3).split("#", 1)[0].split():
+                    if "$" in token:
+                        continue
+                    if token.endswith(".o"):
+                        name = Path(token).name[:-2] + ".ko"
+                        obj_dir = (Path(rel_dir) / Path(token).parent).as_posix()
+                        modules.setdefault(name, []).append((obj_dir, symbol or match.group(2)))
+                    elif token.endswith("/"):
+                        dirs[(Path(rel_dir) / token.rstrip("/")).as_posix()] = symbol
+    return modules, dirs
+
+def preflight_module_lists(ctx: BuildContext, list_files: list[Path]):
+    """
+    Verifies before compiling that every module named in the given list
+    files will be built as a loadable module (=m) with the current .config
+
+    Each .ko is mapped back to its Kconfig symbol through the kernel
+    Makefiles (disambiguated by modules.order from a previous build when
+    available), and the symbols gating its parent directories must be
+    enabled as well. Exits listing every problem found
+
+    Modules the Makefiles do not name literally (e.g. obj-$(VAR)) are only
+    checked against modules.order and otherwise reported as warnings
+    """
+    start = time.perf_counter()
+    log_message("Running module list preflight against .config...")
+
+    config = read_kernel_config(ctx)
+    modules, dirs = scan_kbuild_makefiles(ctx)
+
+    # Known build paths from a previous build narrow down duplicate names
+    previous_paths = {}
+    order_file = ctx.out_dir / "modules.order"
+    if order_file.is_file():
+        for entry in order_file.read_text().split():
+            previous_paths[Path(entry).stem + ".ko"] = Path(entry).parent.as_posix()
+
+    def symbol_state(symbol: str) -> str:
+        return symbol if symbol in {"y", "m"} else config.get(symbol, "n")
+
+    def dir_enabled(obj_dir: str) -> Optional[str]:
+        # Returns the first disabled gating symbol on the way to the root
+        path = Path(obj_dir)
+        while path != Path("."):
+            symbol = dirs.get(path.as_posix())
+            if symbol is not None and config.get(symbol) not in {"y", "m"}:
+                return symbol
+            path = path.parent
+        return None
+
+    problems = []
+    warnings = []
+    for list_file in list_files:
+        for name in read_modules_file(list_file):
+            candidates = modules.get(name, [])
+            if name in previous_paths:
+                candidates = [x for x in candidates if x[0] == previous_paths[name]] or candidates
+            if not candidates and name in previous_paths:
+                gate = dir_enabled(previous_paths[name])
+                if gate is not None:
+                    problems.append(f"{list_file.name}: {name} will not be built as a module "
+                                    f"({previous_paths[name]}/ disabled by {gate})")
+                continue
+            if not candidates:
+                warnings.append(f"{list_file.name}: cannot map {name} to a kernel Makefile, "
+                                f"not checked")
+                continue
+
+            reasons = []
+            for obj_dir, symbol in candidates:
+                state = symbol_state(symbol)
+                gate = dir_enabled(obj_dir)
+                if state == "m" and gate is None:
+                    break
+                if gate is not None:
+                    reasons.append(f"{obj_dir}/ disabled by {gate}")
+                elif symbol == "y":
+                    reasons.append("obj-y (built-in)")
+                elif state == "y":
+                    reasons.append(f"{symbol}=y (built-in)")
+                else:
+                    reasons.append(f"{symbol} is not set")
+            else:
+                problems.append(f"{list_file.name}: {name} will not be built as a module "
+                                f"({'; '.join(reasons)})")
+
+    elapsed = time.perf_counter() - start
+    for warning in warnings:
+        log_message(f"WARNING: {warning}")
+    if problems:
+        for problem in problems:
+            log_message(f"ERROR: {problem}")
+        log_message(f"Module preflight failed with {len(problems)} problem(s) in {elapsed:.1f}s")
+        sys.exit(1)
+    log_message(f"Module preflight passed in {elapsed:.1f}s")
+
+def get_image_module_sets(ctx: BuildContext) -> dict[str, set[str]]:
+    """
+    Returns the set of module filenames packaged into each module image
+    """
+    return {
+        "vendor_ramdisk_dlkm": set(
+            read_modules_file(VENDOR_RAMDISK_DLKM_EARLY_MODULES_FILE) +
+            read_modules_file(VENDOR_RAMDISK_DLKM_MODULES_FILE)
+        ),
+        "system_dlkm": set(get_system_dlkm_list(ctx)),
+        "vendor_dlkm": set(read_modules_file(VENDOR_DLKM_MODULES_FILE)),
+    }
+
+class ModuleGraph:
+    """
+    Dependency graph over every installed module, with each module
+    assigned to the partitions that package it
+
+    Computed once per build, it checks that every partition can resolve
+    its dependencies from partitions mounted no later than itself and
+    produces each partition's modules.dep, including dependencies on
+    modules packaged in another partition
+    """
+
+    def __init__(self, module_dir: Path, partitions: dict[str, list[str]]):
+        self.partitions = partitions
+        self.paths = {}
+        self.warnings = []
+        for path in sorted(module_dir.rglob("*.ko")):
+            if path.name in self.paths:
+                self.warnings.append(f"{path.name} is installed twice: "
+                                     f"{self.paths[path.name]} and {path}")
+                continue
+            self.paths[path.name] = path
+
+        by_key = {module_name_key(x): x for x in self.paths}
+        self.deps = {}
+        self.unresolved = {}
+        for name, path in self.paths.items():
+            self.deps[name] = []
+            for dep in get_module_depends(path):
+                if dep in by_key:
+                    self.deps[name].append(by_key[dep])
+                else:
+                    self.unresolved.setdefault(name, []).append(dep)
+
+        self.owners = {}
+        for partition, modules in partitions.items():
+            for name in modules:
+                self.owners.setdefault(name, [])
+                if partition not in self.owners[name]:
+                    self.owners[name].append(partition)
+
+    @classmethod
+    def from_staging(cls, ctx: BuildContext) -> "ModuleGraph":
+        """
+        Builds the graph from the modules staging dir and the partition module lists
+        """
+        kernel_dirs = list((ctx.modules_staging_dir / "lib" / "modules").glob("*-*"))
+        if not kernel_dirs:
+            log_message("ERROR: No kernel version found")
+            sys.exit(1)
+        return cls(kernel_dirs[0], {
+            "vendor_ramdisk_dlkm": (read_modules_file(VENDOR_RAMDISK_DLKM_EARLY_MODULES_FILE) +
+                                    read_modules_file(VENDOR_RAMDISK_DLKM_MODULES_FILE)),
+            "system_dlkm": get_system_dlkm_list(ctx),
+            "vendor_dlkm": read_modules_file(VENDOR_DLKM_MODULES_FILE),
+        })
+
+    def provider(self, name: str, partition: str) -> Optional[str]:
+        """
+        Returns the partition a module is loaded from when needed by a
+        module in the given partition: the same partition if it packages it,
+        otherwise the earliest partition mounted no later than it
+        """
+        owners = self.owners.get(name, [])
+        if partition in owners:
+            return partition
+        stage = MODULE_PARTITIONS[partition][1]
+        usable = [x for x in owners if MODULE_PARTITIONS[x][1] <= stage]
+        return min(usable, key=lambda x: MODULE_PARTITIONS[x][1], default=None)
+
+    def check(self, strict: bool = False) -> bool:
+        """
+        Logs missing, cross-stage and duplicated modules across all partitions
+
+        Missing vendor_ramdisk_dlkm modules are errors; missing system_dlkm
+        and vendor_dlkm modules are warnings, as the image builders have
+        always skipped them. Unresolvable dependencies are warnings unless
+        strict
+
+        Args:
+            strict (bool): Fail on unresolvable dependencies
+
+        Returns:
+            bool: True if no error was found
+        """
+        errors = []
+        warnings = list(self.warnings)
+        dependency_problems = errors if strict else warnings
+        for partition, modules in self.partitions.items():
+            stage = MODULE_PARTITIONS[partition][1]
+            for name in modules:
+                if name not in self.paths:
+                    # dlkm images tolerate GKI modules this config does not build
+                    report = errors if partition == "vendor_ramdisk_dlkm" else warnings
+                    report.append(f"{partition}: {name} is listed but not installed")
+                    continue
+                for dep in self.unresolved.get(name, []):
+                    dependency_problems.append(f"{partition}: {name} depends on {dep}, "
+                                               f"which is not installed")
+                for dep in self.deps[name]:
+                    if self.provider(dep, partition):
+                        continue
+                    owners = self.owners.get(dep)
+                    if not owners:
+                        dependency_problems.append(f"{partition}: {name} depends on {dep}, "
+                                                   f"which no partition packages")
+                    else:
+                        later = ", ".join(x for x in owners if MODULE_PARTITIONS[x][1] > stage)
+                        dependency_problems.append(f"{partition}: {name} depends on {dep}, "
+                                                   f"which is only in {later} (mounted later)")
+
+        for name, owners in sorted(self.owners.items()):
+            if len(owners) > 1:
+                warnings.append(f"{name} is packaged in {', '.join(owners)}")
+
+        for warning in warnings:
+            log_message(f"WARNING: Module graph: {warning}")
+        for error in errors:
+            log_message(f"ERROR: Module graph: {error}")
+        log_message(f"Module graph: {len(self.paths)} installed modules, "
+                    f"{len(errors)} error(s), {len(warnings)} warning(s)")
+        return not errors
+
+    def modules_dep(self, partition: str) -> str:
+        """
+        Returns modules.dep for a partition. Each line lists a module's
+        transitive dependencies at their mount paths, dependencies of a
+        dependency after it, as modprobe loads them from the end
+        """
+        def path(name: str, owner: str) -> str:
+            return f"{MODULE_PARTITIONS[owner][0]}/lib/modules/{name}"
+
+        lines = []
+        for name in self.partitions[partition]:
+            if name not in self.paths:
+                continue
+            order = []
+            seen = set()
+
+            def visit(module: str):
+                for dep in self.deps[module]:
+                    if dep not in seen:
+                        seen.add(dep)
+                        visit(dep)
+                        order.append(dep)
+
+            visit(name)
+            deps = " ".join(path(x, self.provider(x, partition) or partition)
+                            for x in reversed(order))
+            lines.append(f"{path(name, partition)}: {deps}".rstrip())
+        return "\n".join(lines) + "\n"
+
+    def required(self) -> set[str]:
+        """
+        Returns every packaged module and everything they depend on
+        """
+        required = set()
+        pending = [x for x in self.owners if x in self.paths]
+        while pending:
+            name = pending.pop()
+            if name not in required:
+                required.add(name)
+                pending.extend(self.deps.get(name, []))
+        return required
+
+def scan_kconfig_depends(ctx: BuildContext) -> dict[str, set[str]]:
+    """
+    Maps every Kconfig symbol to the symbols named in its 'depends on'
+    lines and enclosing 'if' blocks, i.e. the symbols that can switch it off
+
+    Returns:
+        dict[str, set[str]]: e.g. {"CONFIG_FOO_SPI": {"CONFIG_FOO", "CONFIG_SPI"}}
+    """
+    depends = {}
+    for dirpath, dirnames, filenames in os.walk(ctx.kernel_source_dir):
+        current = Path(dirpath)
+        dirnames[:] = [
+            x for x in dirnames
+            if not x.startswith(".") and current / x != ctx.out_dir
+            and x not in {"Documentation", "tools", "samples"}
+        ]
+        for filename in filenames:
+            if not filename.startswith("Kconfig"):
+                continue
+            try:
+                text = (current / filename).read_text(errors="replace")
+            except OSError:
+                continue
+
+            symbol = None
+            if_stack = []
+            for line in text.replace("\\\n", " ").splitlines():
+                words = line.split(None, 1)
+                if not words:
+                    continue
+                keyword, rest = words[0], (words[1] if len(words) > 1 else "")
+                if keyword in {"config", "menuconfig"}:
+                    symbol = f"CONFIG_{rest.strip()}"
+                    depends.setdefault(symbol, set()).update(*if_stack)
+                elif keyword == "depends" and symbol and rest.startswith("on"):
+                    depends[symbol].update(
+                        f"CONFIG_{x}" for x in re.findall(r"\b[A-Z][A-Z0-9_]*\b", rest[2:]))
+                elif keyword == "if":
+                    if_stack.append({f"CONFIG_{x}" for x in re.findall(r"\b[A-Z][A-Z0-9_]*\b", rest)})
+                    symbol = None
+                elif keyword == "endif":
+                    if if_stack:
+                        if_stack.pop()
+                    symbol = None
+                elif keyword in {"menu", "endmenu", "choice", "endchoice", "comment", "source"}:
+                    symbol = None
+    return depends
+
+def get_module_symbols(ctx: BuildContext) -> dict[str, Optional[str]]:
+    """
+    Maps every module in OUT_DIR/modules.order to the Kconfig symbol that
+    builds it, None if it is built unconditionally or the Makefiles are
+    ambiguous about it
+    """
+    modules, _ = scan_kbuild_makefiles(ctx)
+    symbols = {}
+    for name, path in get_module_build_paths(ctx).items():
+        candidates = {symbol for obj_dir, symbol in modules.get(name, [])
+                      if obj_dir == Path(path).parent.as_posix()}
+        symbols[name] = candidates.pop() if len(candidates) == 1 else None
+    return symbols
+
+def build_trial_config(ctx: BuildContext, config_fragments: list[Path]) -> dict[str, str]:
+    """
+    Generates a .config in a throwaway output tree and returns it
+    """
+    trial = copy.copy(ctx)
+    set_out_dir(trial, ctx.mkdtemp("trim_config_"))
+    try:
+        generate_kernel_config(trial, get_make_args(trial), config_fragments)
+        return read_kernel_config(trial)
+    finally:
+        shutil.rmtree(trial.out_dir, ignore_errors=True)
+
+def write_trim_fragment(ctx: BuildContext, config_fragments: list[Path], output: Path) -> dict:
+    """
+    Writes a config fragment disabling the modules the defconfig builds
+    but no image packages, and logs what it saves
+
+    A module stays enabled if any packaged module depends on it, if its
+    Kconfig symbol also builds a needed module, or if disabling it would
+    turn off a packaged module or a built-in option through Kconfig
+    dependencies. The last check generates the trimmed .config in a
+    throwaway tree and repeats until nothing needed changes from the
+    untrimmed one
+
+    Args:
+        config_fragments (list[Path]): Fragments the build merges over the defconfig
+        output (Path): Fragment file to write
+
+    Returns:
+        dict: Disabled symbols and modules, and the install and build sizes saved
+    """
+    start = time.perf_counter()
+    # Compare fresh configs, OUT_DIR/.config may carry local edits
+    config = build_trial_config(ctx, config_fragments)
+    graph = ModuleGraph.from_staging(ctx)
+    build_paths = get_module_build_paths(ctx)
+    module_symbols = get_module_symbols(ctx)
+    required = graph.required()
+
+    by_symbol = {}
+    for name, symbol in module_symbols.items():
+        by_symbol.setdefault(symbol, set()).add(name)
+    # A symbol can only go if every module it builds is unneeded
+    trim = {
+        symbol for symbol, names in by_symbol.items()
+        if symbol and config.get(symbol) == "m" and not names & required
+    }
+
+    protected = {module_symbols.get(x) for x in required} - {None}
+    protected |= {k for k, v in config.items() if v == "y"}
+    kconfig_depends = scan_kconfig_depends(ctx)
+    kept = set()
+    output.parent.mkdir(parents=True, exist_ok=True)
+    for _ in range(CONFIG_TRIM_MAX_ROUNDS):
+        output.write_text("".join(f"# {x} is not set\n" for x in sorted(trim)))
+        trial = build_trial_config(ctx, [*config_fragments, output])
+        lost = {x for x in protected if trial.get(x) != config.get(x)}
+        if not lost:
+            break
+        # Keep every trimmed symbol the lost ones (transitively) depend on
+        keep = set()
+        pending = list(lost)
+        while pending:
+            for dep in kconfig_depends.get(pending.pop(), ()):
+                if dep not in keep:
+                    keep.add(dep)
+                    pending.append(dep)
+        keep &= trim
+        if not keep:
+            log_message(f"ERROR: Trimming turns off needed options: {', '.join(sorted(lost))}")
+            sys.exit(1)
+        log_message(f"Keeping {len(keep)} symbol(s) needed by {', '.join(sorted(lost)[:5])}")
+        trim -= keep
+        kept |= keep
+    else:
+        log_message(f"ERROR: Config trim did not converge in {CONFIG_TRIM_MAX_ROUNDS} rounds")
+        sys.exit(1)
+
+    # Symbols selected by enabled options stay on, only count real removals
+    removed = sorted(x for x in trim if trial.get(x) != "m")
+    removed_modules = sorted(x for x in module_symbols if module_symbols[x] in removed)
+    output.write_text(
+        f"# Generated by build_kernel.py --trim-unpackaged-modules\n"
+        f"# Modules built by {ctx.defconfig} that no image packages\n" +
+        "".join(f"# {x} is not set\n" for x in removed)
+    )
+
+    installed_size = sum(graph.paths[x].stat().st_size for x in removed_modules if x in graph.paths)
+    built_size = sum((ctx.out_dir / build_paths[x]).stat().st_size for x in removed_modules
+                     if (ctx.out_dir / build_paths[x]).is_file())
+    unpackaged = set(build_paths) - required
+    log_message(f"{len(unpackaged)} of {len(build_paths)} built modules are not packaged; "
+                f"disabling {len(removed)} symbols removes {len(removed_modules)} modules")
+    log_message(f"Saves {installed_size / 1024 ** 2:.1f} MiB of modules_install and "
+                f"{built_size / 1024 ** 2:.1f} MiB of built modules")
+    if kept:
+        log_message(f"Kept for Kconfig dependencies: {', '.join(sorted(kept))}")
+    log_message(f"Wrote {output} in {time.perf_counter() - start:.1f}s, "
+                f"use it with --config-fragment")
+    return {
+        "symbols": removed,
+        "modules": removed_modules,
+        "kept": sorted(kept),
+        "modules_install_bytes": installed_size,
+        "built_module_bytes": built_size,
+    }
+
+def benchmark_config_trim(ctx: BuildContext, args: argparse.Namespace, fragment: Path):
+    """
+    Times a from-scratch build with and without the trim fragment and logs
+    the compile time and modules_install size of each
+    Both runs build into a throwaway OUT_DIR, DIST_DIR and staging dir, so
+    the existing trees are untouched
+    """
+    out_dir, dist_dir, temp_dir = ctx.out_dir, ctx.dist_dir, ctx.temp_dir
+    base_fragments = list(args.config_fragment)
+    bench_root = ctx.mkdtemp("config_trim_bench_")
+    results = {}
+    try:
+        for mode, fragments in (("full", base_fragments), ("trimmed", [*base_fragments, fragment])):
+            set_out_dir(ctx, bench_root / mode / "out")
+            ctx.dist_dir = bench_root / mode / "dist"
+            ctx.temp_dir = bench_root / mode / "tmp"
+            ctx.temp_dir.mkdir(parents=True)
+            args.config_fragment = fragments
+            log_message(f"Benchmarking {mode} config build...")
+            start = time.perf_counter()
+            try:
+                run_build_stages(ctx, args)
+                elapsed = time.perf_counter() - start
+                installed = sum(x.stat().st_size for x in ctx.modules_staging_dir.rglob("*.ko"))
+                results[mode] = (elapsed, installed)
+            finally:
+                shutil.rmtree(bench_root / mode, ignore_errors=True)
+    finally:
+        args.config_fragment = base_fragments
+        set_out_dir(ctx, out_dir)
+        ctx.dist_dir, ctx.temp_dir = dist_dir, temp_dir
+        shutil.rmtree(bench_root, ignore_errors=True)
+
+    for mode, (elapsed, installed) in results.items():
+        log_message(f"{mode:>7} build: {elapsed:.1f}s, modules_install {installed / 1024 ** 2:.1f} MiB")
+    full, trimmed = results["full"], results["trimmed"]
+    log_message(f"Config trim saves {full[0] - trimmed[0]:.1f}s "
+                f"({1 - trimmed[0] / full[0]:.1%}) and "
+                f"{(full[1] - trimmed[1]) / 1024 ** 2:.1f} MiB of modules_install")
+
+
+def get_module_sign_command(ctx: BuildContext) -> Optional[list[str]]:
+    """
+    Returns the sign-file command modules_install appends to every module
+    when CONFIG_MODULE_SIG_ALL is set, run from OUT_DIR like Kbuild does
+
+    Returns:
+        list[str] | None: sign-file, hash, key and certificate, or None if
+            modules_install does not sign modules
+    """
+    config = read_kernel_config(ctx)
+    if config.get("CONFIG_MODULE_SIG_ALL") != "y":
+        return None
+    return [
+        str(ctx.out_dir / "scripts" / "sign-file"),
+        config.get("CONFIG_MODULE_SIG_HASH", "sha1"),
+        config.get("CONFIG_MODULE_SIG_KEY", "certs/signing_key.pem"),
+        str(ctx.out_dir / "certs" / "signing_key.x509"),
+    ]
 
-    finally:
-        shutil.rmtree(staging_dir, ignore_errors=True)
+def install_module(ctx: BuildContext,
+                   src: Path,
+                   dst: Path,
+                   sign_command: Optional[list[str]] = None):
+    """
+    Installs a single module the way modules_install does:
+    strips debug info while keeping .ARM.attributes, then signs it
 
-def build_vendorboot_image():
+    Args:
+        src (Path): Built module
+        dst (Path): Installed module
+        sign_command (list[str], optional): From get_module_sign_command()
     """
-    Assemble vendor_boot.img using mkbootimg (header version 4).
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    run_cmd(
+        ctx,
+        ["llvm-strip", *MODULE_STRIP_FLAGS.split(), "-o", dst, src],
+        fatal_on_error=True
+    )
+    if sign_command:
+        run_cmd(ctx, [*sign_command, dst], cwd=ctx.out_dir, fatal_on_error=True)
 
-    Combines multiple vendor ramdisk fragments (platform, dlkm, recovery),
-    a DTB image, and embeds a basic vendor bootconfig file
+def get_module_stat_key(path: Path) -> list[int]:
+    """
+    Returns the (size, mtime) pair used to detect a rebuilt module,
+    the same signal make uses for its own dependency check
+    """
+    st = path.stat()
+    return [st.st_size, st.st_mtime_ns]
 
-    Requires:
-        - DTB image generated with --create-dtbo-images
-        - Vendor ramdisk fragments generated with --build-vendor-ramdisk-dlkm
+def install_modules_incremental(ctx: BuildContext, jobs: int):
     """
-    image_name = "vendor_boot"
-    final_img = DIST_DIR / f"{image_name}.img"
-    parts_dir = ROOT_DIR / "vb_fragments"
+    Installs modules into MODULES_STAGING_DIR, restripping only modules
+    whose built .ko changed since the last install
 
-    vendor_ramdisk_dlkm = DIST_DIR / "vendor_ramdisk_dlkm.cpio.lz4"
-    dtb_path = DIST_DIR / "dtb.img"
-    vendor_ramdisk_platform = parts_dir / "vendor_ramdisk_platform.lz4"
-    vendor_ramdisk_recovery = parts_dir / "vendor_ramdisk_recovery.lz4"
+    The first install (or a kernel release change) runs a full
+    'make modules_install'. Later installs compare every built .ko with the
+    manifest of installed copies, strip changed modules in parallel,
+    drop modules that are no longer built and refresh depmod output,
+    leaving the same tree as a full install
 
-    # Create staging directory
-    staging_dir = Path(tempfile.mkdtemp(prefix=f"{image_name}_staging_"))
-    staging_dir.mkdir(parents=True, exist_ok=True)
+    Args:
+        jobs (int): Number of parallel strip jobs
+    """
+    release_file = ctx.out_dir / "include" / "config" / "kernel.release"
+    if not release_file.is_file():
+        log_message(f"ERROR: Kernel release file not found: {release_file}")
+        sys.exit(1)
+    kernel_release = release_file.read_text().strip()
 
+    modules_root = ctx.modules_staging_dir / "lib" / "modules"
+    install_dir = modules_root / kernel_release
+    manifest_path = ctx.out_dir / MODULES_INSTALL_MANIFEST_FILE
     try:
-        # Create bootconfig
-        bootconfig_file = staging_dir / "vendor_bootconfig.txt"
-        bootconfig_file.write_text(
-            "buildtime_bootconfig=enable\n"
-            "androidboot.serialconsole=0\n"
+        manifest = json.loads(manifest_path.read_text())
+    except (OSError, ValueError):
+        manifest = {}
+
+    build_paths = get_module_order(ctx)
+    sign_command = get_module_sign_command(ctx)
+    # Without the signing tools only modules_install can say what is missing
+    can_sign = sign_command is None or all(
+        Path(x).is_file() for x in (sign_command[0], sign_command[3]))
+
+    if (not install_dir.is_dir() or manifest.get("kernel_release") != kernel_release
+            or not can_sign):
+        log_message(f"Installing all modules to: {ctx.modules_staging_dir}...")
+        # Drop trees of other kernel releases so only one version is staged
+        shutil.rmtree(modules_root, ignore_errors=True)
+        run_cmd(
+            ctx,
+            ["make", f"-j{jobs}", *get_make_args(ctx),
+             f"INSTALL_MOD_STRIP={MODULE_STRIP_FLAGS}",
+             f"INSTALL_MOD_PATH={ctx.modules_staging_dir}", "modules_install"],
+            cwd=ctx.kernel_source_dir
         )
+    else:
+        installed = manifest.get("modules", {})
+        changed = [
+            rel for rel in build_paths
+            if not (install_dir / "kernel" / rel).is_file()
+            or installed.get(rel) != get_module_stat_key(ctx.out_dir / rel)
+        ]
+
+        # Remove modules that are no longer part of the build
+        wanted = {install_dir / "kernel" / rel for rel in build_paths}
+        stale = [x for x in (install_dir / "kernel").rglob("*.ko") if x not in wanted]
+        for path in stale:
+            log_message(f"Removing stale module: {path.name}")
+            path.unlink()
+
+        if not changed and not stale:
+            log_message("Installed modules are up to date")
+            return
 
-        # Check required files
-        for x in [
-            vendor_ramdisk_platform,
-            vendor_ramdisk_recovery,
-            vendor_ramdisk_dlkm,
-            dtb_path
-        ]:
-            if not x.exists():
-                log_message(f"Missing required file: {x}")
-                sys.exit(1)
+        log_message(f"Restripping {len(changed)} of {len(build_paths)} modules...")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            futures = [
+                pool.submit(install_module, ctx, ctx.out_dir / rel,
+                            install_dir / "kernel" / rel, sign_command)
+                for rel in changed
+            ]
+            for future in futures:
+                future.result()
+
+        # Refresh the module lists the way modules_install writes them:
+        # modules.order in link order, the builtin lists verbatim
+        (install_dir / "modules.order").write_text(
+            "".join(f"kernel/{rel}\n" for rel in build_paths)
+        )
+        for name in ("modules.builtin", "modules.builtin.modinfo"):
+            if (ctx.out_dir / name).is_file():
+                shutil.copyfile(ctx.out_dir / name, install_dir / name)
 
-        # Run mkbootimg
+        depmod = ctx.kernelbuild_tools_path / "depmod"
         run_cmd(
-            f"{MKBOOT_PATH / 'mkbootimg.py'} "
-            f"--vendor_bootconfig {bootconfig_file} "
-            f"--vendor_cmdline \"bootconfig loop.max_part=7\" "
-            f"--header_version 4 "
-            f"--dtb {dtb_path} "
-            f"--pagesize 2048 "
-            f"--ramdisk_name platform "
-            f"--ramdisk_type platform "
-            f"--vendor_ramdisk_fragment {vendor_ramdisk_platform} "
-            f"--ramdisk_name dlkm "
-            f"--ramdisk_type dlkm "
-            f"--vendor_ramdisk_fragment {vendor_ramdisk_dlkm} "
-            f"--ramdisk_name recovery "
-            f"--ramdisk_type recovery "
-            f"--vendor_ramdisk_fragment {vendor_ramdisk_recovery} "
-            f"--vendor_boot {final_img} ",
+            ctx,
+            [depmod if depmod.is_file() else "depmod", "-a",
+             "-b", ctx.modules_staging_dir, kernel_release],
             fatal_on_error=True
         )
 
-        if not final_img.exists():
-            log_message(f"Failed to generate {final_img}")
-            sys.exit(1)
+    manifest_path.write_text(json.dumps({
+        "kernel_release": kernel_release,
+        "modules": {
+            rel: get_module_stat_key(ctx.out_dir / rel) for rel in sorted(build_paths)
+        },
+    }, indent=2))
+
+def build_modules_only(ctx: BuildContext,
+                       jobs: int,
+                       names: list[str],
+                       extra_env: Optional[dict[str, str]] = None
+                       ) -> set[str]:
+    """
+    Rebuilds and installs only the given modules using targeted make goals
+    Requires OUT_DIR and MODULES_STAGING_DIR from a previous full build
 
-    finally:
-        if staging_dir.exists():
-            log_message(f"Cleaning up temporary directory: {staging_dir}")
-            shutil.rmtree(staging_dir, ignore_errors=True)
+    Args:
+        jobs (int): Number of parallel make jobs (-j)
+        names (list[str]): Module filenames (e.g. "blk-sec-wb.ko"),
+            all modules from modules.order if empty
+        extra_env (dict[str, str], optional): Additional environment variables
+
+    Returns:
+        set[str]: Module filenames that were rebuilt and installed
+    """
+    if not (ctx.out_dir / ".config").is_file():
+        log_message(f"ERROR: No .config in {ctx.out_dir}, run a full build first")
+        sys.exit(1)
+    check_out_dir_compiled(ctx, "--modules-only")
+
+    build_paths = get_module_build_paths(ctx)
+    names = [x if x.endswith(".ko") else f"{x}.ko" for x in names]
+    if not names:
+        names = sorted(build_paths)
+
+    unknown = [x for x in names if x not in build_paths]
+    if unknown:
+        log_message(f"ERROR: Module(s) not found in modules.order: {', '.join(unknown)}")
+        sys.exit(1)
+
+    targets = [build_paths[x] for x in names]
+    log_message(f"Rebuilding {len(targets)} module(s) with {jobs} parallel jobs...")
+    run_cmd(
+        ctx,
+        ["make", f"-j{jobs}", *get_make_args(ctx), *targets],
+        cwd=ctx.kernel_source_dir,
+        extra_env=extra_env,
+        fatal_on_error=True
+    )
+
+    # Only the modules rebuilt above differ from the installed copies
+    install_modules_incremental(ctx, jobs)
+
+    return set(names)
+
+def update_module_images(ctx: BuildContext,
+                         modules: set[str],
+                         optimize_order: bool = False,
+                         strict_module_deps: bool = False) -> list[str]:
+    """
+    Rebuilds only the module images that contain any of the given modules
+    vendor_boot.img is repacked when vendor_ramdisk_dlkm changes and it
+    was built before
+
+    Args:
+        modules (set[str]): Changed module filenames
+        optimize_order (bool): Write modules.load in dependency order
+        strict_module_deps (bool): Fail on unresolvable module dependencies
+
+    Returns:
+        list[str]: Names of the images that were rebuilt
+    """
+    affected = [
+        image for image, image_modules in get_image_module_sets(ctx).items()
+        if image_modules & modules
+    ]
+    if not affected:
+        log_message("No module image contains the rebuilt modules")
+        return []
+
+    module_graph = ModuleGraph.from_staging(ctx)
+    if not module_graph.check(strict_module_deps):
+        sys.exit(1)
+
+    rebuilt = []
+    if "vendor_ramdisk_dlkm" in affected:
+        mk_vendor_rd_dlkm(
+            ctx,
+            mount_prefix="",
+            module_early_list_file=VENDOR_RAMDISK_DLKM_EARLY_MODULES_FILE,
+            module_list_file=VENDOR_RAMDISK_DLKM_MODULES_FILE,
+            optimize_order=optimize_order,
+            module_graph=module_graph
+        )
+        rebuilt.append("vendor_ramdisk_dlkm")
+        if (ctx.dist_dir / "vendor_boot.img").exists() and (ctx.dist_dir / "dtb.img").exists():
+            build_vendorboot_image(ctx)
+            rebuilt.append("vendor_boot")
+    if "system_dlkm" in affected:
+        build_dlkm_image(
+            ctx,
+            image_name="system_dlkm",
+            modules_list_file=None,
+            mount_prefix="/system_dlkm",
+            sign_modules=True,
+            optimize_order=optimize_order,
+            module_graph=module_graph,
+        )
+        rebuilt.append("system_dlkm")
+    if "vendor_dlkm" in affected:
+        build_dlkm_image(
+            ctx,
+            image_name="vendor_dlkm",
+            modules_list_file=VENDOR_DLKM_MODULES_FILE,
+            mount_prefix="/vendor_dlkm",
+            sign_modules=False,
+            optimize_order=optimize_order,
+            module_graph=module_graph,
+        )
+        rebuilt.append("vendor_dlkm")
+
+    log_message(f"Updated images: {', '.join(rebuilt)}")
+    return rebuilt
 
-def sign_partition_image(image_path: Path, partition_name: str):
+def sign_partition_image(ctx: BuildContext, image_path: Path, partition_name: str):
     """
     Signs a partition image using AVBTool
     Uses add_hash_footer for boot.img, and add_hashtree_footer for mountable images
     """
-    avbtool = KERNELBUILD_TOOLS_PATH / 'avbtool'
-    key_path = MKBOOT_PATH / "gki/testdata/testkey_rsa4096.pem"
+    avbtool = ctx.kernelbuild_tools_path / 'avbtool'
+    key_path = ctx.mkboot_path / "gki/testdata/testkey_rsa4096.pem"
 
     missing = []
     if not avbtool:
@@ -821,6 +4634,12 @@ def sign_partition_image(image_path: Path, partition_name: str):
         log_message(f"ERROR: Required component(s) missing: {', '.join(missing)}")
         sys.exit(1)
 
+    # avbtool picks a random salt unless one is given
+    salt_args = []
+    if ctx.source_date_epoch is not None:
+        salt = hashlib.sha256(f"{partition_name}:{ctx.source_date_epoch}".encode()).hexdigest()
+        salt_args = ["--salt", salt]
+
     log_message(f"Signing {partition_name}.img with AVBTool...")
     if partition_name in {"boot", "vendor_boot", "dtbo"}:
         # Partitions
@@ -836,41 +4655,47 @@ def sign_partition_image(image_path: Path, partition_name: str):
             padded_size = math.ceil(raw_size / 4096) * 4096
         if partition_name in {"boot", "vendor_boot"}:
             run_cmd(
-                f"{avbtool} add_hash_footer "
-                f"--image {image_path} "
-                f"--partition_name {partition_name} "
-                f"--partition_size {padded_size} "
-                f"--key {key_path} "
-                f"--algorithm SHA256_RSA4096",
+                ctx,
+                [avbtool, "add_hash_footer",
+                 "--image", image_path,
+                 "--partition_name", partition_name,
+                 "--partition_size", str(padded_size),
+                 *salt_args,
+                 "--key", key_path,
+                 "--algorithm", "SHA256_RSA4096"],
                 fatal_on_error=True
             )
         else:
             run_cmd(
-                f"{avbtool} add_hashtree_footer "
-                f"--image {image_path} "
-                f"--partition_name {partition_name} "
-                f"--partition_size {padded_size} "
-                f"--do_not_generate_fec "
-                f"--hash_algorithm sha256 "
-                f"--key {key_path} "
-                f"--algorithm SHA256_RSA4096",
+                ctx,
+                [avbtool, "add_hashtree_footer",
+                 "--image", image_path,
+                 "--partition_name", partition_name,
+                 "--partition_size", str(padded_size),
+                 "--do_not_generate_fec",
+                 "--hash_algorithm", "sha256",
+                 *salt_args,
+                 "--key", key_path,
+                 "--algorithm", "SHA256_RSA4096"],
                 fatal_on_error=True
             )
     else:
         run_cmd(
-            f"{avbtool} add_hashtree_footer "
-            f"--image {image_path} "
-            f"--partition_name {partition_name} "
-            f"--do_not_generate_fec "
-            f"--hash_algorithm sha256 "
-            f"--key {key_path} "
-            f"--algorithm SHA256_RSA4096",
+            ctx,
+            [avbtool, "add_hashtree_footer",
+             "--image", image_path,
+             "--partition_name", partition_name,
+             "--do_not_generate_fec",
+             "--hash_algorithm", "sha256",
+             *salt_args,
+             "--key", key_path,
+             "--algorithm", "SHA256_RSA4096"],
             fatal_on_error=True
         )
 
     log_message(f"{partition_name}.img signed successfully")
 
-def unpack_tarball(archive_path: Path, dest_dir: Path):
+def unpack_tarball(ctx: BuildContext, archive_path: Path, dest_dir: Path):
     """
     Extracts a .tar.gz archive to the given directory
     If the archive contains a single top-level folder,
@@ -884,7 +4709,7 @@ def unpack_tarball(archive_path: Path, dest_dir: Path):
     temp_dir.mkdir(parents=True)
 
     # Extract archive to temporary path
-    run_cmd(f"tar -xzf {archive_path} -C {temp_dir}", fatal_on_error=True)
+    run_cmd(ctx, ["tar", "-xzf", archive_path, "-C", temp_dir], fatal_on_error=True)
 
     contents = list(temp_dir.iterdir())
     dest_dir.mkdir(parents=True, exist_ok=True)
@@ -901,7 +4726,7 @@ def unpack_tarball(archive_path: Path, dest_dir: Path):
     shutil.rmtree(temp_dir, ignore_errors=True)
     log_message(f"Extraction complete: '{archive_path.name}'")
 
-def get_prebuilt(name: str, config: dict, target_dir: Path):
+def get_prebuilt(ctx: BuildContext, name: str, config: dict, target_dir: Path):
     """
     Fetches a prebuilt from a URL or Git repo if not already present
     Updates Git repositories if needed
@@ -924,7 +4749,8 @@ def get_prebuilt(name: str, config: dict, target_dir: Path):
             git_dir = target_dir / ".git"
             if git_dir.is_dir():
                 log_message(f"Updating git repository for '{name}' ...")
-                run_cmd("git pull --recurse-submodules", cwd=target_dir, fatal_on_error=False)
+                run_cmd(ctx, ["git", "pull", "--recurse-submodules"], cwd=target_dir,
+                        fatal_on_error=False)
             else:
                 log_message(f"'{target_dir}' is not a Git repo, skipping pull")
         marker_file.touch()
@@ -942,17 +4768,17 @@ def get_prebuilt(name: str, config: dict, target_dir: Path):
         url = config["download_url"]
         log_message(f"Downloading '{name}' from: {url}")
         # Choose available downloader
-        if shutil.which("wget"):
-            cmd = f"wget -q -O {archive} '{url}'"
-        elif shutil.which("curl"):
-            cmd = f"curl -s -L -o {archive} '{url}'"
+        if ctx.which("wget"):
+            cmd = ["wget", "-q", "-O", archive, url]
+        elif ctx.which("curl"):
+            cmd = ["curl", "-s", "-L", "-o", archive, url]
         else:
             log_message("ERROR: wget or curl not found")
             sys.exit(1)
 
-        run_cmd(cmd, fatal_on_error=True)
+        run_cmd(ctx, cmd, fatal_on_error=True)
         log_message("Download complete. Extracting...")
-        unpack_tarball(archive, target_dir)
+        unpack_tarball(ctx, archive, target_dir)
         os.remove(archive)
         log_message(f"Extraction complete: {target_dir}")
         marker_file.touch()
@@ -961,9 +4787,11 @@ def get_prebuilt(name: str, config: dict, target_dir: Path):
         branch = config["branch"]
         log_message(f"Cloning git repo: {repo} (branch: {branch})")
         depth = config.get("depth")
-        depth_arg = f"--depth {depth} --shallow-submodules" if depth else ""
+        depth_args = ["--depth", str(depth), "--shallow-submodules"] if depth else []
         run_cmd(
-            f"git clone --recurse-submodules {depth_arg} --branch {branch} {repo} {target_dir}",
+            ctx,
+            ["git", "clone", "--recurse-submodules", *depth_args,
+             "--branch", branch, repo, target_dir],
             fatal_on_error=True
         )
         log_message(f"Cloned to: {target_dir}")
@@ -972,93 +4800,1454 @@ def get_prebuilt(name: str, config: dict, target_dir: Path):
         log_message(f"ERROR: Unknown download_type '{download_type}'")
         sys.exit(1)
 
-def setup_environment(skip_prebuilt_update: bool = False):
+def setup_environment(ctx: BuildContext, skip_prebuilt_update: bool = False):
+    """
+    Prepares the build environment by ensuring all prebuilts are present
+    Downloads missing prebuilts and sets the context's paths
+    """
+    log_message("Initializing environment...")
+
+    log_message(f"Set environment variables: ARCH={ctx.env['ARCH']}, "
+        f"CROSS_COMPILE={ctx.env['CROSS_COMPILE']}, "
+        f"TARGET_SOC={ctx.env['TARGET_SOC']}")
+
+    for name, config in ctx.prebuilts_config.items():
+        if name == "Kernel_Source":
+            target = ROOT_DIR.parent / config["target_dir_name"]
+        else:
+            target = ctx.prebuilts_base_dir / config["target_dir_name"]
+        # Skip update if requested
+        config["skip_update"] = skip_prebuilt_update
+        get_prebuilt(ctx, name, config, target)
+        if name == "Kernel_Source":
+            expected_kernel_path = ROOT_DIR.parent / "exynos-kernel"
+            if target.resolve() != expected_kernel_path.resolve():
+                log_message(f"WARNING: Kernel_Source path mismatch: "
+                    f"'{target.resolve()}' != '{expected_kernel_path.resolve()}'")
+            ctx.kernel_source_dir = target
+
+    # Set paths to prebuilts
+    ctx.toolchain_path = (
+        ctx.prebuilts_base_dir /
+        ctx.prebuilts_config["Toolchain"]["target_dir_name"] /
+        ctx.prebuilts_config["Toolchain"]["bin_path_suffix"]
+    )
+    ctx.kernelbuild_tools_path = (
+        ctx.prebuilts_base_dir /
+        ctx.prebuilts_config["Kernel_Build_Tools"]["target_dir_name"] /
+        ctx.prebuilts_config["Kernel_Build_Tools"]["bin_path_suffix"]
+    )
+    ctx.gas_path = (
+        ctx.prebuilts_base_dir /
+        ctx.prebuilts_config["GAS"]["target_dir_name"]
+    )
+    ctx.mkboot_path = (
+        ctx.prebuilts_base_dir /
+        ctx.prebuilts_config["Mkbootimg_Tool"]["target_dir_name"]
+    )
+    ctx.anykernel_path = (
+        ctx.prebuilts_base_dir /
+        ctx.prebuilts_config["Anykernel3"]["target_dir_name"]
+    )
+    ctx.kernel_source_dir = (
+        ROOT_DIR.parent /
+        ctx.prebuilts_config["Kernel_Source"]["target_dir_name"]
+    )
+
+    log_message("Updating build PATH environment variable...")
+    extra_paths = filter(None, [
+        ctx.toolchain_path,
+        ctx.kernelbuild_tools_path,
+        ctx.gas_path,
+        ctx.mkboot_path,
+        ctx.anykernel_path,
+        ctx.kernel_source_dir,
+    ])
+
+    # Add unique paths to the beginning of the PATH
+    current_path_dirs = ctx.env["PATH"].split(os.pathsep)
+    new_path_dirs = []
+    for x in extra_paths:
+        x_str = str(x)
+        if x_str not in current_path_dirs:
+            new_path_dirs.append(x_str)
+
+    ctx.env["PATH"] = os.pathsep.join(new_path_dirs + current_path_dirs)
+    log_message(f"New PATH: {ctx.env['PATH']}")
+
+    log_message("Environment setup complete")
+
+def parse_zip_compression(specs: list[str]) -> list[tuple[str, int, int]]:
+    """
+    Parses --zip-compression values of the form PATTERN=METHOD[:LEVEL]
+    """
+    methods = {"stored": zipfile.ZIP_STORED, "deflated": zipfile.ZIP_DEFLATED}
+    rules = []
+    for spec in specs:
+        pattern, _, value = spec.partition("=")
+        method, _, level = value.partition(":")
+        if not pattern or method not in methods or (level and not level.isdigit()):
+            log_message(f"ERROR: Invalid --zip-compression value: '{spec}'")
+            sys.exit(1)
+        rules.append((pattern, methods[method], int(level) if level else 9))
+    return rules
+
+class InotifyWatcher:
+    """
+    Recursively watches a directory tree for file changes using inotify
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+
+    EVENT_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                  IN_CREATE | IN_DELETE)
+
+    def __init__(self, root: Path, skip_dirs: set[Path]):
+        self.root = root
+        self.skip_dirs = skip_dirs
+        self.watches = {}
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.add_tree(root)
+
+    def skipped(self, path: Path) -> bool:
+        return path.name.startswith(".") or path in self.skip_dirs
+
+    def add_tree(self, root: Path) -> set[Path]:
+        """
+        Watches every directory below root
+
+        Returns:
+            set[Path]: Files already present, which may have been written
+                before the watch was in place
+        """
+        existing = set()
+        for dirpath, dirnames, filenames in os.walk(root):
+            current = Path(dirpath)
+            existing.update(current / x for x in filenames)
+            dirnames[:] = [x for x in dirnames if not self.skipped(current / x)]
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), self.EVENT_MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(),
+                              f"inotify_add_watch failed for {dirpath} "
+                              f"(raise fs.inotify.max_user_watches?)")
+            self.watches[wd] = current
+        return existing
+
+    def read_changes(self, timeout: Optional[float]) -> Optional[set[Path]]:
+        """
+        Waits up to timeout seconds for events
+
+        Returns:
+            Optional[set[Path]]: Changed files, or None if the event queue
+                overflowed and the whole tree must be assumed changed
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+
+        changed = set()
+        data = os.read(self.fd, 1 << 20)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_len = struct.unpack_from("iIII", data, offset)
+            name = data[offset + 16:offset + 16 + name_len].rstrip(b"\0")
+            offset += 16 + name_len
+            if mask & self.IN_Q_OVERFLOW:
+                return None
+            parent = self.watches.get(wd)
+            if parent is None or not name:
+                continue
+            path = parent / os.fsdecode(name)
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO) and not self.skipped(path):
+                    changed |= self.add_tree(path)
+                continue
+            changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+def get_module_objects(ctx: BuildContext) -> dict[str, set[str]]:
+    """
+    Maps the objects linked into each module to the module, using the
+    foo.mod object lists kbuild writes next to every module in OUT_DIR
+
+    Returns:
+        dict[str, set[str]]: e.g. {"kernel/sched/ems/core.o": {"ems.ko"}},
+            empty without a previous build
+    """
+    if not (ctx.out_dir / "modules.order").is_file():
+        return {}
+    objects = {}
+    for name, rel in get_module_build_paths(ctx).items():
+        mod_file = (ctx.out_dir / rel).with_suffix(".mod")
+        if not mod_file.is_file():
+            continue
+        # One object per line on newer kernels, space separated on the first
+        # line followed by undefined symbols on older ones
+        for token in mod_file.read_text().split():
+            if token.endswith(".o"):
+                objects.setdefault(token, set()).add(name)
+    return objects
+
+def classify_source_changes(ctx: BuildContext, changed: set[Path]) -> tuple[str, list[str]]:
+    """
+    Decides the smallest rebuild covering a set of changed source files
+
+    Returns:
+        tuple[str, list[str]]: ("none" | "dtbs" | "modules" | "full",
+            module filenames for "modules")
+    """
+    relevant = {
+        x for x in changed
+        if x.suffix in WATCH_SOURCE_SUFFIXES or x.name in WATCH_SOURCE_NAMES
+    }
+    if not relevant:
+        return "none", []
+
+    rel_paths = [x.relative_to(ctx.kernel_source_dir) for x in relevant]
+    if all(x.suffix in {".dts", ".dtsi"} for x in rel_paths):
+        return "dtbs", []
+    if any(x.suffix not in {".c", ".S"} for x in rel_paths):
+        # Headers, Makefiles and Kconfig can affect anything
+        return "full", []
+
+    # Map each source file to the modules linking its object
+    object_modules = get_module_objects(ctx)
+    modules = set()
+    for rel in rel_paths:
+        owners = object_modules.get(rel.with_suffix(".o").as_posix())
+        if not owners:
+            # Built-in code, or not built at all
+            return "full", []
+        modules.update(owners)
+    return "modules", sorted(modules)
+
+def run_watch_rebuild(ctx: BuildContext, args: argparse.Namespace, kind: str, modules: list[str]):
+    """
+    Runs the rebuild selected by classify_source_changes
+    """
+    if kind == "dtbs":
+        run_cmd(ctx, ["make", f"-j{args.jobs}", *get_make_args(ctx), "dtbs"],
+                cwd=ctx.kernel_source_dir, fatal_on_error=True)
+        if args.create_dtbo_images or args.build_vendor_boot_image:
+            build_dtbo_images(ctx)
+        if args.build_vendor_boot_image:
+            build_vendorboot_image(ctx)
+            if args.sign_images:
+                sign_partition_image(ctx, ctx.dist_dir / "vendor_boot.img", "vendor_boot")
+        if args.sign_images and args.create_dtbo_images:
+            sign_partition_image(ctx, ctx.dist_dir / "dtbo.img", "dtbo")
+    elif kind == "modules":
+        run_modules_only_stages(ctx, args, modules)
+    else:
+        run_build_stages(ctx, args)
+
+def watch_and_rebuild(ctx: BuildContext, args: argparse.Namespace):
+    """
+    Keeps the process resident, watches the kernel source with inotify and
+    runs the smallest incremental rebuild and repack after each burst of
+    edits, reporting the time from save to images ready
+    """
+    log_message("Running initial build for watch mode...")
+    try:
+        run_build_stages(ctx, args)
+    except SystemExit:
+        log_message("Initial build failed, waiting for changes...")
+    # Module rebuilds map sources through the .mod files of the object tree
+    check_out_dir_compiled(ctx, "watch mode")
+
+    watcher = InotifyWatcher(ctx.kernel_source_dir, {ctx.out_dir})
+    log_message(f"Watching {ctx.kernel_source_dir} ({len(watcher.watches)} directories), "
+                f"press Ctrl-C to stop")
+    try:
+        while True:
+            changed = watcher.read_changes(None)
+            if changed is not None and not changed:
+                continue
+            first_event = time.monotonic()
+
+            # Debounce: collect events until the tree has been quiet
+            while changed is not None:
+                more = watcher.read_changes(args.watch_debounce)
+                if more is None:
+                    changed = None
+                elif not more:
+                    break
+                else:
+                    changed |= more
+
+            if changed is None:
+                log_message("inotify queue overflowed, running full incremental build")
+                kind, modules = "full", []
+            else:
+                kind, modules = classify_source_changes(ctx, changed)
+            if kind == "none":
+                continue
+
+            log_message(f"Change detected, rebuilding ({kind}"
+                        f"{': ' + ', '.join(modules) if modules else ''})...")
+            try:
+                run_watch_rebuild(ctx, args, kind, modules)
+                log_message(f"Images ready {time.monotonic() - first_event:.1f}s after save")
+            except SystemExit:
+                log_message("Rebuild failed, waiting for changes...")
+    except KeyboardInterrupt:
+        log_message("Watch mode stopped")
+    finally:
+        watcher.close()
+
+def get_make_env(ctx: BuildContext, args: argparse.Namespace) -> dict[str, str]:
+    """
+    Returns the extra environment for kernel make invocations
+    If --extra-local-version is enabled, BRANCH and KMI_GENERATION from
+    build config files are injected for setlocalversion
+    """
+    make_env = get_reproducible_env(ctx)
+    if args.extra_local_version:
+        version_env = get_version_env(ctx)
+        log_message(f"Using local version env: BRANCH={version_env['BRANCH']}, KMI_GENERATION={version_env['KMI_GENERATION']}")
+        make_env.update(version_env)
+    return make_env
+
+def run_modules_only_stages(ctx: BuildContext, args: argparse.Namespace, names: list[str]):
+    """
+    Rebuilds the given modules, repacks the images containing them and
+    re-signs those images if requested
+    """
+    rebuilt = build_modules_only(ctx, args.jobs, names, get_make_env(ctx, args) or None)
+    for name in update_module_images(ctx, rebuilt, args.optimize_module_order,
+                                     args.strict_module_deps):
+        image_path = ctx.dist_dir / f"{name}.img"
+        if args.sign_images and image_path.exists():
+            sign_partition_image(ctx, image_path, name)
+
+class BuildJournal:
+    """
+    Checkpoint journal recording each completed build stage and the hashes
+    of its outputs, so --resume can skip stages whose outputs are intact
+
+    Hashes are tracked per file, so a later stage that rewrites an output
+    in place (e.g. AVB signing) keeps the producing stage valid. Once a
+    stage has to run again, every stage after it runs again too
+    """
+
+    def __init__(self, path: Path, key: str, resume: bool):
+        self.path = path
+        self.key = key
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.files = {}
+        self.resumed = False
+        self.rerun = False
+        if resume:
+            try:
+                data = json.loads(path.read_text())
+            except (OSError, ValueError):
+                data = {}
+            if data.get("key") == key:
+                self.stages = data.get("stages", {})
+                self.files = data.get("files", {})
+                self.resumed = True
+            else:
+                log_message("No matching checkpoint journal, starting from the first stage")
+        self.save()
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({
+            "key": self.key,
+            "stages": self.stages,
+            "files": self.files,
+        }, indent=2))
+        os.replace(tmp, self.path)
+
+    def is_complete(self, name: str) -> bool:
+        """
+        Returns True if the stage completed and all its outputs are unchanged
+        """
+        with self.lock:
+            outputs = self.stages.get(name)
+            if outputs is None:
+                return False
+            expected = {x: self.files.get(x) for x in outputs}
+        for path, digest in expected.items():
+            if not Path(path).is_file() or hash_file(Path(path)) != digest:
+                log_message(f"Resume: output of '{name}' changed or missing: {path}")
+                return False
+        return True
+
+    def record(self, name: str, outputs: list[Path]):
+        """
+        Marks a stage as completed with the given output files
+        """
+        hashes = {str(x): hash_file(x) for x in outputs if x.is_file()}
+        with self.lock:
+            self.stages[name] = sorted(hashes)
+            self.files.update(hashes)
+            self.save()
+
+    def can_skip(self, name: str) -> bool:
+        if self.resumed and not self.rerun and self.is_complete(name):
+            log_message(f"Resume: skipping completed stage '{name}'")
+            return True
+        return False
+
+    def execute(self, name: str, stage: Callable[[], None],
+                outputs: Callable[[], list[Path]]):
+        with self.lock:
+            self.rerun = True
+            self.stages.pop(name, None)
+            self.save()
+        stage()
+        self.record(name, outputs())
+
+    def run(self, name: str, stage: Callable[[], None],
+            outputs: Callable[[], list[Path]]):
+        """
+        Runs a stage unless it is already complete, then records its outputs
+
+        Args:
+            name (str): Stage name
+            stage (Callable): Stage function
+            outputs (Callable): Returns the stage's output files after it ran
+        """
+        if not self.can_skip(name):
+            self.execute(name, stage, outputs)
+
+    def stage(self, name: str, stage: Callable[[], None],
+              outputs: Callable[[], list[Path]]) -> tuple[str, Callable[[], None]]:
+        """
+        Returns a (name, function) pair for run_parallel_stages
+        Completion is checked now, so stages of one parallel group do not
+        invalidate each other
+        """
+        if self.can_skip(name):
+            return name, lambda: None
+        return name, lambda: self.execute(name, stage, outputs)
+
+def get_size_metrics(ctx: BuildContext) -> dict[str, int]:
+    """
+    Returns the sizes tracked across builds:
+    - "dist:<file>": every artifact in DIST_DIR
+    - "vmlinux:<section>": allocated vmlinux sections, "vmlinux:total" their sum
+    - "modules:<partition>" and "module:<partition>/<name>": packaged
+      modules as installed (stripped), per partition
+    """
+    metrics = {}
+    for path in sorted(ctx.dist_dir.iterdir()):
+        if path.is_file() and path.name != BUILD_METADATA_FILE:
+            # The flash ZIP name carries a timestamp
+            name = "flashable.zip" if path.suffix == ".zip" else path.name
+            metrics[f"dist:{name}"] = path.stat().st_size
+
+    # A cache-restored OUT_DIR keeps the vmlinux of an older compile
+    vmlinux = ctx.out_dir / "vmlinux"
+    if vmlinux.is_file() and not is_out_dir_restored(ctx):
+        with open(vmlinux, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            sections = [x for x in get_elf_sections(data) if x[3] & ELF_SHF_ALLOC]
+        for name, _, size, _ in sections:
+            metrics[f"vmlinux:{name}"] = metrics.get(f"vmlinux:{name}", 0) + size
+        metrics["vmlinux:total"] = sum(x[2] for x in sections)
+
+    if (ctx.modules_staging_dir / "lib" / "modules").is_dir():
+        graph = ModuleGraph.from_staging(ctx)
+        for partition, names in graph.partitions.items():
+            sizes = {x: graph.paths[x].stat().st_size for x in names if x in graph.paths}
+            for name, size in sizes.items():
+                metrics[f"module:{partition}/{name}"] = size
+            metrics[f"modules:{partition}"] = sum(sizes.values())
+    return metrics
+
+def get_symbol_sizes(ctx: BuildContext) -> dict[str, int]:
+    """
+    Returns the size of every sized vmlinux symbol, summed over symbols
+    sharing a name, as bloat-o-meter compares them
+    """
+    vmlinux = ctx.out_dir / "vmlinux"
+    if not vmlinux.is_file() or is_out_dir_restored(ctx):
+        return {}
+    output = run_cmd(ctx, ["llvm-nm", "--print-size", "--radix=d", vmlinux],
+                     fatal_on_error=False) or ""
+    symbols = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 4 and fields[2] in "tTdDbBrRvVwW":
+            symbols[fields[3]] = symbols.get(fields[3], 0) + int(fields[1])
+    return symbols
+
+def check_size_baseline_name(name: str):
+    """
+    Exits unless a size baseline name is a plain file name
+    """
+    if not SIZE_BASELINE_NAME_RE.fullmatch(name):
+        log_message(f"ERROR: Invalid size baseline name '{name}' "
+                    f"(letters, digits, '.', '_' and '-' only)")
+        sys.exit(1)
+
+def save_size_report(ctx: BuildContext, report: dict, baseline: Optional[str] = None) -> Path:
+    """
+    Stores a size report in the target's history, or as a named baseline,
+    and prunes the history to SIZE_HISTORY_MAX_ENTRIES reports
+
+    Returns:
+        Path: The stored report
+    """
+    target_dir = SIZE_HISTORY_DIR / ctx.target_device
+    if baseline:
+        check_size_baseline_name(baseline)
+        path = target_dir / "baselines" / f"{baseline}.json.gz"
+    else:
+        stamp = datetime.datetime.fromtimestamp(report["time"]).strftime("%Y%m%d-%H%M%S")
+        path = target_dir / f"{stamp}-{(report['commit'] or 'unknown')[:12]}.json.gz"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        json.dump(report, f, sort_keys=True)
+    os.replace(tmp_path, path)
+
+    if not baseline:
+        for old in sorted(target_dir.glob("*.json.gz"))[:-SIZE_HISTORY_MAX_ENTRIES]:
+            old.unlink(missing_ok=True)
+    return path
+
+def load_size_report(ctx: BuildContext, baseline: Optional[str] = None) -> Optional[tuple[str, dict]]:
+    """
+    Loads the named baseline, or the latest report in the target's history
+
+    Returns:
+        Optional[tuple[str, dict]]: Report name and report, None if there is none
+    """
+    target_dir = SIZE_HISTORY_DIR / ctx.target_device
+    if baseline:
+        check_size_baseline_name(baseline)
+        path = target_dir / "baselines" / f"{baseline}.json.gz"
+        if not path.is_file():
+            log_message(f"ERROR: Size baseline '{baseline}' not found: {path}")
+            sys.exit(1)
+    else:
+        history = sorted(target_dir.glob("*.json.gz"))
+        if not history:
+            return None
+        path = history[-1]
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return path.name.split(".json")[0], json.load(f)
+
+def log_size_diff(old: dict, new: dict, label: str):
+    """
+    Logs the metric and symbol size changes between two reports, the
+    symbols in bloat-o-meter format
+    """
+    log_message(f"Size changes against {label}:")
+    for name in sorted(set(old["metrics"]) | set(new["metrics"])):
+        before, after = old["metrics"].get(name, 0), new["metrics"].get(name, 0)
+        if before != after and not name.startswith("module:"):
+            log_message(f"  {name:<40} {before:>12} -> {after:>12} ({after - before:+})")
+
+    module_changes = [
+        (name, old["metrics"].get(name, 0), new["metrics"].get(name, 0))
+        for name in set(old["metrics"]) | set(new["metrics"]) if name.startswith("module:")
+    ]
+    module_changes = sorted((x for x in module_changes if x[1] != x[2]),
+                            key=lambda x: -abs(x[2] - x[1]))
+    for name, before, after in module_changes[:SIZE_DIFF_TOP]:
+        log_message(f"  {name:<40} {before:>12} -> {after:>12} ({after - before:+})")
+
+    old_symbols, new_symbols = old.get("symbols", {}), new.get("symbols", {})
+    if not old_symbols or not new_symbols:
+        return
+    changes = []
+    added = removed = grown = shrunk = up = down = 0
+    for name in set(old_symbols) | set(new_symbols):
+        before, after = old_symbols.get(name, 0), new_symbols.get(name, 0)
+        if before == after:
+            continue
+        if name not in old_symbols:
+            added += 1
+        elif name not in new_symbols:
+            removed += 1
+        elif after > before:
+            grown += 1
+        else:
+            shrunk += 1
+        if after > before:
+            up += after - before
+        else:
+            down += before - after
+        changes.append((name, before, after))
+    log_message(f"add/remove: {added}/{removed} grow/shrink: {grown}/{shrunk} "
+                f"up/down: {up}/-{down} ({up - down})")
+    if changes:
+        log_message(f"  {'function':<40} {'old':>8} {'new':>8} {'delta':>8}")
+    for name, before, after in sorted(changes, key=lambda x: -abs(x[2] - x[1]))[:SIZE_DIFF_TOP]:
+        log_message(f"  {name:<40} {before:>8} {after:>8} {after - before:>+8}")
+
+def check_size_budgets(budgets: dict, new: dict, old: Optional[dict]) -> list[str]:
+    """
+    Checks a report against size budgets
+
+    Args:
+        budgets (dict): {"max_size": {pattern: bytes}, "max_growth": {pattern: bytes}},
+            patterns are fnmatch patterns over metric names
+        new (dict): Report of this build
+        old (dict, optional): Report growth is measured against
+
+    Returns:
+        list[str]: Budget violations
+    """
+    violations = []
+    for name, size in sorted(new["metrics"].items()):
+        for pattern, limit in budgets.get("max_size", {}).items():
+            if fnmatch.fnmatchcase(name, pattern) and size > limit:
+                violations.append(f"{name} is {size} bytes, budget {limit} ({pattern})")
+        if old is None or name not in old["metrics"]:
+            continue
+        growth = size - old["metrics"][name]
+        for pattern, limit in budgets.get("max_growth", {}).items():
+            if fnmatch.fnmatchcase(name, pattern) and growth > limit:
+                violations.append(f"{name} grew by {growth} bytes, budget {limit} ({pattern})")
+    return violations
+
+def track_sizes(ctx: BuildContext,
+                baseline: Optional[str] = None,
+                save_baseline: Optional[str] = None,
+                budgets_path: Optional[Path] = None):
+    """
+    Records the sizes of this build in the size history, logs the changes
+    against the previous build (or a named baseline) and exits if a size
+    budget is exceeded
+
+    Args:
+        baseline (str, optional): Baseline compared against instead of the
+            previous build
+        save_baseline (str, optional): Also store this build as a baseline
+        budgets_path (Path, optional): JSON size budgets, see check_size_budgets()
+    """
+    start = time.perf_counter()
+    commit = run_cmd(ctx, ["git", "rev-parse", "HEAD"], cwd=ctx.kernel_source_dir,
+                     fatal_on_error=False)
+    report = {
+        "time": time.time(),
+        "commit": commit.strip() if commit else None,
+        "target": ctx.target_device,
+        "defconfig": ctx.defconfig,
+        "metrics": get_size_metrics(ctx),
+        "symbols": get_symbol_sizes(ctx),
+    }
+    previous = load_size_report(ctx, baseline)
+    write_build_metadata(ctx, "sizes", {
+        name: size for name, size in report["metrics"].items() if not name.startswith("module:")
+    })
+    if previous:
+        log_size_diff(previous[1], report, previous[0])
+
+    # A build over budget is not recorded, so the next build is still
+    # compared against the last accepted one
+    if budgets_path and budgets_path.is_file():
+        budgets = json.loads(budgets_path.read_text())
+        violations = check_size_budgets(budgets, report, previous[1] if previous else None)
+        for violation in violations:
+            log_message(f"ERROR: Size budget exceeded: {violation}")
+        if violations:
+            log_message("Size report not recorded")
+            sys.exit(1)
+        log_message(f"All sizes within the budgets in {budgets_path.name}")
+
+    path = save_size_report(ctx, report)
+    if save_baseline:
+        save_size_report(ctx, report, save_baseline)
+        log_message(f"Saved size baseline '{save_baseline}'")
+    log_message(f"Recorded {len(report['metrics'])} sizes and {len(report['symbols'])} "
+                f"symbols in {path.name} ({time.perf_counter() - start:.1f}s)")
+
+def get_build_journal_key(ctx: BuildContext, args: argparse.Namespace) -> str:
+    """
+    Identifies the build a checkpoint journal belongs to: the options that
+    affect stage outputs and the kernel source state
+    """
+    options = {k: v for k, v in vars(args).items() if k not in BUILD_JOURNAL_IGNORED_OPTIONS}
+    commit = run_cmd(ctx, ["git", "rev-parse", "HEAD"], cwd=ctx.kernel_source_dir,
+                     fatal_on_error=False)
+    diff = run_cmd(ctx, ["git", "diff", "HEAD"], cwd=ctx.kernel_source_dir, fatal_on_error=False)
+
+    digest = hashlib.sha256()
+    for part in [
+        json.dumps(options, sort_keys=True, default=str),
+        (commit or "").strip(),
+        diff or "",
+        get_toolchain_identity(ctx),
+        str(ctx.source_date_epoch),
+        ctx.profile["sha256"] if ctx.profile else "",
+    ]:
+        digest.update(part.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def run_build_stages(ctx: BuildContext, args: argparse.Namespace, build_cache=None):
+    """
+    Runs the kernel build and every requested packaging stage into DIST_DIR
+
+    Args:
+        args (argparse.Namespace): Parsed command line options
+        build_cache (LocalCacheBackend | HttpCacheBackend, optional): Artifact cache
+    """
+    # Determine whether to install kernel modules
+    install_modules = (
+        args.build_vendor_ramdisk_dlkm or
+        args.build_vendor_boot_image or
+        args.build_dlkm_image
+    )
+
+    journal = BuildJournal(ctx.out_dir / BUILD_JOURNAL_FILE, get_build_journal_key(ctx, args),
+                           resume=args.resume)
+
+    # Clean dist output from previous build
+    if ctx.dist_dir.exists() and not journal.resumed:
+        log_message(f"Cleaning DIST_DIR: {ctx.dist_dir}")
+        discard_tree(ctx.dist_dir)
+
+    def dist(*names: str) -> Callable[[], list[Path]]:
+        return lambda: [ctx.dist_dir / x for x in names]
+
+    # Build kernel Image
+    make_env = get_make_env(ctx, args)
+    preflight_lists = []
+    if not args.skip_module_preflight:
+        if args.build_vendor_ramdisk_dlkm or args.build_vendor_boot_image:
+            preflight_lists += [VENDOR_RAMDISK_DLKM_EARLY_MODULES_FILE,
+                                VENDOR_RAMDISK_DLKM_MODULES_FILE]
+        if args.build_dlkm_image:
+            preflight_lists.append(VENDOR_DLKM_MODULES_FILE)
+
+    if args.build_vendor_boot_image:
+        if not args.create_dtbo_images:
+            log_message("Auto-enabling --create-dtbo-images (required for vendor_boot.img)")
+            args.create_dtbo_images = True
+        if not args.build_vendor_ramdisk_dlkm:
+            log_message("Auto-enabling --build-vendor-ramdisk-dlkm (required for vendor_boot.img)")
+            args.build_vendor_ramdisk_dlkm = True
+
+    # dtbo.img and dtb.img only need the dtbs goal, so they are packaged
+    # while Image and modules compile
+    dtbs_packaged = []
+
+    def package_dtbs():
+        name, stage = journal.stage("dtbo", lambda: build_dtbo_images(ctx), dist("dtbo.img", "dtb.img"))
+        stage()
+        dtbs_packaged.append(name)
+
+    journal.run(
+        "kernel",
+        lambda: build_kernel(ctx, args.jobs, make_env or None, install_modules=install_modules,
+                             config_fragments=args.config_fragment,
+                             build_cache=build_cache,
+                             preflight_lists=preflight_lists,
+                             lto=args.lto,
+                             thinlto_cache=(args.thinlto_cache.resolve(),
+                                            int(args.thinlto_cache_max_size * 1024 ** 3)),
+                             on_dtbs=package_dtbs if args.create_dtbo_images else None),
+        # Installed modules must survive too, or packaging would fail
+        lambda: [ctx.dist_dir / "Image", *ctx.modules_staging_dir.glob("lib/modules/*/modules.dep")]
+    )
+
+    spill_staging_if_low(ctx)
+
+    # Compressed Image variants, including the one selected for packaging
+    codecs = list(args.image_compression)
+    if args.kernel_image != "Image":
+        codecs.append(args.kernel_image.split(".", 1)[1])
+    if codecs:
+        journal.run("compressed images", lambda: build_compressed_images(ctx, codecs),
+                    dist(*(f"Image.{x}" for x in codecs)))
+
+    # Check every partition's dependencies before any image is built
+    module_graph = None
+    if args.build_vendor_ramdisk_dlkm or args.build_dlkm_image:
+        module_graph = ModuleGraph.from_staging(ctx)
+        if not module_graph.check(args.strict_module_deps):
+            log_message("ERROR: Module dependencies cannot be satisfied, see above")
+            sys.exit(1)
+
+    # Packaging stages only share read-only inputs, so they run concurrently
+    stages = []
+    if args.flashable_zip:
+        stages.append(journal.stage(
+            "flash zip",
+            lambda: create_flash_zip(ctx, parse_zip_compression(args.zip_compression),
+                                     kernel_image=args.kernel_image),
+            lambda: sorted(ctx.dist_dir.glob(f"{ctx.target_device}-{ctx.variant}-*.zip"))))
+    if args.create_dtbo_images and not dtbs_packaged:
+        stages.append(journal.stage("dtbo", lambda: build_dtbo_images(ctx), dist("dtbo.img", "dtb.img")))
+    if args.create_boot_image:
+        stages.append(journal.stage("boot", lambda: build_boot_image(
+            ctx, args.kernel_image, compare_mkbootimg=args.compare_mkbootimg),
+                                    dist("boot.img")))
+    if args.build_vendor_ramdisk_dlkm:
+        stages.append(journal.stage("vendor_ramdisk_dlkm", lambda: mk_vendor_rd_dlkm(
+            ctx,
+            mount_prefix="",
+            module_early_list_file=VENDOR_RAMDISK_DLKM_EARLY_MODULES_FILE,
+            module_list_file=VENDOR_RAMDISK_DLKM_MODULES_FILE,
+            optimize_order=args.optimize_module_order,
+            module_graph=module_graph
+        ), dist("vendor_ramdisk_dlkm.cpio.lz4")))
+    if args.build_dlkm_image:
+        stages.append(journal.stage("system_dlkm", lambda: build_dlkm_image(
+            ctx,
+            image_name="system_dlkm",
+            modules_list_file=None,
+            mount_prefix="/system_dlkm",
+            sign_modules=True,
+            optimize_order=args.optimize_module_order,
+            module_graph=module_graph,
+        ), dist("system_dlkm.img")))
+        stages.append(journal.stage("vendor_dlkm", lambda: build_dlkm_image(
+            ctx,
+            image_name="vendor_dlkm",
+            modules_list_file=VENDOR_DLKM_MODULES_FILE,
+            mount_prefix="/vendor_dlkm",
+            sign_modules=False,
+            optimize_order=args.optimize_module_order,
+            module_graph=module_graph,
+        ), dist("vendor_dlkm.img")))
+    run_parallel_stages(stages)
+
+    # vendor_boot.img needs dtb.img and vendor_ramdisk_dlkm from above
+    if args.build_vendor_boot_image:
+        journal.run("vendor_boot",
+                    lambda: build_vendorboot_image(ctx, compare_mkbootimg=args.compare_mkbootimg),
+                    dist("vendor_boot.img"))
+
+    if args.benchmark_compression:
+        journal.run("benchmark compression", lambda: benchmark_compression(ctx),
+                    lambda: [ctx.compression_profile_file])
+
+    # Sizes before signing, AVB footers pad images to their partition size
+    if args.track_sizes:
+        track_sizes(ctx, baseline=args.size_baseline, save_baseline=args.save_size_baseline,
+                    budgets_path=args.size_budgets.resolve())
+
+    # Sign images if requested
+    if args.sign_images:
+        images = [
+            ("dtbo", ctx.dist_dir / "dtbo.img", args.create_dtbo_images),
+            ("boot", ctx.dist_dir / "boot.img", args.create_boot_image),
+            ("system_dlkm", ctx.dist_dir / "system_dlkm.img", args.build_dlkm_image),
+            ("vendor_dlkm", ctx.dist_dir / "vendor_dlkm.img", args.build_dlkm_image),
+            ("vendor_boot", ctx.dist_dir / "vendor_boot.img", args.build_vendor_boot_image),
+        ]
+
+        signing = []
+        for name, path, requested in images:
+            if path.exists():
+                if requested:
+                    signing.append(journal.stage(
+                        f"sign {name}",
+                        lambda path=path, name=name: sign_partition_image(ctx, path, name),
+                        lambda path=path: [path]))
+                else:
+                    log_message(f"SKIP: {name}.img exists but not requested")
+            elif requested:
+                log_message(f"MISS: {name}.img requested but not built")
+
+        if not signing:
+            log_message("ERROR: --sign-images given but no image found to sign")
+            sys.exit(1)
+        run_parallel_stages(signing)
+
+    # Archive the final DIST_DIR, signed images included
+    if args.archive_artifacts:
+        archive_artifacts(ctx, args.artifact_store.resolve())
+
+def get_chunk_boundaries(data) -> list[int]:
+    """
+    Splits data into content-defined chunks: a chunk ends after a run of
+    ARTIFACT_CHUNK_RUN bytes that ARTIFACT_CHUNK_TABLE maps to 1, so
+    boundaries depend only on nearby content and realign after an insertion
+    or removal, within ARTIFACT_CHUNK_MIN and ARTIFACT_CHUNK_MAX
+
+    Args:
+        data (bytes | memoryview): Data to split
+
+    Returns:
+        list[int]: End offset of every chunk
+    """
+    classes = bytes(data).translate(ARTIFACT_CHUNK_TABLE)
+    marker = b"\x01" * ARTIFACT_CHUNK_RUN
+    boundaries = []
+    start = 0
+    while start < len(data):
+        end = min(start + ARTIFACT_CHUNK_MAX, len(data))
+        run = classes.find(marker, start + ARTIFACT_CHUNK_MIN - ARTIFACT_CHUNK_RUN, end)
+        start = end if run < 0 else run + ARTIFACT_CHUNK_RUN
+        boundaries.append(start)
+    return boundaries
+
+class ArtifactStore:
+    """
+    Archive of DIST_DIR contents across builds, deduplicated by
+    content-defined chunks
+
+    Chunks are stored once under their SHA-256 (zlib compressed) in
+    chunks/, and each archived build is a manifest under
+    manifests/<target>/ listing the chunks of every file
+    """
+
+    def __init__(self, root: Path, target: str):
+        self.root = root
+        self.manifest_dir = root / "manifests" / target
+        self.chunk_dir = root / "chunks"
+
+    def chunk_path(self, digest: str) -> Path:
+        return self.chunk_dir / digest[:2] / digest
+
+    def builds(self) -> list[str]:
+        """
+        Returns the archived build IDs of the target, oldest first
+        """
+        return sorted(x.name.removesuffix(".json") for x in self.manifest_dir.glob("*.json"))
+
+    def load(self, build_id: str) -> dict:
+        if build_id == "latest" and self.builds():
+            build_id = self.builds()[-1]
+        path = self.manifest_dir / f"{build_id}.json"
+        if not path.is_file():
+            log_message(f"ERROR: No archived build '{build_id}' in {self.manifest_dir}")
+            sys.exit(1)
+        return json.loads(path.read_text())
+
+    def put_chunk(self, data) -> tuple[str, int]:
+        """
+        Stores a chunk unless already present
+
+        Returns:
+            tuple[str, int]: SHA-256 of the chunk and bytes written (0 if deduplicated)
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.chunk_path(digest)
+        try:
+            # Keeps the chunk through a concurrent prune() until our manifest is written
+            os.utime(path)
+            return digest, 0
+        except FileNotFoundError:
+            # Not stored yet, or pruned since
+            pass
+        path.parent.mkdir(parents=True, exist_ok=True)
+        compressed = zlib.compress(data, 1)
+        tmp_path = path.with_name(f".{digest}.{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(compressed)
+        os.replace(tmp_path, path)
+        return digest, len(compressed)
+
+    def store(self, source_dir: Path, build_id: str, info: dict) -> dict:
+        """
+        Chunks every file of source_dir into the store and writes the
+        build's manifest
+
+        Returns:
+            dict: The manifest, with "stored" (new chunk bytes before and
+                after compression) filled in
+        """
+        manifest = dict(info, id=build_id, files=[], stored={"chunks": 0, "bytes": 0, "disk": 0})
+        with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+            for path in sorted(x for x in source_dir.iterdir() if x.is_file()):
+                entry = {"name": path.name, "size": path.stat().st_size,
+                         "mode": stat.S_IMODE(path.stat().st_mode), "chunks": []}
+                data = memoryview(path.read_bytes())
+                offsets = [0] + get_chunk_boundaries(data)
+                chunks = [data[a:b] for a, b in zip(offsets, offsets[1:])]
+                for chunk, (digest, written) in zip(chunks, pool.map(self.put_chunk, chunks)):
+                    entry["chunks"].append([digest, len(chunk)])
+                    if written:
+                        manifest["stored"]["chunks"] += 1
+                        manifest["stored"]["bytes"] += len(chunk)
+                        manifest["stored"]["disk"] += written
+                entry["sha256"] = hashlib.sha256(data).hexdigest()
+                manifest["files"].append(entry)
+
+        self.manifest_dir.mkdir(parents=True, exist_ok=True)
+        path = self.manifest_dir / f"{build_id}.json"
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        tmp_path.write_text(json.dumps(manifest))
+        os.replace(tmp_path, path)
+        return manifest
+
+    def read_chunk(self, digest: str) -> bytes:
+        path = self.chunk_path(digest)
+        if not path.is_file():
+            log_message(f"ERROR: Artifact store chunk missing: {digest}")
+            sys.exit(1)
+        return zlib.decompress(path.read_bytes())
+
+    def restore(self, manifest: dict, dest_dir: Path):
+        """
+        Rebuilds every file of a manifest in dest_dir, verifying its SHA-256
+        """
+        dest_dir.mkdir(parents=True, exist_ok=True)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+            for entry in manifest["files"]:
+                path = dest_dir / entry["name"]
+                tmp_path = dest_dir / f".{entry['name']}.tmp"
+                digest = hashlib.sha256()
+                with open(tmp_path, "wb") as f:
+                    for data in pool.map(self.read_chunk, [x[0] for x in entry["chunks"]]):
+                        digest.update(data)
+                        f.write(data)
+                if digest.hexdigest() != entry["sha256"]:
+                    tmp_path.unlink(missing_ok=True)
+                    log_message(f"ERROR: {entry['name']} does not match its manifest")
+                    sys.exit(1)
+                os.chmod(tmp_path, entry["mode"])
+                os.replace(tmp_path, path)
+
+    def prune(self, max_builds: int) -> int:
+        """
+        Drops the oldest manifests of the target beyond max_builds, then
+        every chunk no manifest of any target references, except chunks
+        used in the last ARTIFACT_CHUNK_GRACE seconds by a build whose
+        manifest may not be written yet
+
+        Returns:
+            int: Number of chunks removed
+        """
+        for build_id in self.builds()[:-max_builds]:
+            (self.manifest_dir / f"{build_id}.json").unlink(missing_ok=True)
+
+        referenced = set()
+        for path in (self.root / "manifests").glob("*/*.json"):
+            for entry in json.loads(path.read_text())["files"]:
+                referenced.update(x[0] for x in entry["chunks"])
+        removed = 0
+        cutoff = time.time() - ARTIFACT_CHUNK_GRACE
+        for path in self.chunk_dir.glob("*/*"):
+            if (path.name not in referenced and not path.name.startswith(".")
+                    and path.stat().st_mtime < cutoff):
+                path.unlink(missing_ok=True)
+                removed += 1
+        return removed
+
+    def stats(self) -> tuple[int, int]:
+        """
+        Returns:
+            tuple[int, int]: Bytes of every archived build of every target,
+                and bytes of their unique chunks
+        """
+        logical = 0
+        unique = {}
+        for path in (self.root / "manifests").glob("*/*.json"):
+            for entry in json.loads(path.read_text())["files"]:
+                logical += entry["size"]
+                unique.update(entry["chunks"])
+        return logical, sum(unique.values())
+
+def archive_artifacts(ctx: BuildContext, store_dir: Path):
+    """
+    Archives DIST_DIR in the artifact store, logs how much of it was
+    already stored and prunes the store to ARTIFACT_STORE_MAX_BUILDS builds
+    per target
+    """
+    start = time.perf_counter()
+    store = ArtifactStore(store_dir, ctx.target_device)
+    commit = run_cmd(ctx, ["git", "rev-parse", "HEAD"], cwd=ctx.kernel_source_dir,
+                     fatal_on_error=False)
+    commit = commit.strip() if commit else None
+    # The suffix keeps archives of one commit within the same second apart
+    build_id = (f"{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}-"
+                f"{(commit or 'unknown')[:12]}-{uuid.uuid4().hex[:6]}")
+    manifest = store.store(ctx.dist_dir, build_id, {
+        "time": time.time(), "commit": commit, "target": ctx.target_device,
+        "defconfig": ctx.defconfig,
+    })
+    removed = store.prune(ARTIFACT_STORE_MAX_BUILDS)
+
+    size = sum(x["size"] for x in manifest["files"])
+    stored = manifest["stored"]
+    logical, unique = store.stats()
+    log_message(f"Archived {len(manifest['files'])} files ({size / 1024 ** 2:.1f} MiB) "
+                f"as build {build_id} in {time.perf_counter() - start:.1f}s")
+    log_message(f"  New chunks: {stored['chunks']}, {stored['bytes'] / 1024 ** 2:.1f} MiB "
+                f"({stored['disk'] / 1024 ** 2:.1f} MiB compressed), "
+                f"{100 - 100 * stored['bytes'] / max(size, 1):.1f}% deduplicated")
+    log_message(f"  Store: {logical / 1024 ** 2:.1f} MiB archived in "
+                f"{unique / 1024 ** 2:.1f} MiB of chunks, dedupe ratio {logical / max(unique, 1):.2f}x"
+                + (f", {removed} unreferenced chunks removed" if removed else ""))
+
+def list_artifacts(ctx: BuildContext, store_dir: Path):
     """
-    Prepares the build environment by ensuring all prebuilts are present
-    Downloads missing prebuilts and sets global paths
+    Logs the archived builds of the target
     """
-    log_message("Initializing environment...")
+    store = ArtifactStore(store_dir, ctx.target_device)
+    builds = store.builds()
+    if not builds:
+        log_message(f"No archived builds for {ctx.target_device} in {store_dir}")
+        return
+    for build_id in builds:
+        manifest = store.load(build_id)
+        size = sum(x["size"] for x in manifest["files"])
+        log_message(f"  {build_id}  {len(manifest['files']):>3} files  "
+                    f"{size / 1024 ** 2:>8.1f} MiB  {manifest.get('defconfig', '')}")
 
-    global TOOLCHAIN_PATH, GAS_PATH, KERNELBUILD_TOOLS_PATH
-    global MKBOOT_PATH, ANYKERNEL_PATH, KERNEL_SOURCE_DIR
+def restore_artifacts(ctx: BuildContext, store_dir: Path, build_id: str):
+    """
+    Replaces DIST_DIR with an archived build ("latest" for the newest)
+    """
+    start = time.perf_counter()
+    store = ArtifactStore(store_dir, ctx.target_device)
+    manifest = store.load(build_id)
+    if ctx.dist_dir.exists():
+        discard_tree(ctx.dist_dir)
+    store.restore(manifest, ctx.dist_dir)
+    size = sum(x["size"] for x in manifest["files"])
+    log_message(f"Restored build {manifest['id']} ({len(manifest['files'])} files, "
+                f"{size / 1024 ** 2:.1f} MiB) to {ctx.dist_dir} "
+                f"in {time.perf_counter() - start:.1f}s")
+
+class BuildRequest:
+    """
+    One build of the build service, shared by every client that asked for
+    the same target, branch and build options while it was queued or running
+    """
 
-    # Global Environment Variables
-    os.environ["ARCH"] = ARCH
-    os.environ["CROSS_COMPILE"] = CROSS_COMPILE_PREFIX
-    os.environ["TARGET_SOC"] = TARGET_SOC
-    log_message(f"Set environment variables: ARCH={os.environ['ARCH']}, "
-        f"CROSS_COMPILE={os.environ['CROSS_COMPILE']}, "
-        f"TARGET_SOC={os.environ['TARGET_SOC']}")
+    def __init__(self, build_id: str, key: str, target: str, branch: str, flags: list[str]):
+        self.id = build_id
+        self.key = key
+        self.target = target
+        self.branch = branch
+        self.flags = flags
+        self.state = "queued"
+        self.clients = 1
+        self.worker = None
+        self.commit = None
+        self.dist_dir = None
+        self.log_path = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+
+    def status(self) -> dict:
+        """
+        Returns the build's state and results as sent to clients
+        """
+        artifacts = []
+        if self.state == "succeeded" and self.dist_dir.is_dir():
+            artifacts = sorted(x.name for x in self.dist_dir.iterdir() if x.is_file())
+        return {
+            "id": self.id,
+            "target": self.target,
+            "branch": self.branch,
+            "flags": self.flags,
+            "state": self.state,
+            "clients": self.clients,
+            "worker": self.worker,
+            "commit": self.commit,
+            "queued_seconds": round((self.started or time.time()) - self.submitted, 1),
+            "build_seconds": (round((self.finished or time.time()) - self.started, 1)
+                              if self.started else None),
+            "dist_dir": str(self.dist_dir) if self.dist_dir else None,
+            "log": str(self.log_path) if self.log_path else None,
+            "artifacts": artifacts,
+        }
 
-    for name, config in PREBUILTS_CONFIG.items():
-        if name == "Kernel_Source":
-            target = ROOT_DIR.parent / config["target_dir_name"]
-        else:
-            target = PREBUILTS_BASE_DIR / config["target_dir_name"]
-        # Skip update if requested
-        config["skip_update"] = skip_prebuilt_update
-        get_prebuilt(name, config, target)
-        if name == "Kernel_Source":
-            expected_kernel_path = ROOT_DIR.parent / "exynos-kernel"
-            if target.resolve() != expected_kernel_path.resolve():
-                log_message(f"WARNING: Kernel_Source path mismatch: "
-                    f"'{target.resolve()}' != '{expected_kernel_path.resolve()}'")
-            KERNEL_SOURCE_DIR = target
+class BuildService:
+    """
+    Queues build requests, coalesces identical in-flight requests and runs
+    distinct builds on a fixed pool of workers
 
-    # Set paths to prebuilts
-    TOOLCHAIN_PATH = (
-        PREBUILTS_BASE_DIR /
-        PREBUILTS_CONFIG["Toolchain"]["target_dir_name"] /
-        PREBUILTS_CONFIG["Toolchain"]["bin_path_suffix"]
-    )
-    KERNELBUILD_TOOLS_PATH = (
-        PREBUILTS_BASE_DIR /
-        PREBUILTS_CONFIG["Kernel_Build_Tools"]["target_dir_name"] /
-        PREBUILTS_CONFIG["Kernel_Build_Tools"]["bin_path_suffix"]
-    )
-    GAS_PATH = (
-        PREBUILTS_BASE_DIR /
-        PREBUILTS_CONFIG["GAS"]["target_dir_name"]
-    )
-    MKBOOT_PATH = (
-        PREBUILTS_BASE_DIR /
-        PREBUILTS_CONFIG["Mkbootimg_Tool"]["target_dir_name"]
-    )
-    ANYKERNEL_PATH = (
-        PREBUILTS_BASE_DIR /
-        PREBUILTS_CONFIG["Anykernel3"]["target_dir_name"]
-    )
-    KERNEL_SOURCE_DIR = (
-        ROOT_DIR.parent /
-        PREBUILTS_CONFIG["Kernel_Source"]["target_dir_name"]
-    )
+    Every worker owns a git worktree of the kernel source and an O= tree,
+    so concurrent builds never share output and a worker rebuilds
+    incrementally when it gets the same branch again. Each build runs
+    this script in a child process with its own DIST_DIR under results/
+    """
 
-    log_message("Updating global PATH environment variable...")
-    extra_paths = filter(None, [
-        TOOLCHAIN_PATH,
-        KERNELBUILD_TOOLS_PATH,
-        GAS_PATH,
-        MKBOOT_PATH,
-        ANYKERNEL_PATH,
-        KERNEL_SOURCE_DIR,
-    ])
+    def __init__(self, ctx: BuildContext, parser: argparse.ArgumentParser,
+                 root: Path, workers: int):
+        self.ctx = ctx
+        self.parser = parser
+        # Builds run in the worker trees, so the root must not be relative
+        self.root = root.resolve()
+        self.jobs = max(1, (os.cpu_count() or 1) // workers)
+        self.lock = threading.Lock()
+        self.fetch_lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.builds = {}
+        self.in_flight = {}
+        self.next_id = 1
+        for index in range(workers):
+            threading.Thread(target=self.worker, args=(index,),
+                             name=f"build-worker-{index}", daemon=True).start()
+
+    def get_key(self, target: str, branch: str, flags: list[str]) -> str:
+        """
+        Validates a request and returns the key identical requests share
+
+        Raises:
+            ValueError: If the target, branch or flags are invalid
+        """
+        if not re.fullmatch(r"[\w.-]+", target):
+            raise ValueError(f"invalid target: '{target}'")
+        if not re.fullmatch(r"[\w.][\w./-]*", branch) or ".." in branch:
+            raise ValueError(f"invalid branch: '{branch}'")
+        try:
+            options = self.parser.parse_args(flags)
+        except SystemExit:
+            raise ValueError(f"invalid build flags: {shlex.join(flags)}") from None
+        for name in sorted(BUILD_SERVICE_REJECTED_OPTIONS):
+            if getattr(options, name) != self.parser.get_default(name):
+                raise ValueError(f"option not allowed in build requests: "
+                                 f"--{name.replace('_', '-')}")
+        for name in sorted(BUILD_SERVICE_TREE_PATH_OPTIONS):
+            value = getattr(options, name)
+            if value == self.parser.get_default(name):
+                continue
+            for path in value if isinstance(value, list) else [value]:
+                if path.is_absolute() or ".." in path.parts:
+                    raise ValueError(f"--{name.replace('_', '-')} must be a path inside "
+                                     f"the kernel tree in build requests: '{path}'")
+        # A local cache directory would be written by the service process
+        if options.build_cache and not options.build_cache.startswith(("http://", "https://")):
+            raise ValueError("--build-cache must be an http(s) URL in build requests")
+
+        options = {k: v for k, v in vars(options).items() if k not in BUILD_JOURNAL_IGNORED_OPTIONS}
+        request = json.dumps({"target": target, "branch": branch, "options": options},
+                             sort_keys=True, default=str)
+        return hashlib.sha256(request.encode()).hexdigest()
+
+    def submit(self, target: str, branch: str, flags: list[str]) -> tuple[BuildRequest, bool]:
+        """
+        Queues a build unless an identical one is already queued or running
+
+        Returns:
+            tuple[BuildRequest, bool]: The build and whether the request
+                joined an in-flight build
+
+        Raises:
+            ValueError: If the request is invalid
+        """
+        with self.lock:
+            key = self.get_key(target, branch, flags)
+            build = self.in_flight.get(key)
+            if build:
+                build.clients += 1
+                log_message(f"Build service: request joined build {build.id} "
+                            f"({build.clients} clients)")
+                return build, True
+            build = BuildRequest(f"{self.next_id}-{key[:12]}", key, target, branch, flags)
+            self.next_id += 1
+            self.builds[build.id] = build
+            self.in_flight[key] = build
+        log_message(f"Build service: queued build {build.id}: {target} {branch} {shlex.join(flags)}")
+        self.queue.put(build)
+        return build, False
+
+    def checkout(self, source: Path, branch: str, log_path: Path) -> Optional[str]:
+        """
+        Points a worker's kernel worktree at the tip of branch
+
+        Args:
+            log_path (Path): Build log receiving git's messages and, on
+                failure, the step that failed
+
+        Returns:
+            Optional[str]: Checked out commit, or None on failure
+        """
+        def git(args: list, cwd: Path) -> Optional[str]:
+            output = run_cmd(self.ctx, ["git", *args], cwd=cwd, fatal_on_error=False,
+                             stderr_path=log_path)
+            if output is None:
+                with open(log_path, "a") as f:
+                    f.write(f"ERROR: Checkout of '{branch}' failed: "
+                            f"{shlex.join(['git', *map(str, args)])}\n")
+            return output
+
+        if not (source / ".git").exists():
+            source.parent.mkdir(parents=True, exist_ok=True)
+            if git(["worktree", "add", "--detach", source], self.ctx.kernel_source_dir) is None:
+                return None
+        # Fetches update the shared shallow file, so only one runs at a time
+        with self.fetch_lock:
+            if git(["fetch", "--depth", "1", "origin", branch], source) is None:
+                return None
+        if git(["checkout", "--detach", "--force", "FETCH_HEAD"], source) is None:
+            return None
+        commit = git(["rev-parse", "HEAD"], source)
+        return commit.strip() if commit else None
+
+    def run_build(self, build: BuildRequest, worker_dir: Path) -> bool:
+        """
+        Checks out the requested branch in the worker's tree and builds it
+
+        Returns:
+            bool: True if the build succeeded
+        """
+        result_dir = self.root / "results" / build.id
+        result_dir.mkdir(parents=True, exist_ok=True)
+        build.dist_dir = result_dir / "dist"
+        build.log_path = result_dir / "build.log"
+
+        source = worker_dir / "kernel"
+        build.commit = self.checkout(source, build.branch, build.log_path)
+        if not build.commit:
+            return False
+
+        # Flags come last so a requested -j overrides the worker's share of CPUs.
+        # Relative paths in them resolve in the worker's kernel worktree
+        command = [
+            sys.executable, Path(__file__).resolve(),
+            "-j", str(self.jobs),
+            *build.flags,
+            "--skip-prebuilt-update",
+            "--target-device", build.target,
+            "--kernel-source", source,
+            "--out-dir", worker_dir / "out",
+            "--dist-dir", build.dist_dir,
+        ]
+        return run_cmd(self.ctx, command, cwd=source, fatal_on_error=False,
+                       timeout=BUILD_SERVICE_BUILD_TIMEOUT,
+                       stdout_path=build.log_path) is not None
+
+    def worker(self, index: int):
+        """
+        Runs queued builds one at a time in the worker's own trees
+        """
+        worker_dir = self.root / f"worker-{index}"
+        while True:
+            build = self.queue.get()
+            with self.lock:
+                build.state = "running"
+                build.worker = index
+                build.started = time.time()
+            log_message(f"Build service: worker {index} started build {build.id}")
+            try:
+                succeeded = self.run_build(build, worker_dir)
+            except SystemExit:
+                succeeded = False
+            with self.lock:
+                build.state = "succeeded" if succeeded else "failed"
+                build.finished = time.time()
+                del self.in_flight[build.key]
+            build.done.set()
+            log_message(f"Build service: build {build.id} {build.state} after "
+                        f"{build.finished - build.started:.1f}s")
+
+def serve_builds(ctx: BuildContext, parser: argparse.ArgumentParser,
+                 port: int, workers: int, root: Path):
+    """
+    Serves the build request service over HTTP on localhost
 
-    # Add unique paths to the beginning of the PATH
-    current_path_dirs = os.environ["PATH"].split(os.pathsep)
-    new_path_dirs = []
-    for x in extra_paths:
-        x_str = str(x)
-        if x_str not in current_path_dirs:
-            new_path_dirs.append(x_str)
+    POST /builds with a JSON body {"target", "branch", "flags"} queues a
+    build, or joins an identical queued or running one. GET /builds lists
+    builds, GET /builds/<id> returns one and GET /builds/<id>/<artifact>
+    downloads an artifact. Add ?wait=1 to POST or GET to block until the
+    build has finished
 
-    os.environ["PATH"] = os.pathsep.join(new_path_dirs + current_path_dirs)
-    log_message(f"New PATH: {os.environ['PATH']}")
+    Args:
+        ctx (BuildContext): Context with the kernel source and environment
+        parser (argparse.ArgumentParser): Parser validating request flags
+        port (int): Localhost port to listen on
+        workers (int): Number of builds run at once
+        root (Path): Directory for worker trees and build results
+    """
+    service = BuildService(ctx, parser, root, workers)
+    default_branch = ctx.prebuilts_config["Kernel_Source"]["branch"]
+    build_re = re.compile(r"^/builds/([\w-]+)(?:/([^/]+))?$")
+
+    class BuildRequestHandler(http.server.BaseHTTPRequestHandler):
+        def send_json(self, code: int, data):
+            body = json.dumps(data, indent=2).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def wait_requested(self, url) -> bool:
+            return urllib.parse.parse_qs(url.query).get("wait", ["0"])[0] not in ("0", "")
+
+        def do_POST(self):
+            url = urllib.parse.urlparse(self.path)
+            if url.path != "/builds":
+                self.send_error(404)
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                if not isinstance(request, dict):
+                    raise ValueError("expected a JSON object")
+                target = request.get("target", ctx.target_device)
+                branch = request.get("branch", default_branch)
+                flags = request.get("flags", [])
+                if (not isinstance(target, str) or not isinstance(branch, str) or
+                        not isinstance(flags, list) or
+                        not all(isinstance(x, str) for x in flags)):
+                    raise ValueError("expected target and branch strings and a list of flags")
+                build, coalesced = service.submit(target, branch, flags)
+            except ValueError as e:
+                self.send_json(400, {"error": str(e)})
+                return
+            if self.wait_requested(url):
+                build.done.wait()
+            self.send_json(200 if build.done.is_set() else 202,
+                           {**build.status(), "coalesced": coalesced})
+
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            if url.path == "/builds":
+                with service.lock:
+                    builds = list(service.builds.values())
+                self.send_json(200, [x.status() for x in builds])
+                return
+            match = build_re.match(url.path)
+            build = service.builds.get(match.group(1)) if match else None
+            if not build:
+                self.send_error(404)
+                return
+            if self.wait_requested(url):
+                build.done.wait()
+            if not match.group(2):
+                self.send_json(200, build.status())
+                return
 
-    log_message("Environment setup complete")
+            if build.state != "succeeded" or match.group(2) not in build.status()["artifacts"]:
+                self.send_error(404)
+                return
+            artifact = build.dist_dir / match.group(2)
+            self.send_response(200)
+            self.send_header("Content-Length", str(artifact.stat().st_size))
+            self.end_headers()
+            with open(artifact, "rb") as f:
+                shutil.copyfileobj(f, self.wfile)
+
+        def log_message(self, format, *args):
+            log_message(f"build service: {format % args}")
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), BuildRequestHandler)
+    log_message(f"Serving build requests on 127.0.0.1:{port} with {workers} workers, "
+                f"results in '{root}'")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        # Stop running builds instead of leaving orphaned children behind
+        get_engine().abort().result()
 
-def main():
+def get_arg_parser() -> argparse.ArgumentParser:
     """
-    Main entry point: parses arguments and runs the build process
+    Returns the command line parser, also used to validate the build
+    options of build service requests
     """
     parser = argparse.ArgumentParser(
         description="Android kernel build script",
@@ -1077,10 +6266,22 @@ def main():
                     Clean and build with all cores
 
                 ./build_kernel.py --build-all
-                    Run full build: dtbo, boot, vendor_boot, dlkm, and sign images
+                    Run full build: dtbo, boot, vendor_boot, dlkm, compressed Image, and sign images
 
                 ./build_kernel.py --clean --build-all
                     Clean and perform full build with default job count
+
+                ./build_kernel.py --modules-only blk-sec-wb.ko --sign-images
+                    Rebuild one module and repack only the images containing it
+
+                ./build_kernel.py --write-synthetic-profile synthetic.afdo
+                ./build_kernel.py --profile synthetic.afdo
+                    Exercise the AutoFDO pipeline with a profile of the last build
+
+                ./build_kernel.py --serve-builds
+                curl -d '{"branch": "glowingkernel", "flags": ["--build-all"]}' \\
+                    'http://127.0.0.1:8788/builds?wait=1'
+                    Queue a build on the local build service and wait for its result
         """),
         formatter_class=argparse.RawDescriptionHelpFormatter
     )
@@ -1157,10 +6358,418 @@ def main():
     parser.add_argument(
         "--build-all",
         action="store_true",
-        help="Enable all build options (dtbo, boot, vendor boot, dlkm, sign)"
+        help="Enable all build options (dtbo, boot, vendor boot, dlkm, Image.gz/lz4, sign)"
+    )
+
+    parser.add_argument(
+        "--config-fragment",
+        action="append",
+        type=Path,
+        default=[],
+        metavar="PATH",
+        help="Merge a config fragment over the defconfig (can be repeated)"
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue a failed build from the first incomplete stage, "
+             "after checking that earlier stage outputs are intact"
+    )
+
+    parser.add_argument(
+        "--lto",
+        choices=list(LTO_CONFIG_FRAGMENTS),
+        help="Select the Clang LTO mode over the defconfig's choice"
+    )
+
+    parser.add_argument(
+        "--thinlto-cache",
+        type=Path,
+        default=THINLTO_CACHE_DIR,
+        metavar="DIR",
+        help=f"Persistent ThinLTO cache used with --lto thin (default: {THINLTO_CACHE_DIR})"
+    )
+
+    parser.add_argument(
+        "--thinlto-cache-max-size",
+        type=float,
+        default=THINLTO_CACHE_DEFAULT_MAX_SIZE_GB,
+        metavar="GB",
+        help=f"Prune the ThinLTO cache to this size after each build "
+             f"(default: {THINLTO_CACHE_DEFAULT_MAX_SIZE_GB})"
+    )
+
+    parser.add_argument(
+        "--profile",
+        type=Path,
+        metavar="PATH",
+        help="Optimize the compile with an AutoFDO sample profile or an indexed "
+             "PGO profile (.profdata) and report its coverage of the built kernel"
+    )
+
+    parser.add_argument(
+        "--write-synthetic-profile",
+        type=Path,
+        metavar="PATH",
+        help=f"Write a text AutoFDO profile of {PROFILE_SYNTHETIC_FUNCTIONS} functions "
+             f"of the built vmlinux to PATH and exit, for testing --profile"
+    )
+
+    parser.add_argument(
+        "--trim-unpackaged-modules",
+        action="store_true",
+        help="Write a config fragment disabling modules that are built but "
+             "not packaged in any image, report the savings and exit "
+             "(needs a previous build with installed modules)"
+    )
+
+    parser.add_argument(
+        "--trim-fragment",
+        type=Path,
+        metavar="PATH",
+        help=f"Fragment written by --trim-unpackaged-modules "
+             f"(default: {CONFIG_TRIM_DIR}/unpackaged_modules_<target>.config)"
+    )
+
+    parser.add_argument(
+        "--benchmark-config-trim",
+        action="store_true",
+        help="With --trim-unpackaged-modules, also time from-scratch builds "
+             "with and without the fragment"
+    )
+
+    parser.add_argument(
+        "--modules-only",
+        nargs="*",
+        metavar="NAME",
+        help="Rebuild only the named modules (all if none given) and "
+             "update the images containing them"
+    )
+
+    parser.add_argument(
+        "--build-cache",
+        metavar="DIR|URL",
+        help="Restore Image, dtbs and modules from a build artifact cache "
+             "(local directory or http:// server) and store new builds in it"
+    )
+
+    parser.add_argument(
+        "--build-cache-max-size",
+        type=float,
+        default=BUILD_CACHE_DEFAULT_MAX_SIZE_GB,
+        metavar="GB",
+        help=f"Size limit of a local or served build cache "
+             f"(default: {BUILD_CACHE_DEFAULT_MAX_SIZE_GB:g})"
+    )
+
+    parser.add_argument(
+        "--serve-build-cache",
+        type=Path,
+        metavar="DIR",
+        help="Serve DIR as a build artifact cache over HTTP and exit on Ctrl-C"
+    )
+
+    parser.add_argument(
+        "--build-cache-port",
+        type=int,
+        default=BUILD_CACHE_DEFAULT_PORT,
+        help=f"Port for --serve-build-cache (default: {BUILD_CACHE_DEFAULT_PORT})"
+    )
+
+    parser.add_argument(
+        "--build-cache-bind",
+        default=BUILD_CACHE_DEFAULT_BIND,
+        metavar="ADDR",
+        help=f"Address for --serve-build-cache (default: {BUILD_CACHE_DEFAULT_BIND}); "
+             f"other addresses need a shared token in {BUILD_CACHE_TOKEN_ENV}, which "
+             f"clients set too"
+    )
+
+    parser.add_argument(
+        "--reproducible",
+        action="store_true",
+        help="Produce bit-identical outputs using SOURCE_DATE_EPOCH "
+             "(defaults to the kernel commit time)"
+    )
+
+    parser.add_argument(
+        "--verify-reproducible",
+        action="store_true",
+        help="Build twice in reproducible mode and compare DIST_DIR hashes"
+    )
+
+    parser.add_argument(
+        "--zip-compression",
+        action="append",
+        default=[],
+        metavar="PATTERN=METHOD[:LEVEL]",
+        help="Override flash ZIP compression for matching entries, "
+             "METHOD is 'stored' or 'deflated' (e.g. 'Image=deflated:6')"
+    )
+
+    parser.add_argument(
+        "--image-compression",
+        action="append",
+        choices=KERNEL_IMAGE_CODECS,
+        default=[],
+        help="Also produce a compressed Image variant (can be repeated)"
+    )
+
+    parser.add_argument(
+        "--kernel-image",
+        choices=["Image"] + [f"Image.{x}" for x in KERNEL_IMAGE_CODECS],
+        default="Image",
+        help="Image variant embedded in boot.img and the flashable ZIP (default: Image)"
+    )
+
+    parser.add_argument(
+        "--compare-mkbootimg",
+        action="store_true",
+        help="Also build boot.img and vendor_boot.img with mkbootimg.py and "
+             "fail unless the native images are byte for byte identical"
     )
 
+    parser.add_argument(
+        "--verify-boot-image",
+        type=Path,
+        metavar="PATH",
+        help="Check the layout of a boot or vendor_boot v4 image, print its "
+             "sections and exit"
+    )
+
+    parser.add_argument(
+        "--track-sizes",
+        action="store_true",
+        help="Record Image, vmlinux section, symbol, module and image sizes, "
+             "diff them against the previous build and enforce size budgets"
+    )
+
+    parser.add_argument(
+        "--size-baseline",
+        metavar="NAME",
+        help="Diff sizes against a saved baseline instead of the previous build"
+    )
+
+    parser.add_argument(
+        "--save-size-baseline",
+        metavar="NAME",
+        help="Also save this build's sizes as a named baseline"
+    )
+
+    parser.add_argument(
+        "--size-budgets",
+        type=Path,
+        default=SIZE_BUDGETS_FILE,
+        metavar="PATH",
+        help=f"JSON size budgets: {{\"max_size\": {{pattern: bytes}}, "
+             f"\"max_growth\": {{pattern: bytes}}}} over metric names such as "
+             f"'dist:Image' or 'module:*' (default: {SIZE_BUDGETS_FILE.name}, if present)"
+    )
+
+    parser.add_argument(
+        "--archive-artifacts",
+        action="store_true",
+        help="Archive DIST_DIR in the deduplicated artifact store as the last stage"
+    )
+
+    parser.add_argument(
+        "--artifact-store",
+        type=Path,
+        default=ARTIFACT_STORE_DIR,
+        metavar="PATH",
+        help=f"Artifact store directory (default: {ARTIFACT_STORE_DIR})"
+    )
+
+    parser.add_argument(
+        "--list-artifacts",
+        action="store_true",
+        help="List the archived builds of the target device and exit"
+    )
+
+    parser.add_argument(
+        "--restore-artifacts",
+        metavar="BUILD_ID",
+        help="Replace DIST_DIR with an archived build ('latest' for the newest) and exit"
+    )
+
+    parser.add_argument(
+        "--strict-module-deps",
+        action="store_true",
+        help="Fail when a packaged module depends on a module no partition "
+             "mounted as early packages (reported as warnings otherwise)"
+    )
+
+    parser.add_argument(
+        "--skip-module-preflight",
+        action="store_true",
+        help="Do not check module lists against .config before compiling"
+    )
+
+    parser.add_argument(
+        "--optimize-module-order",
+        action="store_true",
+        help="Write modules.load in dependency order (early modules first) and "
+             "emit parallel load levels next to each module image"
+    )
+
+    parser.add_argument(
+        "--benchmark-compression",
+        action="store_true",
+        help="Benchmark ramdisk and EROFS compression settings and write "
+             "the selected ones to the compression profile"
+    )
+
+    parser.add_argument(
+        "--compression-profile",
+        type=Path,
+        default=COMPRESSION_PROFILE_FILE,
+        metavar="PATH",
+        help=f"Compression profile read by the build and written by "
+             f"--benchmark-compression (default: {COMPRESSION_PROFILE_FILE})"
+    )
+
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Stay resident, watch the kernel source and incrementally "
+             "rebuild and repack on every change"
+    )
+
+    parser.add_argument(
+        "--ram-build",
+        action="store_true",
+        help="Build OUT_DIR and staging areas on tmpfs when enough memory is free, "
+             "falling back to disk under memory pressure; only DIST_DIR is written to disk"
+    )
+    parser.add_argument(
+        "--ram-build-min-free",
+        type=float,
+        default=RAM_BUILD_DEFAULT_MIN_FREE_GB,
+        metavar="GB",
+        help=f"Free memory required for --ram-build (default: {RAM_BUILD_DEFAULT_MIN_FREE_GB})"
+    )
+    parser.add_argument(
+        "--benchmark-ram-build",
+        action="store_true",
+        help="Time a from-scratch build on disk and on tmpfs and exit"
+    )
+    parser.add_argument(
+        "--max-parallel-commands",
+        type=int,
+        default=MAX_PARALLEL_COMMANDS,
+        metavar="N",
+        help=f"Maximum number of external tools running at once "
+             f"(default: {MAX_PARALLEL_COMMANDS})"
+    )
+    parser.add_argument(
+        "--watch-debounce",
+        type=float,
+        default=WATCH_DEFAULT_DEBOUNCE,
+        metavar="SECONDS",
+        help=f"Quiet time after the last edit before rebuilding "
+             f"(default: {WATCH_DEFAULT_DEBOUNCE})"
+    )
+
+    parser.add_argument(
+        "--target-device",
+        default=TARGET_DEVICE,
+        metavar="NAME",
+        help=f"Device whose DTBOs are packaged and named in the flashable ZIP "
+             f"(default: {TARGET_DEVICE})"
+    )
+    parser.add_argument(
+        "--kernel-source",
+        type=Path,
+        metavar="DIR",
+        help="Build this kernel tree instead of the Kernel_Source prebuilt checkout"
+    )
+    parser.add_argument(
+        "--out-dir",
+        type=Path,
+        metavar="DIR",
+        help="Kernel output (O=) directory (default: <kernel source>/out)"
+    )
+    parser.add_argument(
+        "--dist-dir",
+        type=Path,
+        metavar="DIR",
+        help="Directory receiving the build artifacts (default: ../out/dist)"
+    )
+
+    parser.add_argument(
+        "--serve-builds",
+        action="store_true",
+        help="Run the local build request service and exit on Ctrl-C"
+    )
+    parser.add_argument(
+        "--build-service-port",
+        type=int,
+        default=BUILD_SERVICE_DEFAULT_PORT,
+        help=f"Localhost port for --serve-builds (default: {BUILD_SERVICE_DEFAULT_PORT})"
+    )
+    parser.add_argument(
+        "--build-workers",
+        type=int,
+        default=BUILD_SERVICE_DEFAULT_WORKERS,
+        metavar="N",
+        help=f"Builds run at once by --serve-builds (default: {BUILD_SERVICE_DEFAULT_WORKERS})"
+    )
+    parser.add_argument(
+        "--build-service-dir",
+        type=Path,
+        default=BUILD_SERVICE_DIR,
+        metavar="DIR",
+        help=f"Worker trees and build results of --serve-builds (default: {BUILD_SERVICE_DIR})"
+    )
+
+    return parser
+
+def main():
+    """
+    Main entry point: parses arguments and runs the build process
+    """
+    global MAX_PARALLEL_COMMANDS
+
+    parser = get_arg_parser()
     args = parser.parse_args()
+
+    # Image checks do not need prebuilts or a kernel tree either
+    if args.verify_boot_image:
+        path = args.verify_boot_image.resolve()
+        if not verify_boot_image(path):
+            sys.exit(1)
+        for name, (offset, size) in parse_boot_image(path)["sections"].items():
+            log_message(f"  {name:<20} offset {offset:#010x} size {size}")
+        return
+
+    # Cache server mode does not need prebuilts or a kernel tree
+    if args.serve_build_cache:
+        serve_build_cache(args.serve_build_cache, args.build_cache_port,
+                          args.build_cache_max_size, args.build_cache_bind,
+                          os.environ.get(BUILD_CACHE_TOKEN_ENV) or None)
+        return
+
+    ctx = BuildContext(target_device=args.target_device)
+    ctx.compression_profile_file = args.compression_profile.resolve()
+    if args.out_dir:
+        set_out_dir(ctx, args.out_dir.resolve())
+    if args.dist_dir:
+        ctx.dist_dir = args.dist_dir.resolve()
+    MAX_PARALLEL_COMMANDS = max(1, args.max_parallel_commands)
+
+    # Archived builds are restored without building
+    if args.list_artifacts:
+        list_artifacts(ctx, args.artifact_store.resolve())
+        return
+    if args.restore_artifacts:
+        restore_artifacts(ctx, args.artifact_store.resolve(), args.restore_artifacts)
+        return
+
+    # The benchmark needs installed modules and a vendor_ramdisk_dlkm to work on
+    if args.benchmark_compression:
+        args.build_vendor_ramdisk_dlkm = True
+
     # Full build and sign with --build-all
     if args.build_all:
         log_message("All build options enabled")
@@ -1172,116 +6781,82 @@ def main():
         args.build_vendor_boot_image = True
         args.build_dlkm_image = True
         args.sign_images = True
+        args.image_compression += ["gz", "lz4"]
 
     log_message("Starting Android kernel build process...")
 
     try:
         # Setup environment and validate prebuilts
-        setup_environment(skip_prebuilt_update=args.skip_prebuilt_update)
-        validate_prebuilts()
-
-        if args.clean:
-            clean_build_artifacts()
-
-        # Determine whether to install kernel modules
-        install_modules = (
-            args.build_vendor_ramdisk_dlkm or
-            args.build_vendor_boot_image or
-            args.build_dlkm_image
-        )
-
-        # Clean dist output from previous build
-        if DIST_DIR.exists():
-            log_message(f"Cleaning DIST_DIR: {DIST_DIR}")
-            shutil.rmtree(DIST_DIR, ignore_errors=True)
-
-        # Build kernel Image
-        # If --extra-local-version is enabled, inject BRANCH and KMI_GENERATION
-        # from build config files into the environment for setlocalversion
-        if args.extra_local_version:
-            version_env = get_version_env()
-            log_message(f"Using local version env: BRANCH={version_env['BRANCH']}, KMI_GENERATION={version_env['KMI_GENERATION']}")
-            build_kernel(args.jobs, version_env, install_modules=install_modules)
-        else:
-            build_kernel(args.jobs, install_modules=install_modules)
+        setup_environment(ctx, skip_prebuilt_update=args.skip_prebuilt_update)
+        if args.kernel_source:
+            ctx.kernel_source_dir = args.kernel_source.resolve()
+        validate_prebuilts(ctx)
+
+        if args.serve_builds:
+            serve_builds(ctx, parser, args.build_service_port,
+                         max(1, args.build_workers), args.build_service_dir.resolve())
+            return
 
-        # Flashable ZIP
-        if args.flashable_zip:
-            create_flash_zip()
+        if args.reproducible or args.verify_reproducible:
+            enable_reproducible_mode(ctx)
 
-        # If user explicitly asked for dtbo images only
-        if args.create_dtbo_images or args.build_vendor_boot_image:
-            build_dtbo_images()
+        if args.write_synthetic_profile:
+            write_synthetic_profile(ctx, args.write_synthetic_profile.resolve(),
+                                    PROFILE_SYNTHETIC_FUNCTIONS)
+            return
+        if args.profile:
+            load_profile(ctx, args.profile.resolve())
+            set_profile_link_flags(ctx, args.lto or get_config_lto_mode(
+                ctx, [x.resolve() for x in args.config_fragment]))
+
+        # Fail on bad baseline names before building, not after
+        for name in (args.size_baseline, args.save_size_baseline):
+            if name:
+                check_size_baseline_name(name)
+
+        if args.trim_unpackaged_modules:
+            fragment = (args.trim_fragment.resolve() if args.trim_fragment else
+                        CONFIG_TRIM_DIR / f"unpackaged_modules_{ctx.target_device}.config")
+            write_trim_fragment(ctx, [x.resolve() for x in args.config_fragment], fragment)
+            if args.benchmark_config_trim:
+                benchmark_config_trim(ctx, args, fragment)
+            return
 
-        if args.create_boot_image:
-            build_boot_image()
+        ram_min_free = int(args.ram_build_min_free * 1024 ** 3)
+        if args.benchmark_ram_build:
+            benchmark_ram_build(ctx, args, ram_min_free)
+            return
+        if args.ram_build:
+            enable_ram_build(ctx, ram_min_free)
 
-        # If user explicitly asked for vendor_ramdisk_dlkm only (not via vendor_boot)
-        if args.build_vendor_ramdisk_dlkm and not args.build_vendor_boot_image:
-            mk_vendor_rd_dlkm(
-                mount_prefix="",
-                module_early_list_file=VENDOR_RAMDISK_DLKM_EARLY_MODULES_FILE,
-                module_list_file=VENDOR_RAMDISK_DLKM_MODULES_FILE
-            )
+        # Fast path: rebuild selected modules and repack affected images only
+        if args.modules_only is not None:
+            if args.clean:
+                log_message("ERROR: --modules-only cannot be combined with --clean")
+                sys.exit(1)
+            run_modules_only_stages(ctx, args, args.modules_only)
+            log_message("Module-only build completed successfully.")
+            return
 
-        # Build vendor_boot.img
-        if args.build_vendor_boot_image:
-            if not args.create_dtbo_images:
-                log_message("Auto-enabling --create-dtbo-images (required for vendor_boot.img)")
-                args.create_dtbo_images = True
-            if not args.build_vendor_ramdisk_dlkm:
-                log_message("Auto-enabling --build-vendor-ramdisk-dlkm (required for vendor_boot.img)")
-                args.build_vendor_ramdisk_dlkm = True
-
-            # Build dtbo image
-            build_dtbo_images()
-
-            # Build vendor_ramdisk_dlkm
-            mk_vendor_rd_dlkm(
-                mount_prefix="",
-                module_early_list_file=VENDOR_RAMDISK_DLKM_EARLY_MODULES_FILE,
-                module_list_file=VENDOR_RAMDISK_DLKM_MODULES_FILE
-            )
-            build_vendorboot_image()
+        if args.clean:
+            clean_build_artifacts(ctx)
 
-        # Build system_dlkm and vendor_dlkm images if needed
-        if args.build_dlkm_image:
-            build_dlkm_image(
-                image_name="system_dlkm",
-                modules_list_file=None,
-                mount_prefix="/system_dlkm",
-                sign_modules=True,
-            )
-            build_dlkm_image(
-                image_name="vendor_dlkm",
-                modules_list_file=VENDOR_DLKM_MODULES_FILE,
-                mount_prefix="/vendor_dlkm",
-                sign_modules=False,
-            )
+        if args.watch:
+            watch_and_rebuild(ctx, args)
+            return
 
-        # Sign images if requested
-        if args.sign_images:
-            images = [
-                ("dtbo", DIST_DIR / "dtbo.img", args.create_dtbo_images),
-                ("boot", DIST_DIR / "boot.img", args.create_boot_image),
-                ("system_dlkm", DIST_DIR / "system_dlkm.img", args.build_dlkm_image),
-                ("vendor_dlkm", DIST_DIR / "vendor_dlkm.img", args.build_dlkm_image),
-                ("vendor_boot", DIST_DIR / "vendor_boot.img", args.build_vendor_boot_image),
-            ]
+        build_cache = None
+        if args.build_cache:
+            build_cache = open_build_cache(args.build_cache, args.build_cache_max_size)
 
-            signed_any = False
-            for name, path, requested in images:
-                if path.exists():
-                    if requested:
-                        sign_partition_image(path, name)
-                        signed_any = True
-                    else:
-                        log_message(f"SKIP: {name}.img exists but not requested")
-                elif requested:
-                    log_message(f"MISS: {name}.img requested but not built")
+        run_build_stages(ctx, args, build_cache)
 
-            if not signed_any:
-                log_message("ERROR: --sign-images given but no image found to sign")
+        # Rebuild into a fresh DIST_DIR and compare every artifact
+        if args.verify_reproducible:
+            first_hashes = hash_dist_dir(ctx)
+            log_message("Rebuilding to verify reproducibility...")
+            run_build_stages(ctx, args, build_cache)
+            if not compare_dist_hashes(first_hashes, hash_dist_dir(ctx)):
                 sys.exit(1)
 
     except SystemExit:
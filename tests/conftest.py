@@ -0,0 +1,26 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import build_kernel  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def build_log(tmp_path, monkeypatch):
+    """Keeps the build log of every test out of the repository"""
+    monkeypatch.setattr(build_kernel, "BUILD_LOG_FILE", tmp_path / "kernel_build.log")
+
+
+@pytest.fixture
+def ctx(tmp_path):
+    """Build context with OUT_DIR, DIST_DIR and staging dirs under tmp_path"""
+    ctx = build_kernel.BuildContext(target_device="test",
+                                    out_dir=tmp_path / "out",
+                                    dist_dir=tmp_path / "dist")
+    ctx.temp_dir = tmp_path / "tmp"
+    for path in (ctx.out_dir, ctx.dist_dir, ctx.temp_dir):
+        path.mkdir()
+    return ctx
@@ -0,0 +1,84 @@
+import os
+import random
+
+import build_kernel
+from build_kernel import ArtifactStore, get_chunk_boundaries
+
+
+def random_bytes(size, seed=0):
+    return random.Random(seed).randbytes(size)
+
+
+def test_chunk_boundaries_within_bounds():
+    data = random_bytes(4 << 20)
+    boundaries = get_chunk_boundaries(data)
+    assert boundaries[-1] == len(data)
+    sizes = [b - a for a, b in zip([0] + boundaries, boundaries)]
+    assert all(x <= build_kernel.ARTIFACT_CHUNK_MAX for x in sizes)
+    assert all(x >= build_kernel.ARTIFACT_CHUNK_MIN for x in sizes[:-1])
+
+
+def test_chunk_boundaries_realign_after_insertion():
+    data = random_bytes(4 << 20)
+    edited = data[:1000] + b"inserted" + data[1000:]
+    before = set(get_chunk_boundaries(data)[2:])
+    after = {x - len(b"inserted") for x in get_chunk_boundaries(edited)}
+    assert before <= after
+
+
+def test_padding_is_cut_at_max():
+    data = bytes(3 * build_kernel.ARTIFACT_CHUNK_MAX)
+    assert get_chunk_boundaries(data) == [build_kernel.ARTIFACT_CHUNK_MAX * i for i in (1, 2, 3)]
+
+
+def test_store_and_restore(tmp_path):
+    source = tmp_path / "dist"
+    source.mkdir()
+    (source / "boot.img").write_bytes(random_bytes(1 << 20, seed=1))
+    (source / "dtbo.img").write_bytes(random_bytes(100, seed=2))
+    os.chmod(source / "dtbo.img", 0o600)
+
+    store = ArtifactStore(tmp_path / "store", "test")
+    first = store.store(source, "build-1", {"commit": "abc"})
+    assert first["stored"]["chunks"] > 0
+    second = store.store(source, "build-2", {"commit": "abc"})
+    assert second["stored"]["chunks"] == 0
+    assert store.builds() == ["build-1", "build-2"]
+
+    dest = tmp_path / "restored"
+    store.restore(store.load("latest"), dest)
+    for name in ("boot.img", "dtbo.img"):
+        assert (dest / name).read_bytes() == (source / name).read_bytes()
+    assert (dest / "dtbo.img").stat().st_mode & 0o777 == 0o600
+
+
+def test_prune_keeps_referenced_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(build_kernel, "ARTIFACT_CHUNK_GRACE", -1)
+    source = tmp_path / "dist"
+    source.mkdir()
+    store = ArtifactStore(tmp_path / "store", "test")
+    (source / "boot.img").write_bytes(random_bytes(1 << 20, seed=1))
+    store.store(source, "build-1", {})
+    (source / "boot.img").write_bytes(random_bytes(1 << 20, seed=2))
+    store.store(source, "build-2", {})
+
+    assert store.prune(1) > 0
+    assert store.builds() == ["build-2"]
+    dest = tmp_path / "restored"
+    store.restore(store.load("build-2"), dest)
+    assert (dest / "boot.img").read_bytes() == (source / "boot.img").read_bytes()
+
+
+def test_put_chunk_rewrites_chunk_pruned_concurrently(tmp_path, monkeypatch):
+    store = ArtifactStore(tmp_path / "store", "test")
+    data = random_bytes(1000)
+    digest, _ = store.put_chunk(data)
+    utime = os.utime
+
+    def pruned_utime(path, *args, **kwargs):
+        os.unlink(path)
+        return utime(path, *args, **kwargs)
+
+    monkeypatch.setattr(build_kernel.os, "utime", pruned_utime)
+    assert store.put_chunk(data)[1] > 0
+    assert store.read_chunk(digest) == data
@@ -0,0 +1,78 @@
+import os
+
+import pytest
+
+from build_kernel import (parse_boot_image, verify_boot_image, write_boot_image,
+                          write_vendor_boot_image)
+
+
+@pytest.fixture
+def sources(tmp_path):
+    files = {
+        "kernel": os.urandom(10000),
+        "platform": os.urandom(3000),
+        "dlkm": os.urandom(5000),
+        "dtb": os.urandom(700),
+        "bootconfig": b"androidboot.hardware=test\n",
+    }
+    for name, data in files.items():
+        (tmp_path / name).write_bytes(data)
+    return {name: tmp_path / name for name in files}
+
+
+def read_section(path, layout, name):
+    offset, size = layout["sections"][name]
+    with open(path, "rb") as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+def test_boot_image_round_trip(tmp_path, sources):
+    image = tmp_path / "boot.img"
+    write_boot_image(image, sources["kernel"], cmdline="console=ttyMSM0")
+    layout = parse_boot_image(image)
+    assert layout["kind"] == "boot"
+    assert layout["header"]["cmdline"] == "console=ttyMSM0"
+    assert layout["size"] == image.stat().st_size
+    assert read_section(image, layout, "kernel") == sources["kernel"].read_bytes()
+    assert verify_boot_image(image, {"kernel": sources["kernel"]})
+
+
+def test_vendor_boot_image_round_trip(tmp_path, sources):
+    image = tmp_path / "vendor_boot.img"
+    write_vendor_boot_image(
+        image,
+        [("", "platform", sources["platform"]), ("dlkm", "dlkm", sources["dlkm"])],
+        sources["dtb"], sources["bootconfig"], vendor_cmdline="quiet", board="test")
+    layout = parse_boot_image(image)
+    assert layout["kind"] == "vendor_boot"
+    assert layout["header"]["board"] == "test"
+    assert layout["size"] == image.stat().st_size
+    for name, source in (("ramdisk:", "platform"), ("ramdisk:dlkm", "dlkm"),
+                         ("dtb", "dtb"), ("bootconfig", "bootconfig")):
+        assert read_section(image, layout, name) == sources[source].read_bytes()
+    assert verify_boot_image(image, {"ramdisk:dlkm": sources["dlkm"], "dtb": sources["dtb"]})
+
+
+def test_verify_detects_corruption(tmp_path, sources):
+    image = tmp_path / "boot.img"
+    write_boot_image(image, sources["kernel"])
+    offset, size = parse_boot_image(image)["sections"]["kernel"]
+    with open(image, "r+b") as f:
+        f.seek(offset + size)
+        f.write(b"\1")
+    assert not verify_boot_image(image)
+
+    write_boot_image(image, sources["kernel"])
+    with open(image, "r+b") as f:
+        f.seek(offset)
+        f.write(b"\0" * 16)
+    assert not verify_boot_image(image, {"kernel": sources["kernel"]})
+
+
+def test_truncated_image_is_rejected(tmp_path, sources):
+    image = tmp_path / "boot.img"
+    write_boot_image(image, sources["kernel"])
+    os.truncate(image, image.stat().st_size - 1)
+    with pytest.raises(ValueError, match="truncated"):
+        parse_boot_image(image)
@@ -0,0 +1,150 @@
+import shutil
+import subprocess
+import tarfile
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+import build_kernel
+
+KEY = "ab" * 32
+
+
+@pytest.fixture
+def entry(tmp_path):
+    path = tmp_path / "entry.tar.gz"
+    path.write_bytes(b"cache entry" * 1000)
+    return path
+
+
+def serve(tmp_path, token=None):
+    server = build_kernel.create_build_cache_server(tmp_path / "served", 0, 1.0, token=token)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def test_local_backend_round_trip(tmp_path, entry):
+    backend = build_kernel.LocalCacheBackend(tmp_path / "cache", 1 << 20)
+    assert not backend.get(KEY, tmp_path / "out")
+    backend.put(KEY, entry)
+    assert backend.get(KEY, tmp_path / "out")
+    assert (tmp_path / "out").read_bytes() == entry.read_bytes()
+
+
+def test_local_backend_checks_digest(tmp_path, entry):
+    backend = build_kernel.LocalCacheBackend(tmp_path / "cache", 1 << 20)
+    backend.put(KEY, entry)
+    backend.entry_path(KEY).write_bytes(b"corrupted")
+    assert not backend.get(KEY, tmp_path / "out")
+
+    # Entries without a digest are misses too
+    backend.put(KEY, entry)
+    backend.digest_path(KEY).unlink()
+    assert not backend.get(KEY, tmp_path / "out")
+
+
+def test_restored_out_dir_refuses_compiled_tree_stages(ctx, tmp_path):
+    boot_dir = ctx.out_dir / "arch" / ctx.arch / "boot"
+    boot_dir.mkdir(parents=True)
+    (boot_dir / "Image").write_bytes(b"Image")
+    (ctx.out_dir / "modules.order").write_text("drivers/foo.o\n")
+    install_dir = ctx.modules_staging_dir / "lib" / "modules" / "6.1.0"
+    install_dir.mkdir(parents=True)
+    (install_dir / "modules.order").write_text("kernel/drivers/foo.ko\n")
+    backend = build_kernel.LocalCacheBackend(tmp_path / "cache", 1 << 20)
+    build_kernel.store_build_cache(ctx, backend, KEY)
+
+    shutil.rmtree(ctx.out_dir)
+    ctx.out_dir.mkdir()
+    assert build_kernel.restore_build_cache(ctx, backend, KEY)
+    assert (boot_dir / "Image").read_bytes() == b"Image"
+    assert (ctx.out_dir / "modules.order").is_file()
+    assert (install_dir / "modules.order").is_file()
+    assert build_kernel.is_out_dir_restored(ctx)
+    with pytest.raises(SystemExit):
+        build_kernel.check_out_dir_compiled(ctx, "--modules-only")
+
+
+def test_local_backend_evicts_oldest(tmp_path, entry):
+    backend = build_kernel.LocalCacheBackend(tmp_path / "cache", entry.stat().st_size)
+    backend.put(KEY, entry)
+    backend.put("cd" * 32, entry)
+    assert not backend.entry_path(KEY).exists()
+    assert backend.entry_path("cd" * 32).exists()
+
+
+def test_http_round_trip(tmp_path, entry):
+    server, url = serve(tmp_path)
+    try:
+        backend = build_kernel.HttpCacheBackend(url)
+        assert not backend.get(KEY, tmp_path / "out")
+        backend.put(KEY, entry)
+        assert backend.get(KEY, tmp_path / "out")
+        assert (tmp_path / "out").read_bytes() == entry.read_bytes()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_http_token_and_signature(tmp_path, entry):
+    server, url = serve(tmp_path, token="secret")
+    try:
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(f"{url}/{KEY}.tar.gz", timeout=10)
+        assert error.value.code == 401
+
+        backend = build_kernel.HttpCacheBackend(url, "secret")
+        backend.put(KEY, entry)
+        assert backend.get(KEY, tmp_path / "out")
+
+        # Entries replaced on the server without the token's signature are misses
+        served = tmp_path / "served" / f"{KEY}.tar.gz"
+        served.write_bytes(b"poisoned")
+        assert not backend.get(KEY, tmp_path / "out")
+
+        # Unsigned uploads are rejected
+        build_kernel.HttpCacheBackend(url, "other").put("cd" * 32, entry)
+        assert not (tmp_path / "served" / f"{'cd' * 32}.tar.gz").exists()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_wide_bind_needs_token(tmp_path):
+    with pytest.raises(SystemExit):
+        build_kernel.create_build_cache_server(tmp_path, 0, 1.0, bind="0.0.0.0")
+
+
+def test_signing_key_not_cached(ctx):
+    (ctx.out_dir / "certs").mkdir()
+    for name in ("signing_key.pem", "signing_key.x509"):
+        (ctx.out_dir / "certs" / name).write_bytes(b"key")
+    names = [x.name for x in build_kernel.get_build_cache_files(ctx)]
+    assert "signing_key.x509" in names
+    assert "signing_key.pem" not in names
+
+
+@pytest.mark.skipif(not shutil.which("openssl"), reason="needs openssl")
+def test_restore_requires_matching_signing_key(ctx, tmp_path):
+    def make_key(directory):
+        directory.mkdir(parents=True)
+        subprocess.run(["openssl", "req", "-new", "-x509", "-newkey", "rsa:2048", "-nodes",
+                        "-subj", "/CN=test", "-outform", "DER",
+                        "-keyout", directory / "signing_key.pem",
+                        "-out", directory / "signing_key.x509"],
+                       check=True, capture_output=True)
+        return directory
+
+    remote = make_key(tmp_path / "remote")
+    archive = tmp_path / "entry.tar.gz"
+    with tarfile.open(archive, "w:gz") as tar:
+        tar.add(remote / "signing_key.x509", arcname="certs/signing_key.x509")
+
+    with tarfile.open(archive) as tar:
+        assert not build_kernel.check_restored_signing_key(ctx, tar)
+        make_key(ctx.out_dir / "certs")
+        assert not build_kernel.check_restored_signing_key(ctx, tar)
+        shutil.copy(remote / "signing_key.pem", ctx.out_dir / "certs" / "signing_key.pem")
+        assert build_kernel.check_restored_signing_key(ctx, tar)
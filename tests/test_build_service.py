@@ -0,0 +1,42 @@
+import shutil
+
+import pytest
+
+from build_kernel import BuildService, get_arg_parser
+
+
+@pytest.fixture
+def service(ctx, tmp_path):
+    ctx.kernel_source_dir = tmp_path / "kernel"
+    ctx.kernel_source_dir.mkdir()
+    return BuildService(ctx, get_arg_parser(), tmp_path / "service", 1)
+
+
+@pytest.mark.parametrize("flags", [
+    ["--save-size-baseline", "main"],
+    ["--thinlto-cache", "cache"],
+    ["--build-cache", "cache"],
+    ["--config-fragment", "/etc/debug.config"],
+    ["--config-fragment", "arch/arm64/configs/../../../../debug.config"],
+    ["--profile", "/tmp/kernel.afdo"],
+])
+def test_rejects_paths_outside_worker_tree(service, flags):
+    with pytest.raises(ValueError):
+        service.get_key("test", "main", flags)
+
+
+def test_accepts_paths_inside_worker_tree(service):
+    service.get_key("test", "main", [
+        "--config-fragment", "arch/arm64/configs/debug.config",
+        "--profile", "android/gki/kernel.afdo",
+        "--build-cache", "https://cache.example.com/kernel",
+    ])
+
+
+@pytest.mark.skipif(not shutil.which("git"), reason="needs git")
+def test_checkout_failure_is_logged(service, tmp_path):
+    log_path = tmp_path / "build.log"
+    assert service.checkout(tmp_path / "worker-0" / "kernel", "main", log_path) is None
+    log = log_path.read_text()
+    assert "not a git repository" in log
+    assert "ERROR: Checkout of 'main' failed: git worktree add" in log
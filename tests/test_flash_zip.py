@@ -0,0 +1,65 @@
+import os
+import stat
+import zipfile
+
+import pytest
+
+import build_kernel
+
+
+@pytest.fixture
+def anykernel(ctx, tmp_path, monkeypatch):
+    # Small chunks so the parallel path runs on small files
+    monkeypatch.setattr(build_kernel, "FLASH_ZIP_PARALLEL_THRESHOLD", 64 * 1024)
+    monkeypatch.setattr(build_kernel, "FLASH_ZIP_CHUNK_SIZE", 16 * 1024)
+    ctx.anykernel_path = tmp_path / "AnyKernel3"
+    files = {
+        "META-INF/com/google/android/update-binary": b"#!/sbin/sh\n" * 100,
+        "tools/busybox": os.urandom(100 * 1024),
+        "modules/empty": b"",
+        "ramdisk/ünïcode.txt": b"text",
+        "patch/blob.gz": os.urandom(1000),
+        ".git/HEAD": b"ref",
+    }
+    for rel, data in files.items():
+        path = ctx.anykernel_path / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+    (ctx.anykernel_path / "tools/busybox").chmod(0o755)
+    (ctx.dist_dir / "Image").write_bytes(os.urandom(50 * 1024) + b"\0" * 200 * 1024)
+    return ctx
+
+
+def build_zip(ctx):
+    for old in ctx.dist_dir.glob("*.zip"):
+        old.unlink()
+    build_kernel.create_flash_zip(ctx)
+    return next(ctx.dist_dir.glob("*.zip"))
+
+
+def test_round_trip(anykernel):
+    path = build_zip(anykernel)
+    with zipfile.ZipFile(path) as zf:
+        assert zf.testzip() is None
+        names = set(zf.namelist())
+        assert ".git/HEAD" not in names
+        for name in names - {"anykernel.sh", "Image"}:
+            assert zf.read(name) == (anykernel.anykernel_path / name).read_bytes()
+        assert zf.read("Image") == (anykernel.dist_dir / "Image").read_bytes()
+        assert zf.read("anykernel.sh") == (build_kernel.ROOT_DIR / "src/anykernel.sh").read_bytes()
+
+        assert zf.getinfo("patch/blob.gz").compress_type == zipfile.ZIP_STORED
+        image = zf.getinfo("Image")
+        assert image.compress_type == zipfile.ZIP_DEFLATED
+        assert image.compress_size < image.file_size
+        assert stat.S_IMODE(zf.getinfo("tools/busybox").external_attr >> 16) == 0o755
+
+
+def test_reproducible(anykernel):
+    anykernel.source_date_epoch = 1700000000
+    first = build_zip(anykernel).read_bytes()
+    os.utime(anykernel.anykernel_path / "tools/busybox", (1e9, 1e9))
+    path = build_zip(anykernel)
+    assert path.read_bytes() == first
+    with zipfile.ZipFile(path) as zf:
+        assert {x.date_time for x in zf.infolist()} == {(2023, 11, 14, 22, 13, 20)}
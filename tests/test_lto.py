@@ -0,0 +1,67 @@
+import os
+import time
+
+import pytest
+
+import build_kernel
+from build_kernel import (LTO_CONFIG_FRAGMENTS, get_config_lto_mode, mark_thinlto_cache_hits,
+                          prepare_thinlto_cache, prune_thinlto_cache, report_lto_link)
+
+
+@pytest.fixture
+def thinlto_cache(tmp_path):
+    """A cache of three entries last used long ago"""
+    cache_dir = tmp_path / "thinlto"
+    cache_dir.mkdir()
+    for name in ("llvmcache-a", "llvmcache-b", "llvmcache-c"):
+        (cache_dir / name).write_bytes(b"old")
+        os.utime(cache_dir / name, (1e9, 1e9))
+    return cache_dir
+
+
+def link(cache_dir):
+    """Reads entry a, replaces entry c through a rename and adds entry d"""
+    path = cache_dir / "llvmcache-a"
+    os.utime(path, ns=(time.time_ns(), path.stat().st_mtime_ns))
+    (cache_dir / "new.tmp").write_bytes(b"new")
+    os.replace(cache_dir / "new.tmp", cache_dir / "llvmcache-c")
+    (cache_dir / "llvmcache-d").write_bytes(b"new")
+
+
+def test_thinlto_reuse_and_pruning(ctx, thinlto_cache, monkeypatch):
+    messages = []
+    monkeypatch.setattr(build_kernel, "log_message", messages.append)
+    monkeypatch.setattr(build_kernel, "thinlto_cache_reads_update_atime", lambda _: True)
+    before = prepare_thinlto_cache(thinlto_cache)
+    link(thinlto_cache)
+    hits = mark_thinlto_cache_hits(thinlto_cache, before)
+    assert hits == {"llvmcache-a"}
+    report_lto_link(ctx, "thin", time.time(), thinlto_cache, before, hits)
+    assert any("1 entries reused, 2 new (33.3% reuse)" in x for x in messages)
+
+    # Entry a was last used now, b only at its first write
+    prune_thinlto_cache(thinlto_cache, 1 << 20, 1)
+    assert sorted(x.name for x in thinlto_cache.iterdir()) == [
+        "llvmcache-a", "llvmcache-c", "llvmcache-d"]
+
+
+def test_thinlto_hits_without_atime(thinlto_cache, monkeypatch):
+    monkeypatch.setattr(build_kernel, "thinlto_cache_reads_update_atime", lambda _: False)
+    before = prepare_thinlto_cache(thinlto_cache)
+    link(thinlto_cache)
+    assert mark_thinlto_cache_hits(thinlto_cache, before) == {"llvmcache-a", "llvmcache-b"}
+
+
+def test_lto_mode_from_config_inputs(ctx, tmp_path):
+    ctx.kernel_source_dir = tmp_path / "kernel"
+    configs = ctx.kernel_source_dir / "arch" / ctx.arch / "configs"
+    configs.mkdir(parents=True)
+    (configs / ctx.defconfig).write_text("CONFIG_LTO_CLANG_FULL=y\n")
+    assert get_config_lto_mode(ctx, []) == "full"
+
+    fragment = tmp_path / "lto.config"
+    fragment.write_text("\n".join(LTO_CONFIG_FRAGMENTS["none"]) + "\n")
+    assert get_config_lto_mode(ctx, [fragment]) == "none"
+    # No .config is read, so the answer is the same before and after one exists
+    (ctx.out_dir / ".config").write_text("CONFIG_LTO_CLANG_THIN=y\n")
+    assert get_config_lto_mode(ctx, [fragment]) == "none"
@@ -0,0 +1,79 @@
+import pytest
+
+import build_kernel
+
+MAKEFILES = {
+    "drivers/Makefile": "obj-$(CONFIG_FOO_DRIVERS) += foo/\nobj-y += bar/\n",
+    "drivers/foo/Makefile": "obj-$(CONFIG_FOO) += foo.o\nobj-m += foo_extra.o\n",
+    "drivers/bar/Makefile": (
+        "obj-m += bar.o\n"
+        "obj-y += bar_core.o \\\n\tbar_util.o  # built-in\n"
+        "obj-$(CONFIG_BAR_DEBUG) += bar_debug.o\n"
+        "obj-$(BAR_VARIANT) += bar_variant.o\n"
+    ),
+}
+
+
+@pytest.fixture
+def kernel(ctx, tmp_path):
+    ctx.kernel_source_dir = tmp_path / "src"
+    for rel, text in MAKEFILES.items():
+        path = ctx.kernel_source_dir / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text)
+    return ctx
+
+
+def write_config(ctx, **symbols):
+    (ctx.out_dir / ".config").write_text(
+        "".join(f"CONFIG_{name}={value}\n" for name, value in symbols.items()))
+
+
+def preflight(ctx, tmp_path, *modules):
+    list_file = tmp_path / "modules.load"
+    list_file.write_text("\n".join(modules) + "\n")
+    build_kernel.preflight_module_lists(ctx, [list_file])
+
+
+def test_scan_kbuild_makefiles(kernel):
+    modules, dirs = build_kernel.scan_kbuild_makefiles(kernel)
+    assert modules["foo.ko"] == [("drivers/foo", "CONFIG_FOO")]
+    assert modules["foo_extra.ko"] == [("drivers/foo", "m")]
+    assert modules["bar.ko"] == [("drivers/bar", "m")]
+    assert modules["bar_core.ko"] == [("drivers/bar", "y")]
+    assert modules["bar_util.ko"] == [("drivers/bar", "y")]
+    assert "bar_variant.ko" not in modules
+    assert dirs["drivers/foo"] == "CONFIG_FOO_DRIVERS"
+    assert dirs["drivers/bar"] is None
+
+
+def test_preflight_passes_obj_m_and_config_m(kernel, tmp_path):
+    write_config(kernel, FOO_DRIVERS="y", FOO="m")
+    preflight(kernel, tmp_path, "foo.ko", "foo_extra.ko", "bar.ko")
+
+
+@pytest.mark.parametrize("config, module", [
+    ({"FOO_DRIVERS": "y", "FOO": "y"}, "foo.ko"),
+    ({"FOO_DRIVERS": "y"}, "foo.ko"),
+    ({"FOO": "m"}, "foo_extra.ko"),
+    ({}, "bar_core.ko"),
+])
+def test_preflight_fails_unbuilt_modules(kernel, tmp_path, config, module):
+    write_config(kernel, **config)
+    with pytest.raises(SystemExit):
+        preflight(kernel, tmp_path, module)
+
+
+def test_preflight_warns_on_unmapped_modules(kernel, tmp_path):
+    write_config(kernel)
+    preflight(kernel, tmp_path, "bar_variant.ko")
+
+
+def test_preflight_maps_through_modules_order(kernel, tmp_path):
+    write_config(kernel)
+    (kernel.out_dir / "modules.order").write_text("drivers/bar/bar_variant.ko\n")
+    preflight(kernel, tmp_path, "bar_variant.ko")
+
+    (kernel.out_dir / "modules.order").write_text("drivers/foo/foo_variant.ko\n")
+    with pytest.raises(SystemExit):
+        preflight(kernel, tmp_path, "foo_variant.ko")
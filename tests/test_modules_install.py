@@ -0,0 +1,117 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from build_kernel import MODULES_INSTALL_MANIFEST_FILE, install_modules_incremental
+
+pytestmark = pytest.mark.skipif(
+    not all(shutil.which(x) for x in ("make", "gcc", "llvm-strip")),
+    reason="needs make, gcc and llvm-strip")
+
+# Link order differs from alphabetical order, and two modules share a name
+MODULE_ORDER = ["drivers/z/zeta.o", "drivers/b/foo.o", "drivers/a/foo.o"]
+
+# modules_install as Kbuild does it: strip, sign, copy the lists, depmod
+KBUILD_MAKEFILE = """\
+modules_install:
+\tcd $(O) && rel=$$(cat include/config/kernel.release) && \\
+\tdir=$(INSTALL_MOD_PATH)/lib/modules/$$rel && \\
+\tfor m in $$(sed 's:\\.o$$:.ko:' modules.order); do \\
+\t\tmkdir -p $$dir/kernel/$$(dirname $$m) && \\
+\t\tllvm-strip $(INSTALL_MOD_STRIP) -o $$dir/kernel/$$m $$m && \\
+\t\tscripts/sign-file sha256 certs/signing_key.pem certs/signing_key.x509 $$dir/kernel/$$m \\
+\t\t|| exit 1; \\
+\tdone && \\
+\tsed 's:^\\(.*\\)\\.o$$:kernel/\\1.ko:' modules.order > $$dir/modules.order && \\
+\tcp -f modules.builtin modules.builtin.modinfo $$dir/ && \\
+\t{depmod} -a -b $(INSTALL_MOD_PATH) $$rel
+"""
+
+SIGN_FILE = """\
+#!/bin/sh
+printf 'signed %s with %s\\n' "$1" "$2" >> "$4"
+"""
+
+DEPMOD = """\
+#!/bin/sh
+cd "$3/lib/modules/$4" && find kernel -name '*.ko' | sort > modules.dep
+"""
+
+
+def write_script(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+    path.chmod(0o755)
+
+
+def build_module(ctx, rel, source):
+    c_file = ctx.temp_dir / "module.c"
+    c_file.write_text(source)
+    ko = ctx.out_dir / rel.replace(".o", ".ko")
+    ko.parent.mkdir(parents=True, exist_ok=True)
+    subprocess.run(["gcc", "-g", "-c", c_file, "-o", ko], check=True)
+
+
+def read_tree(root):
+    return {
+        str(x.relative_to(root)): x.read_bytes()
+        for x in sorted(root.rglob("*")) if x.is_file()
+    }
+
+
+@pytest.fixture
+def kbuild(ctx, tmp_path):
+    source_dir = tmp_path / "kernel"
+    tools_dir = tmp_path / "tools"
+    write_script(tools_dir / "depmod", DEPMOD)
+    source_dir.mkdir()
+    (source_dir / "Makefile").write_text(KBUILD_MAKEFILE.format(depmod=tools_dir / "depmod"))
+    ctx.kernel_source_dir = source_dir
+    ctx.kernelbuild_tools_path = tools_dir
+
+    out = ctx.out_dir
+    (out / "include" / "config").mkdir(parents=True)
+    (out / "include" / "config" / "kernel.release").write_text("6.1.0-test\n")
+    (out / ".config").write_text(
+        "CONFIG_MODULE_SIG_ALL=y\n"
+        'CONFIG_MODULE_SIG_HASH="sha256"\n'
+        'CONFIG_MODULE_SIG_KEY="certs/signing_key.pem"\n')
+    write_script(out / "scripts" / "sign-file", SIGN_FILE)
+    (out / "certs").mkdir()
+    (out / "certs" / "signing_key.pem").write_text("key\n")
+    (out / "certs" / "signing_key.x509").write_text("cert\n")
+    (out / "modules.order").write_text("".join(f"{x}\n" for x in MODULE_ORDER))
+    (out / "modules.builtin").write_text("kernel/drivers/x/builtin.ko\n")
+    (out / "modules.builtin.modinfo").write_bytes(b"builtin.description=test\0")
+    for index, rel in enumerate(MODULE_ORDER):
+        build_module(ctx, rel, f"int value_{index} = {index};\n")
+    return ctx
+
+
+def test_incremental_install_matches_full_install(kbuild, tmp_path):
+    ctx = kbuild
+    install_modules_incremental(ctx, 2)
+
+    # Rebuild one of the modules sharing a name
+    build_module(ctx, "drivers/a/foo.o", "int value_2 = 42;\n")
+    os.utime(ctx.out_dir / "drivers/a/foo.ko", ns=(1, 1))
+    install_modules_incremental(ctx, 2)
+    incremental = read_tree(ctx.modules_staging_dir)
+
+    (ctx.out_dir / MODULES_INSTALL_MANIFEST_FILE).unlink()
+    ctx.modules_staging_dir = tmp_path / "full_install"
+    install_modules_incremental(ctx, 2)
+    full = read_tree(ctx.modules_staging_dir)
+
+    assert incremental.keys() == full.keys()
+    for name in full:
+        assert incremental[name] == full[name], name
+
+    install_dir = "lib/modules/6.1.0-test/"
+    assert incremental[install_dir + "modules.builtin"] == b"kernel/drivers/x/builtin.ko\n"
+    assert incremental[install_dir + "modules.order"].decode().split() == [
+        "kernel/" + x.replace(".o", ".ko") for x in MODULE_ORDER]
+    assert incremental[install_dir + "kernel/drivers/a/foo.ko"].endswith(
+        b"signed sha256 with certs/signing_key.pem\n")
@@ -0,0 +1,58 @@
+import shutil
+import subprocess
+
+import pytest
+
+import build_kernel
+
+pytestmark = pytest.mark.skipif(not shutil.which("llvm-profdata"), reason="needs llvm-profdata")
+
+
+@pytest.fixture
+def vmlinux(ctx, tmp_path):
+    """A small ELF with a few functions standing in for vmlinux"""
+    if not shutil.which("gcc"):
+        pytest.skip("needs gcc")
+    source = tmp_path / "vmlinux.c"
+    source.write_text("int sched_tick(int x) { return x * 3; }\n"
+                      "int do_idle(int x) { return x + 1; }\n"
+                      "int main(void) { return sched_tick(do_idle(0)); }\n")
+    subprocess.run(["gcc", "-O1", "-o", ctx.out_dir / "vmlinux", source], check=True)
+    return ctx
+
+
+@pytest.fixture
+def profile(vmlinux, tmp_path, monkeypatch):
+    monkeypatch.setattr(build_kernel, "PROFILE_CACHE_DIR", tmp_path / "profiles")
+    path = tmp_path / "kernel.afdo"
+    build_kernel.write_synthetic_profile(vmlinux, path, 2)
+    build_kernel.load_profile(vmlinux, path)
+    return vmlinux
+
+
+def test_synthetic_profile(profile):
+    assert profile.profile["kind"] == "sample"
+    assert profile.profile["path"].parent.name == "profiles"
+    coverage = build_kernel.report_profile_coverage(profile)
+    assert coverage["matched_functions"] == coverage["hot_functions"] - 1
+    assert coverage["missing_hot_functions"] == ["synthetic_missing_function"]
+
+
+def test_make_args_keep_kcflags(profile):
+    profile.env["KCFLAGS"] = "-Wno-error"
+    kcflags = [x for x in build_kernel.get_make_args(profile) if x.startswith("KCFLAGS=")]
+    assert kcflags == [f"KCFLAGS=-Wno-error -fprofile-sample-use={profile.profile['path']}"]
+
+
+def test_lto_link_gets_sample_profile(profile):
+    profile.env["LDFLAGS_vmlinux"] = "-X"
+    build_kernel.set_profile_link_flags(profile, "none")
+    assert profile.env["LDFLAGS_vmlinux"] == "-X"
+    assert "LDFLAGS_MODULE" not in profile.env
+
+    build_kernel.set_profile_link_flags(profile, "thin")
+    flag = f"--lto-sample-profile={profile.profile['path']}"
+    assert profile.env["LDFLAGS_vmlinux"] == f"-X {flag}"
+    assert profile.env["LDFLAGS_MODULE"] == flag
+    assert not any(x.startswith(("LD=", "LDFLAGS")) for x in build_kernel.get_make_args(profile))
+
@@ -0,0 +1,72 @@
+import json
+
+import pytest
+
+import build_kernel
+
+BUDGETS = {"max_size": {"dist:*.img": 1000}, "max_growth": {"dist:Image": 100}}
+
+
+def report(**metrics):
+    return {"metrics": metrics}
+
+
+def test_check_size_budgets():
+    old = report(**{"dist:Image": 5000})
+    assert build_kernel.check_size_budgets(
+        BUDGETS, report(**{"dist:Image": 5100, "dist:boot.img": 1000}), old) == []
+
+    violations = build_kernel.check_size_budgets(
+        BUDGETS, report(**{"dist:Image": 5101, "dist:boot.img": 1001}), old)
+    assert violations == [
+        "dist:Image grew by 101 bytes, budget 100 (dist:Image)",
+        "dist:boot.img is 1001 bytes, budget 1000 (dist:*.img)",
+    ]
+
+
+def test_growth_needs_previous_report():
+    assert build_kernel.check_size_budgets(BUDGETS, report(**{"dist:Image": 10 ** 9}), None) == []
+    assert build_kernel.check_size_budgets(
+        BUDGETS, report(**{"dist:Image": 10 ** 9}), report(**{"dist:boot.img": 1})) == []
+
+
+@pytest.fixture
+def history(ctx, tmp_path, monkeypatch):
+    monkeypatch.setattr(build_kernel, "SIZE_HISTORY_DIR", tmp_path / "history")
+    ctx.kernel_source_dir = tmp_path
+    budgets = tmp_path / "budgets.json"
+    budgets.write_text(json.dumps(BUDGETS))
+    return budgets
+
+
+def build(ctx, budgets, image_size, **kwargs):
+    (ctx.dist_dir / "Image").write_bytes(b"\0" * image_size)
+    build_kernel.track_sizes(ctx, budgets_path=budgets, **kwargs)
+
+
+def test_over_budget_build_is_not_recorded(ctx, history):
+    build(ctx, history, 5000)
+    with pytest.raises(SystemExit):
+        build(ctx, history, 5500)
+    # Still compared against the accepted 5000 byte build
+    with pytest.raises(SystemExit):
+        build(ctx, history, 5500)
+    name, previous = build_kernel.load_size_report(ctx)
+    assert previous["metrics"]["dist:Image"] == 5000
+
+
+def test_baselines(ctx, history):
+    build(ctx, history, 5000, save_baseline="v1.0")
+    build(ctx, history, 5100)
+    build(ctx, history, 5200)
+    with pytest.raises(SystemExit):
+        build(ctx, history, 5201, baseline="v1.0")
+    assert build_kernel.load_size_report(ctx, "v1.0")[1]["metrics"]["dist:Image"] == 5000
+
+
+@pytest.mark.parametrize("name", ["../x", "a/b", ".hidden"])
+def test_baseline_names_stay_in_history(ctx, history, name):
+    with pytest.raises(SystemExit):
+        build(ctx, history, 5000, save_baseline=name)
+    with pytest.raises(SystemExit):
+        build_kernel.load_size_report(ctx, name)
@@ -0,0 +1,86 @@
+import re
+import threading
+import time
+
+import pytest
+
+import build_kernel
+
+
+@pytest.fixture(autouse=True)
+def engine(monkeypatch):
+    """Engine running enough commands at once for the stages below"""
+    engine = build_kernel.SubprocessEngine(8)
+    monkeypatch.setattr(build_kernel, "_ENGINE", engine)
+    return engine
+
+
+def test_failed_stage_cancels_its_group_only(ctx):
+    other = {}
+
+    def other_build():
+        try:
+            build_kernel.run_parallel_stages([
+                ("slow", lambda: build_kernel.run_cmd(ctx, ["sleep", "1"])),
+                ("fast", lambda: build_kernel.run_cmd(ctx, ["true"])),
+            ])
+            other["result"] = "ok"
+        except SystemExit:
+            other["result"] = "failed"
+
+    thread = threading.Thread(target=other_build)
+    thread.start()
+    start = time.monotonic()
+    with pytest.raises(SystemExit):
+        build_kernel.run_parallel_stages([
+            ("sleep", lambda: build_kernel.run_cmd(ctx, ["sleep", "30"])),
+            ("fail", lambda: (time.sleep(0.2), build_kernel.run_cmd(ctx, ["false"]))),
+        ])
+    assert time.monotonic() - start < 10
+    thread.join()
+    assert other["result"] == "ok"
+
+    # Nothing is left aborted for the next group
+    build_kernel.run_parallel_stages([
+        ("a", lambda: build_kernel.run_cmd(ctx, ["true"])),
+        ("b", lambda: build_kernel.run_cmd(ctx, ["true"])),
+    ])
+
+
+def test_abort_reaches_nested_groups(ctx, engine):
+    outer = build_kernel.CommandGroup()
+    inner = build_kernel.CommandGroup(outer)
+    result = {}
+
+    def run():
+        with build_kernel.command_group(inner):
+            result["stdout"] = build_kernel.run_cmd(ctx, ["sleep", "30"], fatal_on_error=False)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    time.sleep(0.5)
+    engine.abort(outer).result(10)
+    thread.join(10)
+    assert not thread.is_alive()
+    assert result["stdout"] is None
+    assert not engine.aborted
+
+
+def test_kernel_goals_report_the_separate_dtbs_make(ctx, monkeypatch):
+    calls = []
+    messages = []
+
+    def run_kernel_make(ctx, jobs, extra_env, config_fragments, goals=None):
+        calls.append(goals)
+        time.sleep(0.3 if goals == ["dtbs"] else 0.2)
+
+    monkeypatch.setattr(build_kernel, "run_kernel_make", run_kernel_make)
+    monkeypatch.setattr(build_kernel, "log_message", messages.append)
+    build_kernel.run_kernel_goals(ctx, 1, None, [], lambda: time.sleep(0.2))
+
+    assert calls == [["dtbs"], ["Image", "modules"]]
+    overlap, dtbs_make, saved = (float(x) for x in re.search(
+        r"([-\d.]+)s overlapped; the separate dtbs make took ([-\d.]+)s, "
+        r"so at least ([-\d.]+)s", messages[-1]).groups())
+    assert dtbs_make == pytest.approx(0.3, abs=0.05)
+    assert saved == pytest.approx(overlap - dtbs_make, abs=0.11)
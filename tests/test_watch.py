@@ -0,0 +1,48 @@
+import pytest
+
+import build_kernel
+
+
+@pytest.fixture
+def built(ctx, tmp_path):
+    ctx.kernel_source_dir = tmp_path / "src"
+    ctx.kernel_source_dir.mkdir()
+    (ctx.out_dir / "modules.order").write_text(
+        "drivers/net/foo/foo.ko\ndrivers/net/bar.o\n")
+    (ctx.out_dir / "drivers/net/foo").mkdir(parents=True)
+    # Newer kbuild: one object per line
+    (ctx.out_dir / "drivers/net/foo/foo.mod").write_text(
+        "drivers/net/foo/main.o\ndrivers/net/foo/lib/util.o\n")
+    # Older kbuild: objects on the first line, undefined symbols on the second
+    (ctx.out_dir / "drivers/net/bar.mod").write_text(
+        "drivers/net/bar.o drivers/net/foo/lib/util.o\n printk\n")
+    return ctx
+
+
+def classify(ctx, *paths):
+    return build_kernel.classify_source_changes(ctx, {ctx.kernel_source_dir / x for x in paths})
+
+
+def test_module_sources(built):
+    assert classify(built, "drivers/net/foo/main.c") == ("modules", ["foo.ko"])
+    assert classify(built, "drivers/net/foo/lib/util.c") == ("modules", ["bar.ko", "foo.ko"])
+    assert classify(built, "drivers/net/bar.c", "drivers/net/foo/main.c") == \
+        ("modules", ["bar.ko", "foo.ko"])
+
+
+def test_built_in_next_to_modules(built):
+    # Same directory as bar.ko, and below foo.ko's directory
+    assert classify(built, "drivers/net/core.c") == ("full", [])
+    assert classify(built, "drivers/net/foo/lib/builtin.c") == ("full", [])
+    assert classify(built, "drivers/net/bar.c", "drivers/net/core.c") == ("full", [])
+
+
+def test_other_changes(built):
+    assert classify(built, "README") == ("none", [])
+    assert classify(built, "arch/arm64/boot/dts/a.dts") == ("dtbs", [])
+    assert classify(built, "drivers/net/foo/foo.h") == ("full", [])
+
+
+def test_no_previous_build(ctx, tmp_path):
+    ctx.kernel_source_dir = tmp_path / "src"
+    assert classify(ctx, "drivers/net/foo/main.c") == ("full", [])